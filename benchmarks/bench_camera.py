@@ -0,0 +1,60 @@
+import numpy as np
+
+# (the messages of import errors are kept, so a skipped benchmark names the missing module)
+try:
+    from treadmillio.camera.camerainterface import debayer_frame
+    debayer_import_error = None
+except ImportError as e: # needs OpenCV (and the other camera dependencies)
+    debayer_frame = None
+    debayer_import_error = str(e)
+
+try:
+    from treadmillio.camera.videowriter import jpeg_encoder
+    jpeg_import_error = None
+except ImportError as e: # needs simplejpeg
+    jpeg_encoder = None
+    jpeg_import_error = str(e)
+
+
+def make_frame(sx, sy):
+    # A smooth gradient with some noise, roughly as compressible as a real frame
+    rng = np.random.RandomState(0)
+    x, y = np.meshgrid(np.arange(sx), np.arange(sy))
+    frame = (x + y) * 255.0 / (sx + sy) + rng.normal(0, 8, (sy, sx))
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+RESOLUTIONS = ['640x480', '1280x1024']
+
+
+class Debayer:
+    params = (RESOLUTIONS, ['Mono8', 'Bayer_RG8'])
+    param_names = ['resolution', 'mode']
+
+    def setup(self, resolution, mode):
+        if debayer_frame is None:
+            raise NotImplementedError('Camera interface is not importable ({}).'.format(debayer_import_error))
+        self.sx, self.sy = [int(v) for v in resolution.split('x')]
+        self.raw = make_frame(self.sx, self.sy).tobytes()
+
+    def time_debayer(self, resolution, mode):
+        debayer_frame(self.raw, mode, self.sx, self.sy)
+
+
+class JpegEncode:
+    params = (RESOLUTIONS, ['Mono8', 'Bayer_RG8'], [85])
+    param_names = ['resolution', 'mode', 'quality']
+
+    def setup(self, resolution, mode, quality):
+        if jpeg_encoder is None:
+            raise NotImplementedError('Video writer is not importable ({}).'.format(jpeg_import_error))
+        sx, sy = [int(v) for v in resolution.split('x')]
+        frame = make_frame(sx, sy)
+        if mode == 'Mono8':
+            self.img = frame.reshape(sy, sx, 1)
+        else:
+            self.img = np.ascontiguousarray(np.repeat(frame[:, :, np.newaxis], 3, axis=2))
+        self.encode = jpeg_encoder(mode, quality)
+
+    def time_jpeg_encode(self, resolution, mode, quality):
+        self.encode(self.img)
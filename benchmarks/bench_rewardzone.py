@@ -0,0 +1,42 @@
+import numpy as np
+
+from treadmillio.rewardzone import RewardZoneController
+
+from .common import make_interface, null_logger, TRACK_LENGTH
+
+
+def make_zones(n_zones, zone_type):
+    zones = {}
+    width = TRACK_LENGTH / n_zones
+    for idx in range(n_zones):
+        zone = {'Type': zone_type,
+                'DispensePin': 'Reward',
+                'RewardZoneStart': idx * width,
+                'RewardZoneEnd': idx * width + width / 4,
+                'ResetZoneStart': idx * width + width / 2,
+                'ResetZoneEnd': idx * width + 3 * width / 4,
+                'PumpRunTime': 1,
+                'LickTimeout': 0}
+        if zone_type == 'Operant':
+            zone['LickPin'] = 'Lick'
+        zones['Zone{}'.format(idx)] = zone
+    return {'RewardZoneList': zones}
+
+
+class UpdateRewardZones:
+    params = ([1, 10, 100], ['Classical', 'Operant'])
+    param_names = ['n_zones', 'zone_type']
+
+    def setup(self, n_zones, zone_type):
+        self.interface = make_interface()
+        self.controller = RewardZoneController(make_zones(n_zones, zone_type), self.interface)
+        self.positions = np.linspace(0, TRACK_LENGTH, 1000, endpoint=False).tolist()
+        self.idx = 0
+        self.time = 0
+
+    def time_update_reward_zones(self, n_zones, zone_type):
+        # sweep around the track, so zones are entered, rewarded and reset (licking all along)
+        self.time += 2
+        self.idx = (self.idx + 1) % len(self.positions)
+        self.interface.inputs.update(self.time, 0x04)
+        self.controller.update_reward_zones(self.time, self.positions[self.idx], 0x04, null_logger)
@@ -0,0 +1,60 @@
+from .common import make_interface
+
+
+class ReadData:
+    params = ([0, 1, 5, 50], [False, True])
+    param_names = ['backlog', 'catch_up']
+
+    def setup(self, backlog, catch_up):
+        self.interface = make_interface(backlog=backlog, catch_up=catch_up)
+
+    def time_read_data(self, backlog, catch_up):
+        self.interface.read_data()
+
+
+class UpdatePulses:
+    def setup(self):
+        self.interface = make_interface()
+
+    def time_update_pulses_idle(self):
+        self.interface.update_pulses()
+
+    def time_pulse_cycle(self):
+        # raise a pulse and lower it on the next update
+        self.interface.pulse_output('Reward', -1)
+        self.interface.update_pulses()
+        self.interface.flush_commands()
+
+
+class UpdatePulsesPending:
+    # update_pulses() with many outputs in the middle of long pulses (should not depend on the number)
+    params = [1, 16, 256]
+    param_names = ['n_pending']
+
+    def setup(self, n_pending):
+        self.interface = make_interface()
+        for idx in range(n_pending):
+            name = 'Output{}'.format(idx)
+            self.interface.add_gpio(name, {'Number': 5 + idx % 8, 'Type': 'Output'})
+            self.interface.pulse_output(name, 10**9)
+
+    def time_update_pulses(self, n_pending):
+        self.interface.update_pulses()
+
+
+
+class UpdateInputs:
+    # edges and debouncing of the GPIO inputs, with the lick pin bouncing every few packets
+    params = ([1, 8, 16], [1, 10])
+    param_names = ['n_inputs', 'debounce']
+
+    def setup(self, n_inputs, debounce):
+        self.interface = make_interface()
+        for idx in range(n_inputs):
+            self.interface.inputs.add_input('Input{}'.format(idx), idx + 1, debounce)
+        self.words = [0x04 * ((idx // 3) % 2) for idx in range(60)]
+        self.idx = 0
+
+    def time_update_inputs(self, n_inputs, debounce):
+        self.idx = (self.idx + 1) % len(self.words)
+        self.interface.inputs.update(self.idx * 2, self.words[self.idx])
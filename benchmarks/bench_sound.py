@@ -0,0 +1,108 @@
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+
+from .common import NullPipe, TRACK_LENGTH
+
+try:
+    import scipy.io.wavfile
+    from treadmillio import soundstimulus, alsainterface
+    sound_import_error = None
+except ImportError as e:
+    soundstimulus = None
+    sound_import_error = str(e)
+
+
+def make_localized_sounds(n_stimuli, modulation='Linear'):
+    sounds = {}
+    with mock.patch.object(soundstimulus.time, 'sleep'): # SoundStimulus waits for the ALSA process
+        for idx in range(n_stimuli):
+            params = {'Device': 'Default1', 'BaselineGain': 0.0, 'OffGain': -90.0,
+                      'CenterPosition': idx * TRACK_LENGTH / n_stimuli,
+                      'Modulation': {'Type': modulation, 'Width': 20.0, 'CutoffGain': -60.0, 'SpeakerDistance': 5.0}}
+            name = 'Sound{}'.format(idx)
+            sounds[name] = soundstimulus.LocalizedSound(TRACK_LENGTH, 'Line' if modulation == 'Natural' else 'Ring',
+                                                        name, params, NullPipe(), 0)
+    return sounds
+
+
+class UpdateLocalized:
+    params = ([1, 10, 50], ['Linear', 'Natural'])
+    param_names = ['n_stimuli', 'modulation']
+
+    def setup(self, n_stimuli, modulation):
+        if soundstimulus is None:
+            raise NotImplementedError('Sound modules are not importable ({}).'.format(sound_import_error))
+        self.controller = soundstimulus.SoundStimulusController.__new__(soundstimulus.SoundStimulusController)
+        self.controller.alsa_playback_pipe = NullPipe()
+        self.controller.LocalizedStimuli = make_localized_sounds(n_stimuli, modulation)
+        self.positions = np.linspace(0, TRACK_LENGTH, 1000, endpoint=False).tolist()
+        self.idx = 0
+
+    def time_update_localized(self, n_stimuli, modulation):
+        self.idx = (self.idx + 1) % len(self.positions)
+        pos = self.positions[self.idx]
+        self.controller.update_localized(pos, pos)
+
+
+def write_test_sound(directory, name, fs=96000, duration=1.0):
+    filename = os.path.join(directory, name)
+    t = np.arange(int(fs * duration)) / fs
+    scipy.io.wavfile.write(filename, fs, (np.sin(2 * np.pi * 1000 * t) * 10000).astype(np.int16))
+    return filename
+
+
+class StimulusNextBuffer:
+    params = ([32, 256], [False, True])
+    param_names = ['buffer_size', 'gain_change']
+
+    def setup(self, buffer_size, gain_change):
+        if soundstimulus is None:
+            raise NotImplementedError('Sound modules are not importable ({}).'.format(sound_import_error))
+        self.directory = tempfile.mkdtemp()
+        filename = write_test_sound(self.directory, 'tone.wav')
+        data_buffer = np.zeros((buffer_size, 2, 1))
+        self.stimulus = alsainterface.Stimulus(filename, data_buffer[:, :, 0], 0, buffer_size, -10.0, window=buffer_size)
+        self.gains = [0.1, 0.5]
+        self.gain_change = gain_change
+
+    def teardown(self, buffer_size, gain_change):
+        for f in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, f))
+        os.rmdir(self.directory)
+
+    def time_get_nextbuf(self, buffer_size, gain_change):
+        if self.gain_change: # each buffer crossfades to a new gain
+            self.gains.reverse()
+            self.stimulus.gain = self.gains[0]
+        self.stimulus.get_nextbuf()
+
+
+class PlaybackMix:
+    params = ([32, 256], [1, 10, 50])
+    param_names = ['buffer_size', 'n_stimuli']
+
+    def setup(self, buffer_size, n_stimuli):
+        if soundstimulus is None:
+            raise NotImplementedError('Sound modules are not importable ({}).'.format(sound_import_error))
+        self.directory = tempfile.mkdtemp()
+        filename = write_test_sound(self.directory, 'tone.wav')
+
+        # An ALSAPlaybackSystem without a sound device - just what mix() uses
+        self.system = alsainterface.ALSAPlaybackSystem.__new__(alsainterface.ALSAPlaybackSystem)
+        self.system.adevice = None
+        self.system.data_buf = np.zeros((buffer_size, 2, n_stimuli))
+        self.system.stimuli = {'Stimulus{}'.format(k): alsainterface.Stimulus(filename, self.system.data_buf[:, :, k], k % 2,
+                                                                              buffer_size, -20.0, window=buffer_size)
+                               for k in range(n_stimuli)}
+        self.system.out_buf = np.zeros((buffer_size, 2), dtype='int16', order='C')
+
+    def teardown(self, buffer_size, n_stimuli):
+        for f in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, f))
+        os.rmdir(self.directory)
+
+    def time_mix(self, buffer_size, n_stimuli):
+        self.system.mix()
@@ -0,0 +1,85 @@
+from treadmillio.taskstatemachine import TaskState, TaskStateMachine, PatchState
+
+from .common import make_interface
+
+
+def make_transitions(condition_type, n_transitions):
+    transitions = {}
+    for idx in range(n_transitions):
+        kind = condition_type
+        if condition_type == 'Mixed':
+            kind = ['GPIO', 'Speed', 'Position', 'ElapsedTime'][idx % 4]
+        if kind == 'ElapsedTime':
+            params = {'ConditionType': 'ElapsedTime', 'Duration': 10**9}
+        elif kind == 'GPIO':
+            params = {'ConditionType': 'GPIO', 'Pin': 3, 'Value': idx % 2 == 0}
+        elif kind == 'Equation':
+            params = {'ConditionType': 'GPIO', 'Equation': 'Lick AND NOT (Reward OR AUX{})'.format(idx % 12 + 1)}
+        elif kind == 'Speed':
+            params = {'ConditionType': 'Speed', 'Threshold': 1000.0 + idx, 'Direction': '>'}
+        elif kind == 'Position':
+            params = {'ConditionType': 'Position', 'Threshold': 1000.0 + idx, 'Direction': '>'}
+        elif kind == 'Random':
+            params = {'ConditionType': 'Random'}
+        else:
+            params = {'ConditionType': 'None'}
+        transitions['State{}'.format(idx)] = params
+    return transitions
+
+
+class GetNextState:
+    params = (['None', 'ElapsedTime', 'GPIO', 'Equation', 'Speed', 'Position', 'Random', 'Mixed'], [1, 4, 16])
+    param_names = ['condition_type', 'n_transitions']
+
+    def setup(self, condition_type, n_transitions):
+        self.interface = make_interface()
+        self.state = TaskState('Benchmark', {'NextState': make_transitions(condition_type, n_transitions)},
+                               self.interface)
+        self.state.on_entrance()
+
+    def time_get_next_state(self, condition_type, n_transitions):
+        self.state.get_next_state()
+
+
+class UpdateStatemachineIdle:
+    # A state waiting on many conditions, none of which is met
+    params = (['EveryTick', 'EventDriven'], [4, 16])
+    param_names = ['evaluation_mode', 'n_transitions']
+
+    def setup(self, evaluation_mode, n_transitions):
+        self.interface = make_interface()
+        transitions = make_transitions('Mixed', n_transitions)
+        states = {'Waiting': {'Type': 'Base', 'FirstState': True, 'NextState': transitions}}
+        for state_name in transitions:
+            states[state_name] = {'Type': 'Base', 'NextState': 'Waiting'}
+        self.state_machine = TaskStateMachine({'States': states, 'EvaluationMode': evaluation_mode},
+                                              self.interface, None)
+        self.state_machine.update_statemachine() # enter the first state
+
+    def time_update_statemachine(self, evaluation_mode, n_transitions):
+        self.state_machine.update_statemachine()
+
+
+class PatchStateRemain:
+    # A patch which has been filling for session_minutes, waiting for a reward threshold
+    params = (['Poisson', 'Exponential'], [1, 60])
+    param_names = ['model_type', 'session_minutes']
+
+    def setup(self, model_type, session_minutes):
+        self.interface = make_interface()
+        if model_type == 'Poisson':
+            model_params = {'tau': 10.0**6, 'V0': 0.5, 'lambda0': 2.0}
+        else:
+            model_params = {'tau': 10.0**6, 'r0': 1.0}
+        config = {'Params': {'ModelType': model_type, 'ModelParams': model_params},
+                  'NextState': {'Harvest': {'ConditionType': 'Reward', 'Value': 10.0**9},
+                                'Tone': {'ConditionType': 'Increment', 'Value': 10.0**9}}}
+        self.state = PatchState('Patch', config, self.interface)
+        self.state.on_entrance()
+        self.interface.MasterTime = session_minutes * 60000
+        self.state.on_remain()
+
+    def time_on_remain(self, model_type, session_minutes):
+        self.interface.MasterTime += 2
+        self.state.on_remain()
+        self.state.get_next_state()
@@ -0,0 +1,62 @@
+import numpy as np
+
+from treadmillio.velocityfilter import make_velocity_filter
+
+POSITION_RESOLUTION = np.pi * 20.2 / 4096 # cm per encoder step (default wheel)
+
+FILTERS = ['MovingAverage', 'Exponential', 'SavitzkyGolay', 'Kalman']
+
+
+def make_trajectory(n_samples=20000, seed=0):
+    """Encoder-quantized changes in position of a sinusoidal speed profile, with occasional 4 ms gaps."""
+    rng = np.random.default_rng(seed)
+    dt = np.full(n_samples, 0.002)
+    dt[rng.random(n_samples) < 0.01] = 0.004
+    t = np.cumsum(dt)
+    velocity = 30 * np.sin(2 * np.pi * 0.3 * t) + 10 * (rng.random() + 1)
+    encoder = np.floor(np.cumsum(velocity * dt) / POSITION_RESOLUTION)
+    changes = np.diff(encoder, prepend=0.0) * POSITION_RESOLUTION
+    return changes, dt, velocity
+
+
+class VelocityFilterUpdate:
+    params = FILTERS
+    param_names = ['velocity_filter']
+
+    def setup(self, velocity_filter):
+        self.filter = make_velocity_filter(velocity_filter, POSITION_RESOLUTION)
+        self.changes, self.dt, _ = make_trajectory(1000)
+        self.changes = self.changes.tolist()
+        self.dt = self.dt.tolist()
+        self.idx = 0
+
+    def time_update(self, velocity_filter):
+        self.idx = (self.idx + 1) % 1000
+        self.filter.update(self.changes[self.idx], self.dt[self.idx])
+
+
+class VelocityFilterUpdateMany:
+    params = (FILTERS, [5, 50, 500])
+    param_names = ['velocity_filter', 'n_samples']
+
+    def setup(self, velocity_filter, n_samples):
+        self.filter = make_velocity_filter(velocity_filter, POSITION_RESOLUTION)
+        self.changes, self.dt, _ = make_trajectory(n_samples)
+
+    def time_update_many(self, velocity_filter, n_samples):
+        self.filter.update_many(self.changes, self.dt)
+
+
+class VelocityFilterAccuracy:
+    """RMS error (cm/s) of each filter on a known speed profile (the accuracy side of accuracy vs. cost)."""
+    params = FILTERS
+    param_names = ['velocity_filter']
+    unit = 'cm/s'
+
+    def setup(self, velocity_filter):
+        self.changes, self.dt, self.velocity = make_trajectory()
+
+    def track_rms_error(self, velocity_filter):
+        estimate = make_velocity_filter(velocity_filter, POSITION_RESOLUTION).update_many(self.changes, self.dt)
+        settled = slice(1000, None) # skip the start up transient
+        return float(np.sqrt(np.mean((estimate[settled] - self.velocity[settled]) ** 2)))
@@ -0,0 +1,72 @@
+import numpy as np
+
+from treadmillio.serialinterface import SerialInterface
+from treadmillio.packetdecoder import PACKET_DTYPES
+
+TRACK_LENGTH = 200.0
+
+
+class FakeSerial():
+    """Serial port which serves the same block of synthetic packets over and over."""
+    def __init__(self, n_packets=5000, backlog=0):
+        packets = np.zeros(n_packets, dtype=PACKET_DTYPES[2])
+        packets['StartChar'] = b'F'
+        packets['StructSize'] = PACKET_DTYPES[2].itemsize
+        packets['MasterTime'] = np.arange(n_packets) * 2
+        packets['UnwrappedEncoder'] = np.cumsum(np.random.RandomState(0).randint(-2, 8, n_packets))
+        packets['GPIO'] = (np.arange(n_packets) // 50) % 2 << 2
+        self._data = packets.tobytes()
+        self._message_len = PACKET_DTYPES[2].itemsize
+        self._offset = 0
+        self.backlog = backlog
+
+    @property
+    def in_waiting(self):
+        return self.backlog * self._message_len
+
+    def readinto(self, b):
+        n = len(b)
+        if self._offset + n > len(self._data):
+            self._offset = 0
+        b[:] = self._data[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def read(self, n):
+        b = bytearray(n)
+        self.readinto(b)
+        return bytes(b)
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+GPIO_CONFIG = {'Lick': {'Number': 3, 'Type': 'Input'},
+               'Reward': {'Number': 4, 'Type': 'Output'}}
+
+MAZE_CONFIG = {'Length': TRACK_LENGTH, 'Topology': 'Ring'}
+
+
+def make_interface(backlog=0, catch_up=False, maze_config=MAZE_CONFIG):
+    """SerialInterface connected to a FakeSerial (skipping the hardware handshake)."""
+    interface = SerialInterface(gpio_config=GPIO_CONFIG, maze_config=maze_config, catch_up=catch_up)
+    interface.serial = FakeSerial(backlog=backlog)
+    interface.MessageLen = PACKET_DTYPES[2].itemsize
+    interface.startChar = b'F'
+    interface._packet_buffer = bytearray(interface.MessageLen)
+    interface._batch_buffer = bytearray(interface.MessageLen * 500)
+    interface.read_data() # initialize the encoder
+    return interface
+
+
+class NullPipe():
+    """Stand-in for the pipe to the ALSA process."""
+    def send_bytes(self, data):
+        pass
+
+
+def null_logger(row):
+    pass
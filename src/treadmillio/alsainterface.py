@@ -4,7 +4,6 @@
 
 import sys
 import scipy.io.wavfile
-import alsaaudio
 import numpy as np
 from itertools import cycle
 import os
@@ -19,6 +18,11 @@ import warnings
 import errno
 import signal
 
+try:
+    import alsaaudio
+except ImportError: # only needed to open sound devices (install the "sound" extra)
+    alsaaudio = None
+
 #from profilehooks import profile
 
 # Default parameters
@@ -210,6 +214,8 @@ class ALSAPlaybackSystem():
 
 
         # Open alsa device
+        if alsaaudio is None:
+            raise(ImportError('pyalsaaudio is required for sound playback (install treadmillio[sound]).'))
         self.adevice = alsaaudio.PCM(device=device)
         self.adevice.setchannels(num_channels) # We'll always present stereo audio
         self.adevice.setrate(self.fs)
@@ -235,14 +241,18 @@ class ALSAPlaybackSystem():
     def set_gain(self, stimulus, gain):
         self.stimuli[stimulus].gain = gain
 
+    def mix(self):
+        # Fill out_buf with the next period of all stimuli
+        for _, stim in self.stimuli.items():
+            stim.get_nextbuf()
+        self.out_buf[:] = self.data_buf.sum(axis=2).astype(dtype=self.out_buf.dtype, order='C')
+
     def play(self):
         print(time.time())
         with open(self.xrun_filename, 'w') as xrun_logfile:
             self.running = True
             while self.running:
-                for _, stim in self.stimuli.items():
-                    stim.get_nextbuf()
-                self.out_buf[:] = self.data_buf.sum(axis=2).astype(dtype=self.out_buf.dtype, order='C')
+                self.mix()
                 res = self.adevice.write(self.out_buf)
 
                 while (res == errno.EPIPE) :
@@ -288,6 +298,8 @@ class ALSARecordSystem():
         self.channels = config['NChannels']
 
         # Open alsa device
+        if alsaaudio is None:
+            raise(ImportError('pyalsaaudio is required for sound recording (install treadmillio[sound]).'))
         self.adevice = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL, device=device)
 
         self.adevice.setchannels(self.channels) # We'll always record stereo audio TODO: support many channels
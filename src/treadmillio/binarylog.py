@@ -0,0 +1,185 @@
+import json
+import struct
+import numpy as np
+
+# Binary log files are a short JSON header followed by fixed-size records.
+#
+#   bytes 0-7   : LOG_MAGIC
+#   bytes 8-11  : header length (uint32, little endian)
+#   header      : JSON dictionary (space padded so that records start on a
+#                 64 byte boundary). The 'dtype' key holds the numpy
+#                 description of a record. Other keys (e.g., 'Description',
+#                 'Version') are free-form information about the file.
+#   records     : packed numpy structured records, written in blocks.
+#
+# The number of records is not stored in the header - it is inferred from
+# the file size. That way a file from a session which crashed is still
+# readable up to the last block which was written.
+#
+# Logs written through a LogSink reserve space in the header for a record of
+# blocks which were dropped because the sink's backlog was full. If any were,
+# the header is rewritten when the log is closed with 'DroppedRecords' (the
+# total) and 'Gaps', a list of [index, count] pairs: `count` records are
+# missing before the record at `index`. (If there are too many gaps to fit,
+# only the first are kept and 'GapsTruncated' is set.)
+
+LOG_MAGIC = b'\x93TMIOLOG'
+HEADER_ALIGNMENT = 64
+GAP_HEADER_RESERVE = 4096 # header space reserved for the gaps of a log written through a LogSink
+
+DATALOG_DTYPE = np.dtype([('MasterTime', '<u4'),
+                          ('GPIO', '<u2'),
+                          ('Encoder', '<i2'),
+                          ('UnwrappedEncoder', '<i4'),
+                          ('Timestamp', '<f8'),
+                          ('Pos', '<f4'),
+                          ('Velocity', '<f4')])
+
+
+def write_log_header(f, dtype, reserve=0, length=None, **info):
+    """Write the header of a binary log file.
+
+    Args:
+        reserve: Extra padding (bytes), so the header can be rewritten with more information later.
+        length: Total length of the header (to rewrite an existing header in place).
+
+    Returns:
+        Total length of the header, i.e., the offset of the first record.
+
+    Raises:
+        ValueError: if the header doesn't fit in `length` bytes.
+    """
+    info['dtype'] = np.lib.format.dtype_to_descr(np.dtype(dtype))
+    header = json.dumps(info).encode('utf-8')
+    unpadded_length = len(LOG_MAGIC) + 4 + len(header) + 1
+    if length is None:
+        padding = reserve + (-(unpadded_length + reserve) % HEADER_ALIGNMENT)
+    else:
+        padding = length - unpadded_length
+        if padding < 0:
+            raise(ValueError('Log header is {} bytes longer than the space available.'.format(-padding)))
+    header = header + b' ' * padding + b'\n'
+    f.write(LOG_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    return len(LOG_MAGIC) + 4 + len(header)
+
+
+def read_log_header(f):
+    magic = f.read(len(LOG_MAGIC))
+    if magic != LOG_MAGIC:
+        raise(ValueError('Not a TreadmillIO binary log file (bad magic string {}).'.format(magic)))
+    header_length, = struct.unpack('<I', f.read(4))
+    info = json.loads(f.read(header_length).decode('utf-8'))
+    descr = info.pop('dtype')
+    if isinstance(descr, list): # JSON turns the tuples of a structured dtype into lists
+        descr = [tuple(field) for field in descr]
+    return info, np.lib.format.descr_to_dtype(descr)
+
+
+def load_log(filename):
+    """Load a binary log file.
+
+    Returns:
+        data: numpy structured array with one element per record
+        info: dictionary of header information (e.g. 'Version')
+    """
+    with open(filename, 'rb') as f:
+        info, dtype = read_log_header(f)
+        offset = f.tell()
+        f.seek(0, 2)
+        n_records = (f.tell() - offset) // dtype.itemsize # ignore any partially written record
+        f.seek(offset)
+        data = np.fromfile(f, dtype=dtype, count=n_records)
+    return data, info
+
+
+class BinaryLogWriter():
+    def __init__(self, filename, dtype, block_length=2500, sink=None, **info):
+        """Writes fixed-size records to a binary log file.
+
+        Records are stored in a preallocated structured array and written
+        to disk a block at a time, so that appending a record in the main
+        loop doesn't involve any formatting or file IO.
+
+        Args:
+            filename: Log file to create.
+            dtype: numpy structured dtype of a single record.
+            block_length: Number of records buffered before writing to disk.
+                          (2500 records is 5 s of data at 500 Hz.)
+            sink: Optional LogSink. If given, full blocks are handed to its
+                  writer thread rather than written from the calling thread.
+                  Blocks which the sink drops are recorded in the header.
+            info: Additional header entries (e.g. Description, Version).
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self._buffer = np.zeros(block_length, dtype=self.dtype)
+        self._block_length = block_length
+        self._idx = 0
+        self.records_written = 0
+        self.records_dropped = 0
+        self.gaps = [] # [index, count] of each run of dropped records
+
+        self._sink = sink
+        self._info = info
+        self._file = open(filename, 'wb')
+        if self._sink:
+            info['DroppedRecords'] = 0
+            self._header_length = write_log_header(self._file, self.dtype, reserve=GAP_HEADER_RESERVE, **info)
+            self._sink.add_file(self._file) # the sink closes the file after its last write
+        else:
+            self._header_length = write_log_header(self._file, self.dtype, **info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def writerow(self, row):
+        # Same signature as csv.writer().writerow so the two are interchangeable.
+        self._buffer[self._idx] = tuple(row)
+        self._idx += 1
+        if self._idx == self._block_length:
+            self.flush()
+
+    def flush(self):
+        if self._idx > 0:
+            if self._sink:
+                if not self._sink.submit(self._file.write, self._buffer[:self._idx].tobytes()):
+                    self._record_gap(self._idx)
+                    self._idx = 0
+                    return
+            else:
+                self._file.write(self._buffer[:self._idx].tobytes())
+            self.records_written += self._idx
+            self._idx = 0
+
+    def _record_gap(self, count):
+        self.records_dropped += count
+        if self.gaps and (self.gaps[-1][0] == self.records_written): # consecutive drops are one gap
+            self.gaps[-1][1] += count
+        else:
+            self.gaps.append([self.records_written, count])
+
+    def _write_gaps(self, dropped_records, gaps):
+        # Rewrite the header in place (on the writer thread, after the last block)
+        info = dict(self._info, DroppedRecords=dropped_records, Gaps=gaps)
+        while True:
+            self._file.seek(0)
+            try:
+                write_log_header(self._file, self.dtype, length=self._header_length, **info)
+                break
+            except ValueError: # (nothing is written unless the header fits)
+                info['Gaps'] = info['Gaps'][:len(info['Gaps']) // 2]
+                info['GapsTruncated'] = True
+        self._file.seek(0, 2)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            if not self._sink:
+                self._file.close()
+            elif self.records_dropped:
+                self._sink.submit(self._write_gaps, self.records_dropped, [list(gap) for gap in self.gaps], required=True)
@@ -7,6 +7,14 @@ import numpy as np
 import cv2
 
 
+def debayer_frame(img, mode, sx, sy):
+    """Convert a raw frame buffer to an image array (BGR for Bayer_RG8, a view for Mono8)."""
+    if mode == 'Mono8': # no need!
+        return np.frombuffer(img, np.uint8).reshape(sy, sx,1) # this is a cast!
+    elif mode == 'Bayer_RG8':
+        img_np = np.frombuffer(img, np.uint8).reshape(sy, sx) # this is a cast
+        return cv2.cvtColor(img_np, cv2.COLOR_BayerBG2BGR)
+
 def check_shm(shm_var):
     with shm_var.get_lock():
         value = shm_var.value
@@ -128,11 +136,8 @@ def start_camera(config, frame_queues, terminate_flag, done_flag):
                 self._stream.push_buffer (Aravis.Buffer.new_allocate (payload))
 
         def debayer(self, img):
-            if self.mode == 'Mono8': # no need!
-                self._rgb_img = np.frombuffer(img, np.uint8).reshape(self.sy, self.sx,1) # this is a cast!
-            elif self.mode == 'Bayer_RG8':
-                img_np = np.frombuffer(img, np.uint8).reshape(self.sy, self.sx) # this is a cast
-                self._rgb_img = cv2.cvtColor(img_np, cv2.COLOR_BayerBG2BGR)
+            if self.mode in ['Mono8', 'Bayer_RG8']:
+                self._rgb_img = debayer_frame(img, self.mode, self.sx, self.sy)
 
         def run(self):
             print ("Start acquisition")
@@ -11,6 +11,17 @@ import queue
 import csv
 import numpy as np
 
+def jpeg_encoder(mode, quality=85):
+    """Returns a function which JPEG-encodes a frame (as written by VideoWriter)."""
+    if mode == 'Mono8':
+        return lambda img: simplejpeg.encode_jpeg(img, quality=quality,
+                                colorspace='Gray', colorsubsampling='Gray')
+    elif mode == 'Bayer_RG8':
+        return lambda img: simplejpeg.encode_jpeg(img, quality=quality,
+                                colorspace='BGR', colorsubsampling='444')
+    else:
+        raise ValueError('Unsupported video mode.')
+
 def check_shm(shm_var):
     with shm_var.get_lock():
         value = shm_var.value
@@ -36,17 +47,9 @@ class VideoWriter():
         if config['Compress']:
             self._compressed = True
             video_filename = os.path.join(log_directory, '{}.mjeg'.format(filename_header))
+            encode = jpeg_encoder(mode, quality)
             self._writer = open(video_filename, 'wb')
-            if mode == 'Mono8':
-                self.write = lambda img: self._writer.write(
-                        simplejpeg.encode_jpeg(img, quality=quality,
-                            colorspace='Gray', colorsubsampling='Gray'))
-            elif mode == 'Bayer_RG8':
-                self.write = lambda img: self._writer.write(
-                        simplejpeg.encode_jpeg(img, quality=quality,
-                        colorspace='BGR', colorsubsampling='444'))
-            else:
-                raise ValueError('Unsupported video mode.')
+            self.write = lambda img: self._writer.write(encode(img))
 
             # self._writer = skvideo.io.FFmpegWriter(video_filename, outputdict={
             #     #'-vcodec': 'libx264', '-b': '300000000'
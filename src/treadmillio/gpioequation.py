@@ -0,0 +1,213 @@
+import re
+
+# Boolean equations of GPIO inputs, e.g. 'Lick AND NOT (Poke1 OR Poke2)', for GPIO state
+# transitions. Operators are NOT, AND, XOR and OR (in order of precedence) and parentheses.
+# Operands are GPIO labels, DIO pin numbers (e.g., '3') or AUX pins (e.g., 'AUX3').
+#
+# Equations are compiled (once, when the state machine is loaded) into a list of
+# (mask, value) terms over the GPIO word, with AuxGPIO in the upper 16 bits. The
+# equation is true if (word & mask) == value for any of the terms. The terms are the
+# prime implicants of the equation's truth table (Quine-McCluskey), so each tick
+# takes one or two integer comparisons for most equations.
+
+OPERATORS = ['NOT', 'AND', 'XOR', 'OR']
+AUX_SHIFT = 16 # bit of AUX pin 1 in the combined word
+MAX_PINS = 16 # pins per word
+MAX_VARIABLES = 12 # (the truth table has 2**n rows)
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|([A-Za-z0-9_]+))')
+
+
+def tokenize(equation):
+    tokens = []
+    position = 0
+    equation = equation.rstrip()
+    while position < len(equation):
+        match = _TOKEN.match(equation, position)
+        if not match:
+            raise(ValueError('GPIO equation "{}": unexpected character at "{}".'.format(
+                equation, equation[position:].strip())))
+        tokens.append(match.group(match.lastindex))
+        position = match.end()
+    return tokens
+
+
+class _Parser():
+    def __init__(self, equation):
+        self.equation = equation
+        self.tokens = tokenize(equation)
+        self.idx = 0
+
+    def _peek(self):
+        return self.tokens[self.idx].upper() if self.idx < len(self.tokens) else None
+
+    def _error(self, message):
+        raise(ValueError('GPIO equation "{}": {}.'.format(self.equation, message)))
+
+    def parse(self):
+        if not self.tokens:
+            self._error('empty equation')
+        tree = self._binary(len(OPERATORS) - 1)
+        if self.idx < len(self.tokens):
+            self._error('unexpected "{}"'.format(self.tokens[self.idx]))
+        return tree
+
+    def _binary(self, level):
+        # AND, XOR and OR are left associative, with AND binding most tightly
+        if level == 0:
+            return self._unary()
+        left = self._binary(level - 1)
+        while self._peek() == OPERATORS[level]:
+            self.idx += 1
+            left = (OPERATORS[level], left, self._binary(level - 1))
+        return left
+
+    def _unary(self):
+        token = self._peek()
+        if token is None:
+            self._error('unexpected end of equation')
+        if token == 'NOT':
+            self.idx += 1
+            return ('NOT', self._unary())
+        if token == '(':
+            self.idx += 1
+            tree = self._binary(len(OPERATORS) - 1)
+            if self._peek() != ')':
+                self._error('missing ")"')
+            self.idx += 1
+            return tree
+        if token in OPERATORS or token == ')':
+            self._error('unexpected "{}"'.format(self.tokens[self.idx]))
+        self.idx += 1
+        return ('PIN', self.tokens[self.idx - 1])
+
+
+def parse_equation(equation):
+    """Parse an equation into a tree of ('NOT', a), ('AND'|'XOR'|'OR', a, b) and ('PIN', operand) tuples."""
+    return _Parser(equation).parse()
+
+
+def _evaluate(tree, values):
+    op = tree[0]
+    if op == 'PIN':
+        return values[tree[1]]
+    if op == 'NOT':
+        return not _evaluate(tree[1], values)
+    a = _evaluate(tree[1], values)
+    b = _evaluate(tree[2], values)
+    if op == 'AND':
+        return a and b
+    if op == 'OR':
+        return a or b
+    return a != b # XOR
+
+
+def _operands(tree, operands):
+    if tree[0] == 'PIN':
+        if tree[1] not in operands:
+            operands.append(tree[1])
+    else:
+        for subtree in tree[1:]:
+            _operands(subtree, operands)
+    return operands
+
+
+def operand_bit(operand, gpio_config=None):
+    """Bit of an operand (GPIO label, DIO pin number or AUX pin) in the combined GPIO word."""
+    if gpio_config and operand in gpio_config:
+        pin, shift = gpio_config[operand]['Number'], 0
+    elif operand.isdigit():
+        pin, shift = int(operand), 0
+    elif operand.upper().startswith('AUX') and operand[3:].isdigit():
+        pin, shift = int(operand[3:]), AUX_SHIFT
+    else:
+        raise(ValueError('GPIO equation: unknown GPIO {}.'.format(operand)))
+    if not (0 < pin <= MAX_PINS):
+        raise(ValueError('GPIO equation: pin {} of {} is out of range.'.format(pin, operand)))
+    return shift + pin - 1 # as in SerialInterface.read_pin()
+
+
+def prime_implicants(minterms, n_variables):
+    """Prime implicants of a function of n variables, as (value, dont_care) bit masks."""
+    implicants = set((m, 0) for m in minterms)
+    primes = set()
+    while implicants:
+        merged = set()
+        used = set()
+        by_dont_care = {}
+        for value, dont_care in implicants:
+            by_dont_care.setdefault(dont_care, []).append(value)
+        for dont_care, values in by_dont_care.items():
+            value_set = set(values)
+            for value in values:
+                for bit in range(n_variables):
+                    flag = 1 << bit
+                    if (dont_care & flag) or (value & flag):
+                        continue
+                    if (value | flag) in value_set:
+                        merged.add((value, dont_care | flag))
+                        used.add((value, dont_care))
+                        used.add((value | flag, dont_care))
+        primes |= implicants - used
+        implicants = merged
+    return primes
+
+
+def select_cover(primes, minterms):
+    """Essential prime implicants, then greedily the ones which cover the most remaining minterms."""
+    covers = {prime: set(m for m in minterms if (m & ~prime[1]) == prime[0]) for prime in primes}
+    remaining = set(minterms)
+    cover = []
+    for m in minterms:
+        covering = [prime for prime in primes if m in covers[prime]]
+        if len(covering) == 1 and covering[0] not in cover:
+            cover.append(covering[0])
+            remaining -= covers[covering[0]]
+    while remaining:
+        best = max(sorted(primes), key=lambda prime: len(covers[prime] & remaining))
+        cover.append(best)
+        remaining -= covers[best]
+    return cover
+
+
+def compile_equation(equation, gpio_config=None):
+    """Compile an equation into (mask, value) terms over the combined GPIO word.
+
+    Args:
+        equation: Equation string.
+        gpio_config: GPIO section of the configuration (to look up labels).
+
+    Returns:
+        terms, gpio_mask, aux_mask: The terms (the equation is true if any term matches),
+                                    and the GPIO and AuxGPIO bits which the equation reads.
+    """
+    tree = parse_equation(equation)
+    operands = _operands(tree, [])
+    if len(operands) > MAX_VARIABLES:
+        raise(ValueError('GPIO equation "{}": at most {} different GPIOs are supported.'.format(
+            equation, MAX_VARIABLES)))
+    bits = [operand_bit(operand, gpio_config) for operand in operands]
+    if len(set(bits)) < len(bits):
+        raise(ValueError('GPIO equation "{}": the same pin appears under different names.'.format(equation)))
+
+    n = len(operands)
+    minterms = [row for row in range(2**n)
+                if _evaluate(tree, {operand: bool(row & (1 << i)) for i, operand in enumerate(operands)})]
+
+    terms = []
+    for value, dont_care in select_cover(prime_implicants(minterms, n), minterms):
+        word_mask = 0
+        word_value = 0
+        for i, bit in enumerate(bits):
+            if not dont_care & (1 << i):
+                word_mask |= 1 << bit
+                if value & (1 << i):
+                    word_value |= 1 << bit
+        terms.append((word_mask, word_value))
+
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    gpio_mask = mask & ((1 << AUX_SHIFT) - 1)
+    aux_mask = mask >> AUX_SHIFT
+    return terms, gpio_mask, aux_mask
@@ -0,0 +1,130 @@
+import numpy as np
+
+# Edges and debounced levels of the GPIO inputs, computed once per packet by SerialInterface
+# (rather than by each reward zone, state transition or logger which looks at an input).
+#
+# Each tick, one XOR of the new GPIO word with the previous one gives the rising and falling
+# edges of every pin. For each input, only the tick of its last edge is kept, so the number
+# of ticks it has been at its current level is a subtraction, and debouncing doesn't cost
+# anything per tick: an input whose raw level differs from its debounced level is pending
+# until it has held the new level for `Debounce` ticks (the input's GPIO option, default 1,
+# i.e., not debounced). Then its debounced level changes, which is an onset or offset event
+# (e.g., of a lick), handed to the subscribers with the MasterTime of the tick.
+#
+# The levels in the first packet (e.g., of pull-up inputs) are taken as they are, without
+# edges or events, and count as held from that packet on.
+
+INPUT_TYPES = ['Input', 'Input_Pullup', 'Input_Pulldown']
+
+INPUTLOG_DTYPE = np.dtype([('MasterTime', '<u4'),
+                           ('Input', '<u1'),
+                           ('Level', '<u1')])
+
+
+class GPIOInputs():
+    def __init__(self):
+        """Edges and debounced levels of the GPIO inputs (see SerialInterface.inputs)."""
+        self.tick = 0 # number of packets processed
+        self.MasterTime = 0
+        self.word = 0 # raw GPIO of the last packet
+        self.rising = 0 # pins which went high with the last packet
+        self.falling = 0 # pins which went low with the last packet
+        self.debounced = 0 # debounced levels of the inputs (a GPIO word)
+        self.onsets = 0 # inputs whose debounced level went high with the last packet
+        self.offsets = 0 # inputs whose debounced level went low with the last packet
+        self.mask = 0 # all of the inputs
+
+        self.names = [] # by input id
+        self._ids = {} # mask: input id
+        self._debounce = {} # mask: debounce length (ticks)
+        self._edge_tick = {} # mask: tick of the last edge
+        self._pending = [] # masks of the inputs whose raw and debounced levels differ
+        self._subscribers = []
+
+    def add_input(self, name, pin, debounce=1):
+        """Track an input. Adding a pin again keeps its first name and the longest debounce.
+
+        Args:
+            name: GPIO label.
+            pin: GPIO number (pin N is bit N-1 of the GPIO word).
+            debounce: Number of ticks the input has to hold a level for its debounced level to change.
+
+        Returns:
+            The mask of the input.
+        """
+        if debounce < 1:
+            raise(ValueError('GPIO {}: Debounce must be at least 1 tick.'.format(name)))
+        mask = 0x01 << (pin - 1)
+        if mask in self._ids:
+            self._debounce[mask] = max(self._debounce[mask], debounce)
+        else:
+            self._ids[mask] = len(self.names)
+            self.names.append(name)
+            self._debounce[mask] = debounce
+            self._edge_tick[mask] = 0
+            self.mask |= mask
+        return mask
+
+    def subscribe(self, callback):
+        """Call `callback((MasterTime, input_id, level))` on each debounced onset (level 1) or offset (level 0).
+
+        The event tuple is a row of the input log (INPUTLOG_DTYPE), so a log writer's writerow can subscribe.
+        """
+        self._subscribers.append(callback)
+
+    def start(self, master_time, gpio):
+        """Take the levels of the inputs from the first packet (without edges or events)."""
+        self.tick = 1
+        self.MasterTime = master_time
+        self.word = gpio
+        self.rising = self.falling = 0
+        self.debounced = gpio & self.mask
+        self.onsets = self.offsets = 0
+        for mask in self._ids:
+            self._edge_tick[mask] = 1
+        self._pending = []
+
+    def update(self, master_time, gpio):
+        """Process the GPIO word of a packet."""
+        self.tick += 1
+        self.MasterTime = master_time
+        changed = gpio ^ self.word
+        self.rising = changed & gpio
+        self.falling = changed & self.word
+        self.word = gpio
+        self.onsets = self.offsets = 0
+        changed &= self.mask
+        if changed:
+            for mask in self._ids:
+                if changed & mask:
+                    self._edge_tick[mask] = self.tick
+                    if mask not in self._pending:
+                        self._pending.append(mask)
+        if self._pending:
+            self._debounce_pending()
+
+    def _debounce_pending(self):
+        for mask in list(self._pending):
+            level = self.word & mask
+            if level == (self.debounced & mask): # bounced back
+                self._pending.remove(mask)
+            elif self.tick - self._edge_tick[mask] + 1 >= self._debounce[mask]:
+                self._pending.remove(mask)
+                self.debounced ^= mask
+                if level:
+                    self.onsets |= mask
+                else:
+                    self.offsets |= mask
+                event = (self.MasterTime, self._ids[mask], 1 if level else 0)
+                for callback in self._subscribers:
+                    callback(event)
+
+    def ticks_high(self, mask):
+        """Number of consecutive ticks, up to the last one, during which the input was high (0 if it's low)."""
+        if self.word & mask:
+            return self.tick - self._edge_tick[mask] + 1
+        return 0
+
+    def log_info(self):
+        """Header information of the input log: the names of the inputs (by Input id)."""
+        return {'Inputs': list(self.names)}
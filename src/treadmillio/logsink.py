@@ -0,0 +1,154 @@
+import os
+import csv
+import time
+import warnings
+import threading
+from collections import deque
+
+
+class LogSink():
+    def __init__(self, flush_interval=1000, fsync=False, max_backlog=10000, poll_interval=20):
+        """Writes log data to disk from a separate thread.
+
+        The main loop hands write requests to the sink through a deque
+        (appends and pops on a deque are atomic, so neither side ever waits
+        on a lock). The writer thread drains the queue every `poll_interval`,
+        so a slow disk or an fsync stall only delays the writer thread.
+
+        Args:
+            flush_interval: Interval (ms) at which open log files are flushed.
+            fsync: If True, also fsync log files whenever they are flushed.
+            max_backlog: Maximum number of pending write requests. Above it, a
+                         backlog alarm is raised and new requests are dropped
+                         (and counted in `dropped_writes`) until the writer catches up.
+            poll_interval: Interval (ms) at which the writer thread checks for
+                           new write requests.
+        """
+        self.flush_interval = flush_interval / 1000
+        self.fsync = fsync
+        self.max_backlog = max_backlog
+        self.poll_interval = poll_interval / 1000
+
+        self.backlog_alarms = 0 # number of times the backlog went over max_backlog
+        self.max_backlog_seen = 0
+        self.dropped_writes = 0 # write requests dropped because the backlog was full
+        self.in_backlog_alarm = False
+        self._error = None # exception raised on the writer thread (passed on to submit())
+        self._error_raised = False
+
+        self._queue = deque()
+        self._files = []
+        self._running = True
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='LogSink', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def submit(self, function, *args, required=False):
+        """Queue `function(*args)` to be run on the writer thread.
+
+        Args:
+            required: Queue the request even if the backlog is full (for the
+                      final writes made when a log is closed).
+
+        Returns:
+            False if the request was dropped because the backlog was full.
+
+        Raises:
+            RuntimeError: if a write failed on the writer thread (e.g., the disk is full).
+        """
+        if self._error is not None:
+            self._error_raised = True
+            raise(RuntimeError('LogSink: writing a log file failed.')) from self._error
+        backlog = len(self._queue)
+        if (backlog >= self.max_backlog) and not required:
+            self.dropped_writes += 1
+            if not self.in_backlog_alarm:
+                self.in_backlog_alarm = True
+                self.backlog_alarms += 1
+                warnings.warn('LogSink: {} pending log writes, dropping new ones. Is the disk keeping up?'.format(backlog),
+                              RuntimeWarning)
+            return False
+        self._queue.append((function, args))
+        backlog += 1
+        if backlog > self.max_backlog_seen:
+            self.max_backlog_seen = backlog
+        if self.in_backlog_alarm and (backlog < self.max_backlog // 2): # (hysteresis, so the alarm doesn't flicker)
+            self.in_backlog_alarm = False
+        return True
+
+    def add_file(self, f):
+        """Register a file object to be flushed (and closed) by the sink."""
+        self._files.append(f)
+        return f
+
+    def open(self, filename, mode='w', **kwargs):
+        return self.add_file(open(filename, mode, **kwargs))
+
+    def open_csv(self, filename, header=None):
+        """Open a CSV log file and return a writer whose writerow() queues rows for the sink."""
+        f = self.open(filename, 'w', newline='')
+        if header:
+            print(header, file=f)
+        return SinkCSVWriter(self, csv.writer(f))
+
+    @property
+    def backlog(self):
+        return len(self._queue)
+
+    def _drain(self):
+        while self._queue:
+            function, args = self._queue.popleft()
+            function(*args)
+
+    def _flush_files(self):
+        for f in self._files:
+            if not f.closed:
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    def _run(self):
+        last_flush = time.monotonic()
+        try:
+            while self._running:
+                self._stop_event.wait(self.poll_interval)
+                self._drain()
+                now = time.monotonic()
+                if (now - last_flush) > self.flush_interval:
+                    self._flush_files()
+                    last_flush = now
+        except Exception as e: # passed on to the task loop by submit()
+            self._error = e
+
+    def close(self):
+        if self._running:
+            self._running = False
+            self._stop_event.set()
+            self._thread.join()
+            try:
+                if self._error is None:
+                    self._drain() # anything submitted after the last pass of the writer thread
+                    self._flush_files()
+            finally:
+                for f in self._files:
+                    f.close()
+            if self.backlog_alarms:
+                print('LogSink: backlog reached {} writes {} times ({} writes dropped).'.format(
+                    self.max_backlog, self.backlog_alarms, self.dropped_writes))
+            if (self._error is not None) and not self._error_raised:
+                raise(RuntimeError('LogSink: writing a log file failed.')) from self._error
+
+
+class SinkCSVWriter():
+    def __init__(self, sink, writer):
+        self._sink = sink
+        self._writer = writer
+
+    def writerow(self, row):
+        self._sink.submit(self._writer.writerow, row)
@@ -0,0 +1,114 @@
+import numpy as np
+
+# Packet formats streamed by the IO module firmware (see Hardware/Firmware/Firmware.h).
+#   Version 1: '<cBLhlBx'   (14 bytes)
+#   Version 2: '<cBLhlHHx'  (17 bytes)
+PACKET_DTYPES = {
+    1: np.dtype([('StartChar', 'S1'),
+                 ('StructSize', 'u1'),
+                 ('MasterTime', '<u4'),
+                 ('Encoder', '<i2'),
+                 ('UnwrappedEncoder', '<i4'),
+                 ('GPIO', 'u1'),
+                 ('EndChar', 'S1')]),
+    2: np.dtype([('StartChar', 'S1'),
+                 ('StructSize', 'u1'),
+                 ('MasterTime', '<u4'),
+                 ('Encoder', '<i2'),
+                 ('UnwrappedEncoder', '<i4'),
+                 ('GPIO', '<u2'),
+                 ('AuxGPIO', '<u2'),
+                 ('EndChar', 'S1')]),
+}
+
+START_CHARS = {1: b'E', 2: b'F'}
+
+
+def decode_packets(buffer, version=2, validate=True):
+    """View a buffer holding whole packets as a structured array (no copy).
+
+    Args:
+        buffer: bytes, bytearray or memoryview. Its length must be a multiple
+                of the packet length.
+        version: Protocol version of the packets.
+        validate: If True, check the start character of every packet.
+    """
+    packets = np.frombuffer(buffer, dtype=PACKET_DTYPES[version])
+    if validate:
+        bad = packets['StartChar'] != START_CHARS[version]
+        if bad.any():
+            raise(ValueError('Bad start character in packet {} of {}.'.format(np.flatnonzero(bad)[0], len(packets))))
+    return packets
+
+
+def find_packet_offset(data, version=2, n_check=3, start=0):
+    """Find the offset of the first packet boundary in a stream of bytes.
+
+    A boundary is an offset at which the start character appears in
+    `n_check` consecutive packets. Returns None if none is found.
+    """
+    packet_length = PACKET_DTYPES[version].itemsize
+    start_char = START_CHARS[version][0]
+    raw = np.frombuffer(data, dtype=np.uint8)
+    for offset in range(start, len(raw) - n_check * packet_length + 1):
+        if np.all(raw[offset:offset + n_check * packet_length:packet_length] == start_char):
+            return offset
+    return None
+
+
+def decode_capture(data, version=2):
+    """Decode a raw capture of the serial stream (e.g., `cat /dev/ttyACM0 > capture.bin`).
+
+    Bytes before the first packet boundary are skipped. If corrupted
+    packets are found, the stream is resynchronized after them.
+
+    Args:
+        data: bytes of the capture, or the name of a capture file.
+        version: Protocol version of the packets.
+
+    Returns:
+        Structured array of packets (see PACKET_DTYPES).
+    """
+    if isinstance(data, str):
+        with open(data, 'rb') as f:
+            data = f.read()
+    packet_length = PACKET_DTYPES[version].itemsize
+
+    segments = []
+    offset = find_packet_offset(data, version)
+    while offset is not None:
+        n_packets = (len(data) - offset) // packet_length
+        packets = decode_packets(data[offset:offset + n_packets * packet_length], version, validate=False)
+        bad = np.flatnonzero(packets['StartChar'] != START_CHARS[version])
+        if len(bad) == 0:
+            segments.append(packets)
+            break
+        segments.append(packets[:bad[0]])
+        offset = find_packet_offset(data, version, start=offset + bad[0] * packet_length)
+
+    if segments:
+        return np.concatenate(segments)
+    else:
+        return np.zeros(0, dtype=PACKET_DTYPES[version])
+
+
+def encoder_changes(unwrapped_encoder, previous_unwrapped_encoder=None):
+    """Change in (unwrapped) encoder value for each packet."""
+    unwrapped_encoder = np.asarray(unwrapped_encoder, dtype=np.int64)
+    if previous_unwrapped_encoder is None:
+        previous_unwrapped_encoder = unwrapped_encoder[0]
+    return np.diff(unwrapped_encoder, prepend=previous_unwrapped_encoder)
+
+
+def integrate_position(unwrapped_encoder, diameter_constant, previous_unwrapped_encoder=None, initial_position=0.0):
+    """Unwrapped position (e.g., cm) at each packet from the unwrapped encoder values.
+
+    Args:
+        unwrapped_encoder: UnwrappedEncoder field of a set of packets.
+        diameter_constant: Distance per encoder tick (pi * WheelDiameter / EncoderGain).
+        previous_unwrapped_encoder: Encoder value preceding the first packet. If None,
+                                    the first packet is the starting point.
+        initial_position: Position preceding the first packet.
+    """
+    changes = encoder_changes(unwrapped_encoder, previous_unwrapped_encoder) * diameter_constant
+    return initial_position + np.cumsum(changes)
@@ -0,0 +1,82 @@
+import hashlib
+import numpy as np
+
+# Random number streams for the components of a task (delays, visual stimuli, random
+# transitions, reward zones, patches, ...). Each component draws from its own
+# np.random.Generator, derived from the session's RandomSeed and a stable hash of the
+# component's name (e.g., 'StateMachine/Intertrial'). A component's stream therefore
+# doesn't depend on which other components a configuration has, or on the order in
+# which they are created or draw numbers.
+#
+# Use seed() once at startup (before the components are created), then generator(name)
+# or BatchedDraws(generator(name), draw) in each component.
+
+BATCH_SIZE = 1000
+
+
+class RandomStreams():
+    def __init__(self, seed=None):
+        """Random streams derived from one seed.
+
+        Args:
+            seed: Integer seed (e.g., the RandomSeed preference). If None, fresh entropy
+                  is used (and kept in `seed`, so that it can be logged).
+        """
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy
+
+    def generator(self, name):
+        """Generator of the component called `name` (the same name always gives the same stream)."""
+        digest = hashlib.sha256(name.encode('utf-8')).digest()
+        spawn_key = tuple(int.from_bytes(digest[i:i+4], 'little') for i in range(0, 16, 4))
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(self.seed, spawn_key=spawn_key)))
+
+
+class BatchedDraws():
+    def __init__(self, generator, draw, batch_size=BATCH_SIZE):
+        """Iterator over random values which are drawn `batch_size` at a time.
+
+        Args:
+            generator: np.random.Generator to draw from.
+            draw: Function of (generator, size) which returns `size` values (array or list).
+            batch_size: Number of values drawn at once. A new batch is drawn when these are used up.
+        """
+        self.generator = generator
+        self.draw = draw
+        self.batch_size = batch_size
+        self._values = []
+        self._idx = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._idx >= len(self._values):
+            values = self.draw(self.generator, self.batch_size)
+            self._values = values.tolist() if isinstance(values, np.ndarray) else list(values)
+            self._idx = 0
+        value = self._values[self._idx]
+        self._idx += 1
+        return value
+
+
+_streams = None
+
+
+def seed(value=None):
+    """Set the seed of the session's streams (fresh entropy if None). Returns the seed used."""
+    global _streams
+    _streams = RandomStreams(value)
+    return _streams.seed
+
+
+def generator(name):
+    """Generator of the component called `name` (streams are seeded with fresh entropy if seed() wasn't called)."""
+    if _streams is None:
+        seed()
+    return _streams.generator(name)
+
+
+def batched(name, draw, batch_size=BATCH_SIZE):
+    """BatchedDraws from the stream of the component called `name`."""
+    return BatchedDraws(generator(name), draw, batch_size)
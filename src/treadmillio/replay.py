@@ -0,0 +1,314 @@
+import os
+import numpy as np
+
+from treadmillio.serialinterface import SerialInterface
+from treadmillio.packetdecoder import PACKET_DTYPES, START_CHARS
+from treadmillio import randomstreams
+
+
+def load_datalog(filename):
+    """Load a DataLog (csv or binary) as a structured array with MasterTime, GPIO,
+    Encoder and UnwrappedEncoder fields (and Pos, if it was logged).
+
+    The first row of a DataLog is the synchronization row written before the
+    first sample. It is returned as is.
+    """
+    if os.path.splitext(filename)[1] == '.bin':
+        from treadmillio.binarylog import load_log
+        data, info = load_log(filename)
+        return data
+
+    raw = np.genfromtxt(filename, delimiter=',', skip_header=2, ndmin=2)
+    fields = [('MasterTime', '<u4'), ('GPIO', '<u2'), ('Encoder', '<i2'), ('UnwrappedEncoder', '<i4'), ('Timestamp', '<f8')]
+    if raw.shape[1] >= 7: # older versions didn't log position and velocity
+        fields += [('Pos', '<f4'), ('Velocity', '<f4')]
+    data = np.zeros(raw.shape[0], dtype=fields)
+    for idx, (name, _) in enumerate(fields):
+        data[name] = raw[:, idx]
+    return data
+
+
+class NullSerial():
+    """Stand-in for the serial port. Commands to the IO module are dropped."""
+    in_waiting = 0
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class ReplayInterface(SerialInterface):
+    def __init__(self, datalog, gpio_config=None, maze_config=None):
+        """SerialInterface which replays the data of a recorded session.
+
+        The recorded packets are re-encoded and decoded by the same code as
+        live data, so position and velocity are recomputed rather than read
+        from the log. Outputs (e.g., reward pulses) are tracked but not sent
+        anywhere.
+
+        Args:
+            datalog: DataLog.csv or DataLog.bin of the recorded session.
+            gpio_config: GPIO section of the session configuration.
+            maze_config: Maze section of the session configuration.
+        """
+        SerialInterface.__init__(self, SerialPort=datalog, version=2, gpio_config=gpio_config, maze_config=maze_config)
+        self.datalog = datalog
+        data = load_datalog(datalog)
+        if len(data) < 2:
+            raise(ValueError('DataLog {} has no samples to replay.'.format(datalog)))
+
+        # The packet read when the session started isn't logged - only its GPIO and Encoder
+        # values are, in the synchronization row. Reconstruct it.
+        sync_row, data = data[0], data[1:]
+        packets = np.zeros(len(data) + 1, dtype=PACKET_DTYPES[self.version])
+        packets['StartChar'] = START_CHARS[self.version]
+        packets['StructSize'] = PACKET_DTYPES[self.version].itemsize
+        for name in ['MasterTime', 'GPIO', 'Encoder', 'UnwrappedEncoder']:
+            packets[name][1:] = data[name]
+        packets['MasterTime'][0] = data['MasterTime'][0] - 2
+        packets['GPIO'][0] = sync_row['GPIO']
+        packets['Encoder'][0] = sync_row['Encoder']
+        packets['UnwrappedEncoder'][0] = self._initial_encoder(data[0])
+        self._packets = packets.tobytes()
+        self.n_packets = len(packets)
+        self._offset = 0
+
+    def _initial_encoder(self, first_sample):
+        # Position is integrated from the first packet, so pick the encoder value
+        # which reproduces the first logged position.
+        if (not self.calculate_position) or ('Pos' not in first_sample.dtype.names):
+            return first_sample['UnwrappedEncoder']
+        change_in_position = float(first_sample['Pos'])
+        if change_in_position > self.virtual_track_length / 2: # moved backwards across 0
+            change_in_position -= self.virtual_track_length
+        return first_sample['UnwrappedEncoder'] - int(round(change_in_position / self.diameter_constant))
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def connect(self):
+        self.MessageLen = PACKET_DTYPES[self.version].itemsize
+        self.startChar = START_CHARS[self.version]
+        self.serial = NullSerial()
+        self._offset = 0
+
+    @property
+    def packets_remaining(self):
+        return (len(self._packets) - self._offset) // self.MessageLen
+
+    def read_data(self):
+        if self._offset >= len(self._packets):
+            raise(EOFError('End of replayed session {}.'.format(self.datalog)))
+        StartChar, StructSize = self._process_packet(self._packets, self._offset)
+        self._offset += self.MessageLen
+        return StartChar, StructSize, self.MasterTime, self.Encoder, self.unwrapped_encoder, self.GPIO, self.AuxGPIO
+
+
+class NullSound():
+    """Stand-in for a sound stimulus. Keeps track of gain changes but doesn't play anything."""
+    def __init__(self, name, params):
+        self.name = name
+        self.baseline_gain = params.get('BaselineGain', 0.0)
+        self.off_gain = params.get('OffGain', -90.0)
+        self.gain = self.off_gain
+        self.filename = params.get('Filename', '')
+        self.duration = params.get('Duration', 0)
+        self.index = 0
+        self.is_playing = False
+        self.time_beep_off = -1
+
+    def change_gain(self, gain):
+        self.gain = gain
+
+    def change_gain_raw(self, gain):
+        self.gain = gain
+
+    def choose_sound(self, index):
+        self.index = index
+
+    def play(self, now):
+        self.time_beep_off = now + self.duration
+        self.is_playing = True
+
+    def update(self, time):
+        if self.is_playing and (time > self.time_beep_off):
+            self.is_playing = False
+
+
+class NullSoundController():
+    def __init__(self, sound_config):
+        """Stand-in for SoundStimulusController, built from the same AuditoryStimuli configuration.
+
+        Has the same stimulus dictionaries (so that states and reward zones which
+        refer to sounds can be created), but no audio devices.
+        """
+        self.BackgroundSounds = {}
+        self.Beeps = {}
+        self.LocalizedStimuli = {}
+        self.BundledSounds = {}
+        self._Stimuli = {}
+
+        defaults = sound_config.get('Defaults', {})
+        for stimulus_name, stimulus in sound_config.get('StimuliList', {}).items():
+            params = dict(defaults)
+            params.update(stimulus)
+            sound = NullSound(stimulus_name, params)
+            if params['Type'] == 'Background':
+                sound.change_gain(sound.baseline_gain)
+                self.BackgroundSounds[stimulus_name] = sound
+            elif params['Type'] == 'Beep':
+                self.Beeps[stimulus_name] = sound
+            elif params['Type'] in ['Localized', 'MultilapBackground']:
+                self.LocalizedStimuli[stimulus_name] = sound
+            elif params['Type'] == 'Bundle':
+                sound.change_gain(sound.baseline_gain)
+                self.BundledSounds[stimulus_name] = sound
+            else:
+                raise ValueError('Unknown stimulus type \'{}\'.'.format(params['Type']))
+            self._Stimuli[stimulus_name] = sound
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def get_stimulus(self, stimulus_name):
+        return self._Stimuli[stimulus_name]
+
+    def start_capture(self):
+        pass
+
+    def stop_capture(self):
+        pass
+
+    def update_beeps(self, time):
+        for _, beep in self.Beeps.items():
+            beep.update(time)
+
+    def update_localized(self, pos, unwrapped_pos):
+        pass
+
+
+class NullSocket():
+    """Stand-in for the ZMQ socket of Visualization states."""
+    def send_string(self, command):
+        pass
+
+    def close(self):
+        pass
+
+
+def disable_viewers(config):
+    """Remove the Viewer options from a session configuration (in place)."""
+    if 'StateMachine' in config:
+        config['StateMachine']['Viewer'] = False
+        regions = config['StateMachine'].get('Regions', {'Main': config['StateMachine']})
+        for region in regions.values():
+            for state in region.get('States', {}).values():
+                state['Viewer'] = False
+    if 'AuditoryStimuli' in config:
+        config['AuditoryStimuli']['Viewer'] = False
+    return config
+
+
+class SessionReplay():
+    def __init__(self, config, datalog, random_seed=None):
+        """Replays a recorded session through the task logic as fast as possible.
+
+        Args:
+            config: Parsed configuration of the session (ParsedConfig.yaml).
+            datalog: DataLog.csv or DataLog.bin of the session.
+            random_seed: Seed of the random streams (see randomstreams). Defaults to
+                         the RandomSeed preference of the session, which is needed
+                         to reproduce random transitions, delays, etc.
+        """
+        config = disable_viewers(config)
+        preferences = config.get('Preferences', {}) or {}
+
+        if random_seed is None:
+            random_seed = preferences.get('RandomSeed', None)
+        if random_seed is not None:
+            np.random.seed(int(random_seed) % 2**32)
+        randomstreams.seed(None if random_seed is None else int(random_seed))
+
+        self.Interface = ReplayInterface(datalog, gpio_config=config.get('GPIO', None),
+                                         maze_config=config.get('Maze', None))
+
+        if ('AuditoryStimuli' in config) and preferences.get('EnableSound', False):
+            self.SoundController = NullSoundController(config['AuditoryStimuli'])
+        else:
+            self.SoundController = None
+
+        if 'StateMachine' in config:
+            from treadmillio.taskstatemachine import TaskStateMachine
+            self.StateMachine = TaskStateMachine(config['StateMachine'], self.Interface, self.SoundController)
+            self.StateMachine.socket = NullSocket()
+        else:
+            self.StateMachine = None
+
+        if 'RewardZones' in config:
+            from treadmillio.rewardzone import RewardZoneController
+            self.RewardZones = RewardZoneController(config['RewardZones'], self.Interface, self.SoundController)
+        else:
+            self.RewardZones = None
+
+        self.ticks = 0
+
+    def run(self, state_logger=None, reward_zone_logger=None, timer=None, max_ticks=None):
+        """Run the main loop of run_treadmillio over the recorded data.
+
+        Args:
+            state_logger: Logger (e.g., BinaryLogWriter writerow) for state machine events.
+            reward_zone_logger: Logger for reward zone events.
+            timer: Optional TickTimer with the stages of the replayed loop.
+            max_ticks: Stop after this many ticks (default: the whole session).
+
+        Returns:
+            Number of ticks replayed.
+        """
+        Interface, SoundController, StateMachine, RewardZones = \
+            self.Interface, self.SoundController, self.StateMachine, self.RewardZones
+
+        Interface.connect()
+        FlagChar, StructSize, MasterTime, InitialEncoder, InitialUnwrappedEncoder, InitialGPIO, AuxGPIO = Interface.read_data()
+        if StateMachine:
+            StateMachine.start(MasterTime)
+
+        n_ticks = Interface.packets_remaining
+        if max_ticks is not None:
+            n_ticks = min(n_ticks, max_ticks)
+
+        # Keep in step with the main loop of tools/run_treadmillio.py
+        for _ in range(n_ticks):
+            FlagChar, StructSize, MasterTime, Encoder, UnwrappedEncoder, GPIO, AuxGPIO = Interface.read_data()
+            if timer: timer.lap('read_data')
+
+            Interface.update_pulses()
+            if timer: timer.lap('update_pulses')
+
+            if SoundController:
+                SoundController.update_beeps(MasterTime)
+            if timer: timer.lap('update_beeps')
+
+            if StateMachine:
+                StateMachine.update_statemachine(state_logger)
+            if timer: timer.lap('update_statemachine')
+
+            if SoundController:
+                SoundController.update_localized(Interface.pos, Interface.unwrapped_pos)
+            if timer: timer.lap('update_localized')
+
+            if RewardZones:
+                RewardZones.update_reward_zones(MasterTime, Interface.pos, GPIO, reward_zone_logger)
+            if timer: timer.lap('update_reward_zones')
+
+            Interface.flush_commands()
+            if timer: timer.lap('flush_commands')
+
+            if timer: timer.end_tick(MasterTime)
+            self.ticks += 1
+
+        return n_ticks
@@ -1,7 +1,20 @@
 import time
+from bisect import bisect_left
 from typing import Tuple, Union
 import numpy as np
 
+from . import randomstreams
+
+# Reward zones are intervals of track position (RewardZoneStart to RewardZoneEnd, both
+# included); an interval whose start isn't below its end wraps around the ring. Rather
+# than testing every zone every tick, the controller compiles the zones into a ZoneIndex:
+# the sorted bounds of all the reward and reset intervals cut the track into pieces (the
+# bounds themselves and the open intervals between them), and each piece has the zones
+# which reward and which reset there. The piece of the previous tick is checked first,
+# so finding the current one is usually a single comparison. Zones are only called while
+# the animal is in their reward zone (rewards depend on time and licks), and once when it
+# enters their reset zone (resetting is idempotent).
+
 def inside(zone: Tuple[int,int], pos: int) -> bool:
     if (zone[1] > zone[0]): # take into account the fact that the track is circular
         return (pos >= zone[0]) and (pos <= zone[1])
@@ -9,13 +22,74 @@ def inside(zone: Tuple[int,int], pos: int) -> bool:
         return (pos <= zone[1]) or (pos >= zone[0])
 
 
-    raise(NotImplementedError("Reward types other than classical are not yet implemented"))
+class ZoneIndex():
+    def __init__(self, zones):
+        """Interval index of the reward and reset zones.
+
+        Args:
+            zones: List of reward zones (with active_zone and reset_zone intervals), in update order.
+        """
+        bounds = set()
+        for zone in zones:
+            for interval in (zone.active_zone, zone.reset_zone):
+                if interval:
+                    bounds.update(interval)
+        self.bounds = sorted(bounds)
+
+        # Piece 2*i is the open interval below bounds[i] (2*len(bounds) is above the last
+        # bound), and piece 2*i+1 is bounds[i] itself. Zones are constant over each piece,
+        # so they are found by testing one position in it.
+        self.limits = []
+        self.rewarding = []
+        self.resetting = []
+        for piece in range(2 * len(self.bounds) + 1):
+            lo, hi = self._limits(piece)
+            if piece % 2:
+                pos = lo
+            elif not self.bounds:
+                pos = 0
+            elif piece == 0:
+                pos = hi - 1
+            elif piece == 2 * len(self.bounds):
+                pos = lo + 1
+            else:
+                pos = (lo + hi) / 2
+            self.limits.append((lo, hi))
+            self.rewarding.append(tuple(zone for zone in zones if inside(zone.active_zone, pos)))
+            self.resetting.append(tuple(zone for zone in zones if zone.reset_zone and
+                                        not inside(zone.active_zone, pos) and inside(zone.reset_zone, pos)))
+
+    def _limits(self, piece):
+        idx = piece // 2
+        if piece % 2:
+            return self.bounds[idx], self.bounds[idx]
+        lo = self.bounds[idx-1] if idx > 0 else -np.inf
+        hi = self.bounds[idx] if idx < len(self.bounds) else np.inf
+        return lo, hi
+
+    def locate(self, pos, piece=None):
+        """Piece of the track which contains `pos`.
+
+        Args:
+            pos: Track position.
+            piece: Piece of the previous position (checked first), or None.
+        """
+        if piece is not None:
+            lo, hi = self.limits[piece]
+            if (pos == lo) if (piece % 2) else (lo < pos < hi):
+                return piece
+        idx = bisect_left(self.bounds, pos)
+        if (idx < len(self.bounds)) and (self.bounds[idx] == pos):
+            return 2 * idx + 1
+        return 2 * idx
+
 
 class RewardZoneController():
     def __init__(self, params, gpio_interface, sound_controller=None):
         self.Zones = {}
 
         for reward_name, reward in params['RewardZoneList'].items():
+            reward['Name'] = reward_name
             if reward['Type'] not in ['Classical','Operant']:
                 raise(NotImplementedError("Reward types other than classical or operant are not yet implemented"))
 
@@ -27,12 +101,24 @@ class RewardZoneController():
             elif (reward['Type'] == 'Operant'):
                 self.Zones[reward_name] = OperantRewardZone(reward, gpio_interface, sound_controller)
 
+        self._index = ZoneIndex(list(self.Zones.values()))
+        self._piece = None
+
+        self.rewards = 0 # number of rewards delivered by all zones
+        for zone in self.Zones.values():
+            zone.controller = self
+
     def update_reward_zones(self, time, pos, gpio, logger=None):
-        for _, reward in self.Zones.items():
-            if reward.Type == 'Classical':
-                reward.update(time, pos, logger)
-            elif reward.Type == 'Operant':
-                reward.update(time, pos, gpio, logger)
+        piece = self._index.locate(pos, self._piece)
+        if piece != self._piece:
+            previous = self._index.resetting[self._piece] if self._piece is not None else ()
+            for reward in self._index.resetting[piece]:
+                if reward not in previous:
+                    reward.reset()
+            self._piece = piece
+
+        for reward in self._index.rewarding[piece]:
+            reward.update_inside(time, pos, gpio, logger)
 
 
 class ClassicalRewardZone():
@@ -59,6 +145,7 @@ class ClassicalRewardZone():
            (not ('ResetZoneStart' in params) and ('ResetZoneEnd' in params)):
            raise(ValueError("Both 'ResetZoneStart' and 'ResetZoneEnd' must be specified."))
          
+        self.reset_zone = None
         if ('ResetZoneStart' in params) and ('ResetZoneEnd' in params):
             self.reset_zone = (params['ResetZoneStart'], params['ResetZoneEnd'])
         
@@ -68,6 +155,7 @@ class ClassicalRewardZone():
         self.pulse_length = params['PumpRunTime']
 
         self.current_reward_number = 0
+        self.controller = None # RewardZoneController which counts the rewards (set by the controller)
         self.last_reward_time = 0
         self.active = True
         self.random_active = True
@@ -75,24 +163,32 @@ class ClassicalRewardZone():
 
     def update(self, time, pos, gpio, logger=None):
         if inside(self.active_zone, pos):
-            if time > (self.last_reward_time + self.refractory_period ):
-                if (self.current_reward_number < self.max_rewards):
-                    self.last_reward_time = time
-                    self.current_reward_number += 1
-                    if (self.current_reward_number >= self.max_rewards):
-                        self.active = False
-
-                    self.io_interface.pulse_output(self.pin, time + self.pulse_length) # Trigger GPIO pulse
-                    
-                    if self.reward_sound and self.sound_controller:
-                        self.sound_controller.Beeps[self.reward_sound].play(time) # Play Reward sound
-
+            self.update_inside(time, pos, gpio, logger)
         elif self.reset_zone:
-            if inside(self.reset_zone, pos) and not self.active:
-                self.current_reward_number = 0
-                self.active = True
-
-
+            if inside(self.reset_zone, pos):
+                self.reset()
+
+    def update_inside(self, time, pos, gpio, logger=None):
+        """Update while the animal is in the reward zone."""
+        if time > (self.last_reward_time + self.refractory_period ):
+            if (self.current_reward_number < self.max_rewards):
+                self.last_reward_time = time
+                self.current_reward_number += 1
+                if self.controller:
+                    self.controller.rewards += 1
+                if (self.current_reward_number >= self.max_rewards):
+                    self.active = False
+
+                self.io_interface.pulse_output(self.pin, time + self.pulse_length) # Trigger GPIO pulse
+                
+                if self.reward_sound and self.sound_controller:
+                    self.sound_controller.Beeps[self.reward_sound].play(time) # Play Reward sound
+
+    def reset(self):
+        """Update in the reset zone (outside of the reward zone)."""
+        if not self.active:
+            self.current_reward_number = 0
+            self.active = True
 
 
 class OperantRewardZone(ClassicalRewardZone):
@@ -104,8 +200,9 @@ class OperantRewardZone(ClassicalRewardZone):
         else:
             self.lick_pin = gpio_interface.GPIOs[params['LickPin']]['Number'] # We are going to bit mask raw GPIO for this
 
-        self.lick_history = np.zeros(params.get('DebounceLength', 1)) # lick_history is a vector of zeros. we'll fill it with lick data as a circular buffer
-        self.lick_history_idx = 0
+        # licks count once the pin has been high this many ticks (tracked by the interface's GPIO inputs)
+        self.debounce_length = params.get('DebounceLength', 1)
+        self.lick_mask = gpio_interface.inputs.add_input(params['LickPin'], self.lick_pin)
 
         self.awaiting_zone_entry = True
         self.random_assist = None
@@ -113,54 +210,45 @@ class OperantRewardZone(ClassicalRewardZone):
             if not ( (params['RandomAssist'] >= 0.0) and (params['RandomAssist'] <= 1.0) ):
                 raise ValueError('RandomAssist Parameter of Operant Reward zone must be between 0.0 and 1.0!')
             self.random_assist = params['RandomAssist']
+            self._random_assist_draws = randomstreams.batched('RewardZones/{}'.format(params.get('Name', 'Operant')),
+                                                              lambda rng, n: rng.random(n))
 
         self.Type = 'Operant'
 
-    def update(self, time, pos, gpio, logger=None):
-        # debounce licks
-        mouse_licked = ((gpio & (0x01 << (self.lick_pin-1))) > 0)
-        self.lick_history[self.lick_history_idx] = mouse_licked
-        self.lick_history_idx = (self.lick_history_idx + 1) % len(self.lick_history)
-        mouse_licked_debounced = np.prod(self.lick_history) # will only be true if all ones!
-
-        if inside(self.active_zone, pos):
-            do_random_reward = False
-
-            if self.awaiting_zone_entry:
-                if self.random_assist:
-                    r = np.random.rand()
-                    if (r < self.random_assist):
-                        do_random_reward = True # Deliver reward classically this tick!
+    def update_inside(self, time, pos, gpio, logger=None):
+        """Update while the animal is in the reward zone."""
+        mouse_licked = ((gpio & self.lick_mask) > 0)
+        mouse_licked_debounced = (self.io_interface.inputs.ticks_high(self.lick_mask) >= self.debounce_length)
+        do_random_reward = False
+
+        if self.awaiting_zone_entry:
+            if self.random_assist:
+                r = next(self._random_assist_draws)
+                if (r < self.random_assist):
+                    do_random_reward = True # Deliver reward classically this tick!
+            if logger:
                 logger(['Entered', time, pos, gpio, do_random_reward]) # Log the reward event if logging
-                self.awaiting_zone_entry = False
-
-            if time > (self.last_reward_time + self.refractory_period ):
-                if self.active: 
-                    # mouse_licked = ((gpio & (0x01 << (self.lick_pin-1))) > 0)
-                    if mouse_licked_debounced or (do_random_reward):
-                        self.last_reward_time = time # For refractory period
-                        self.current_reward_number += 1 # For maximum number of rewards
-                        if (self.current_reward_number >= self.max_rewards):
-                            self.active = False # No more rewards after this!
-			
-                        self.io_interface.pulse_output(self.pin, time + self.pulse_length) # Trigger GPIO pulse
-                        
-                        if self.reward_sound and self.sound_controller:
-                            self.sound_controller.Beeps[self.reward_sound].play(time) # Play Reward sound
-
-                        if logger:
-                            logger(['Reward', time, pos, gpio, do_random_reward, mouse_licked]) # Log the reward event if logging
-
-
-        elif self.reset_zone:
-            if inside(self.reset_zone, pos):
-                self.awaiting_zone_entry = True
-                if not self.active:
-                    self.current_reward_number = 0
-                    self.active = True
-
-
+            self.awaiting_zone_entry = False
+
+        if time > (self.last_reward_time + self.refractory_period ):
+            if self.active: 
+                if mouse_licked_debounced or (do_random_reward):
+                    self.last_reward_time = time # For refractory period
+                    self.current_reward_number += 1 # For maximum number of rewards
+                    if self.controller:
+                        self.controller.rewards += 1
+                    if (self.current_reward_number >= self.max_rewards):
+                        self.active = False # No more rewards after this!
 
+                    self.io_interface.pulse_output(self.pin, time + self.pulse_length) # Trigger GPIO pulse
+                    
+                    if self.reward_sound and self.sound_controller:
+                        self.sound_controller.Beeps[self.reward_sound].play(time) # Play Reward sound
 
+                    if logger:
+                        logger(['Reward', time, pos, gpio, do_random_reward, mouse_licked]) # Log the reward event if logging
 
-    
+    def reset(self):
+        """Update in the reset zone (outside of the reward zone)."""
+        self.awaiting_zone_entry = True
+        ClassicalRewardZone.reset(self)
@@ -0,0 +1,68 @@
+import heapq
+import itertools
+
+
+class DeadlineScheduler():
+    def __init__(self):
+        """Calls functions once MasterTime passes their deadlines.
+
+        Pulses, beeps and timed state transitions register their deadlines here
+        instead of being polled every tick. Deadlines are kept in a min-heap, so
+        checking for due deadlines only looks at the earliest one, however many
+        outputs and stimuli are defined. Cancelled deadlines stay in the heap
+        (marked inactive) until they come up, or until they make up most of it.
+        """
+        self._heap = []
+        self._counter = itertools.count() # ties are run in the order they were scheduled
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def schedule(self, deadline, callback, *args):
+        """Call `callback(*args)` at the first run_due(time) with time > deadline.
+
+        Returns:
+            Handle which can be passed to cancel().
+        """
+        entry = [deadline, next(self._counter), callback, args, True]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, handle):
+        """Cancel a scheduled call (if it hasn't been run or cancelled already)."""
+        if handle is not None and handle[4]:
+            handle[4] = False
+            self._cancelled += 1
+            if (self._cancelled > 64) and (self._cancelled > len(self._heap) // 2):
+                # (in place, since run_due() may be iterating over the heap)
+                self._heap[:] = [entry for entry in self._heap if entry[4]]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    @property
+    def next_deadline(self):
+        """Earliest pending deadline (None if nothing is scheduled)."""
+        heap = self._heap
+        while heap and not heap[0][4]:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        return heap[0][0] if heap else None
+
+    def run_due(self, time):
+        """Run (in deadline order) every call whose deadline is before `time`.
+
+        Returns:
+            Number of calls run.
+        """
+        heap = self._heap
+        n_run = 0
+        while heap and heap[0][0] < time:
+            entry = heapq.heappop(heap)
+            if entry[4]:
+                entry[4] = False
+                entry[2](*entry[3])
+                n_run += 1
+            else:
+                self._cancelled -= 1
+        return n_run
@@ -3,6 +3,7 @@ from inspect import unwrap
 from re import I
 from numpy.lib.function_base import _unwrap_dispatcher
 import serial
+import time
 import struct
 import warnings
 import traceback as tb
@@ -10,14 +11,55 @@ from numpy import pi
 import numpy as np
 import zmq
 
+from treadmillio.packetdecoder import PACKET_DTYPES, START_CHARS, decode_packets, encoder_changes, find_packet_offset
+from treadmillio.velocityfilter import make_velocity_filter, NOMINAL_DT
+from treadmillio.scheduler import DeadlineScheduler
+from treadmillio.gpioinputs import GPIOInputs, INPUT_TYPES
+
 class SerialInterface():
-    def __init__(self, SerialPort='/dev/ttyS0', version=2, gpio_config=None, maze_config=None, zmq_streaming=None):
+    def __init__(self, SerialPort='/dev/ttyS0', version=2, gpio_config=None, maze_config=None, zmq_streaming=None,
+                 catch_up=False, telemetry_ring=None, telemetry_ring_length=5000, replace_telemetry_ring=False,
+                 coalesce_commands=True, blocking_commands=False, reader_thread=False, reader_ring_length=5000):
         self.serial = None
         self.version = version
         self.serialPort = SerialPort
 
+        # Command queue. Commands issued during a tick are gathered and sent in one
+        # write by flush_commands() (unless coalesce_commands is False).
+        self.coalesce_commands = coalesce_commands
+        self.blocking_commands = blocking_commands # if False, whatever doesn't fit in the OS buffer waits for the next flush
+        self._command_queue = bytearray()
+        self.commands_queued = 0 # commands queued since the last flush
+        self.commands_flushed = 0 # commands completely written by the last flush
+        self.total_commands = 0
+        self.command_writes = 0 # number of writes to the serial port
+        self.max_commands_per_flush = 0
+        self.command_stalls = 0 # number of flushes which couldn't write the whole queue
+        self._command_bytes_written = 0
+
+        # Backlog tracking. If the main loop stalls, packets pile up in the serial buffer.
+        self.catch_up = catch_up # if True, read_data() drains all pending packets in one call
+        self.backlog = 0 # number of complete packets waiting when read_data() was last called
+        self.max_backlog = 0
+        self.overruns = 0 # number of read_data() calls which found packets already waiting
+        self.caught_up_packets = 0 # number of packets drained (and not returned) in catch-up mode
+        self.skipped_samples = [] # (MasterTime, GPIO, Encoder, UnwrappedEncoder, pos, velocity, host time) for drained packets
+
+        # Host time (time.monotonic()) at which the last packet was received. With a reader thread,
+        # packets are stamped on arrival, so the stamps don't depend on how long the previous tick took.
+        self.last_host_time = 0.0
+        self.use_reader_thread = reader_thread
+        self.reader_ring_length = reader_ring_length
+        self.reader = None
+
         self.GPIOs = {}
 
+        # Edges and debounced levels of the input pins, updated with every packet (see gpioinputs.py)
+        self.inputs = GPIOInputs()
+
+        # Deadlines (MasterTime) of pulses, beeps and timed state transitions. Run by update_pulses().
+        self.scheduler = DeadlineScheduler()
+
         self.latency = 0
 
         self.MasterTime = 0
@@ -70,9 +112,8 @@ class SerialInterface():
             else:
                 raise(ValueError("Unknown Maze Topology {}. Currently implemented: 'Ring' or 'Line'.".format(self.maze_topology)))
 
-            smoothing_window_length = 50
-            self._smoothing_data = np.zeros(smoothing_window_length) # 50 samples at 500 Hz is 0.1 s
-            self._smoothing_idx = 0
+            # Velocity estimator (default: moving average over 50 samples, 0.1 s at 500 Hz)
+            self.velocity_filter = make_velocity_filter(maze_config.get('VelocityFilter', None), self.diameter_constant)
             self.velocity = 0
         else:
             self.virtual_track_length = 1000.0 #cm
@@ -86,6 +127,12 @@ class SerialInterface():
         else:
             self.data_socket = None
 
+        # Local processes read the most recent ticks from shared memory instead
+        if telemetry_ring:
+            from treadmillio.telemetryring import TelemetryRing
+            self.telemetry = TelemetryRing(telemetry_ring, telemetry_ring_length, replace=replace_telemetry_ring)
+        else:
+            self.telemetry = None
 
     def __enter__(self):
         return self
@@ -93,8 +140,18 @@ class SerialInterface():
     def __exit__(self, exc_type, exc_value, exc_traceback):
         print('SerialInterface: exiting because of exception <{}>'.format(exc_type.__name__))
         tb.print_tb(exc_traceback)
+        if self.overruns:
+            print('SerialInterface: {} reads found packets already waiting (max backlog {} packets, {} packets caught up).'.format(
+                self.overruns, self.max_backlog, self.caught_up_packets))
+        if self.total_commands:
+            print('SerialInterface: {} commands sent in {} writes (max {} per write, {} stalled writes).'.format(
+                self.total_commands, self.command_writes, self.max_commands_per_flush, self.command_stalls))
+        if self.reader:
+            self.reader.close() # (before the port is closed under it)
         if (self.serial):
             self.serial.close()
+        if self.telemetry:
+            self.telemetry.close()
 
     def connect(self):
         print('Connecting to serial/USB interface {} and synchronizing.'.format(self.serialPort))
@@ -111,37 +168,26 @@ class SerialInterface():
 
         # We read in a large buffer of data and find which offset is the start of the packets
         K = 3 # This code works for 100 but not 1000. Maybe related to buffer size???
-        if (self.version == 1):
-            self.MessageLen = 14
-            self.startChar = b'E'
-        elif (self.version == 2):
-            self.MessageLen = 17
-            self.startChar = b'F'
+        self.MessageLen = PACKET_DTYPES[self.version].itemsize
+        self.startChar = START_CHARS[self.version]
         x=self.serial.read(self.MessageLen*(K+1))
         print(len(x))
         assert(len(x) == self.MessageLen*(K+1))
         # print(x) # useful for debugging....
         # Find offset in this set
-        index = 0
-        while(True):
-            # print(x[index:])
-            continueFlag = False
-            for k in range(K):
-                if ( x.index(self.startChar,index + k*self.MessageLen) - (k*self.MessageLen + index)) != 0:
-                    continueFlag = True
-            if continueFlag:
-                index = index + 1
-            else:
-                break
-            if (index > (self.MessageLen-1)):
-                print('Reached end with bad index')
-                assert(False)
-                break
+        index = find_packet_offset(x, self.version, n_check=K)
+        if (index is None) or (index > (self.MessageLen-1)):
+            print('Reached end with bad index')
+            assert(False)
 
         # print('Found index: {}'.format(index))
 
         x = self.serial.read(index) # read the last little bit of the bad block, and we are in sync!
 
+        # Preallocated read buffers (one packet, and a batch for catching up)
+        self._packet_buffer = bytearray(self.MessageLen)
+        self._batch_buffer = bytearray(self.MessageLen * 500) # grows if the backlog is ever longer than 1 s
+
         # Make sure we understand the current state - Configure all pins to be input
         for pin in range(12):
             self.configure_pin(pin+1, 'INPUT')
@@ -153,20 +199,92 @@ class SerialInterface():
         if (self.version == 1):
             self.send_byte(self.GPIO_state) # make sure tracking state and GPIO state variable match!
 
+        self.flush_commands(block=True)
+
+        if self.use_reader_thread:
+            from treadmillio.serialreader import SerialReader
+            self.reader = SerialReader(self.serial, self.version, self.reader_ring_length)
 
     def read_data(self):
-        x=self.serial.read(self.MessageLen)
-        assert(len(x)==self.MessageLen)
+        if self.reader:
+            self.backlog = self.reader.pending
+        else:
+            self.backlog = self.serial.in_waiting // self.MessageLen
+        if self.backlog > 0:
+            self.overruns += 1
+            if self.backlog > self.max_backlog:
+                self.max_backlog = self.backlog
+
+        batch = self.catch_up and (self.backlog > 1)
+        if batch:
+            # Process all of the pending packets, but only return the latest. The
+            # others are kept in self.skipped_samples so they can be logged.
+            if self.reader:
+                self.reader.drop_lapped() # (overwritten packets are lost - take the rest in order)
+                n_packets = self.reader.pending
+            else:
+                n_packets = self.backlog
+            if self.reader:
+                packets, host_times = self.reader.take(n_packets)
+                packets = decode_packets(packets, self.version) # (checks the start characters)
+                self.last_host_time = float(host_times[-1])
+                host_times = host_times[:-1].tolist()
+            else:
+                n_bytes = self.MessageLen * n_packets
+                if n_bytes > len(self._batch_buffer):
+                    self._batch_buffer = bytearray(n_bytes)
+                buffer = memoryview(self._batch_buffer)[:n_bytes]
+                n_read = self.serial.readinto(buffer)
+                assert(n_read == n_bytes)
+                self.last_host_time = time.monotonic()
+                host_times = [self.last_host_time] * (n_packets - 1) # all arrived before this read
+                packets = decode_packets(buffer, self.version)
+                del buffer
+            unwrapped_encoder, pos, unwrapped_pos, velocity = self._process_packets(packets)
+            self.skipped_samples = list(zip(packets['MasterTime'][:-1].tolist(), packets['GPIO'][:-1].tolist(),
+                                            packets['Encoder'][:-1].tolist(), unwrapped_encoder[:-1].tolist(),
+                                            pos[:-1].tolist(), velocity[:-1].tolist(), host_times))
+            self.caught_up_packets += n_packets - 1
+            if self.telemetry: # every packet of the batch, so readers don't see gaps
+                self.telemetry.write_many(packets['MasterTime'], packets['GPIO'],
+                                          packets['AuxGPIO'] if (self.version==2) else 0,
+                                          pos, unwrapped_pos, velocity)
+            StartChar, StructSize = bytes(packets['StartChar'][-1]), int(packets['StructSize'][-1])
+            del packets # release the view of the batch buffer
+        else:
+            if self.skipped_samples:
+                self.skipped_samples = []
+            if self.reader:
+                buffer, offset, self.last_host_time = self.reader.next_packet()
+                StartChar, StructSize = self._process_packet(buffer, offset)
+            else:
+                n_read = self.serial.readinto(self._packet_buffer)
+                assert(n_read == self.MessageLen)
+                self.last_host_time = time.monotonic()
+                StartChar, StructSize = self._process_packet(self._packet_buffer, 0)
+
+        if self.data_socket:
+            self.data_socket.send(struct.pack('<Ld', self.MasterTime, self.pos))
+        if self.telemetry and not batch: # (a catch-up batch is written above)
+            self.telemetry.write(self.MasterTime, self.GPIO, self.AuxGPIO or 0, self.pos, self.unwrapped_pos, self.velocity)
 
+        # self.AuxGPIO will be None for version 1 interfaces
+        return StartChar, StructSize, self.MasterTime, self.Encoder, self.unwrapped_encoder, self.GPIO, self.AuxGPIO
+
+    def _process_packet(self, x, offset):
+        # Decode the packet starting at x[offset] and update state (including position)
+        previous_master_time = self.MasterTime
         if (self.version==1):
             StartChar, StructSize, self.MasterTime, self.Encoder, new_unwrapped_encoder, \
-                    self.GPIO  = struct.unpack('<cBLhlBx', x)
+                    self.GPIO  = struct.unpack_from('<cBLhlBx', x, offset)
             assert(StartChar == self.startChar)
+            self._update_inputs(self.MasterTime, self.GPIO)
 
         elif (self.version==2):
             StartChar, StructSize, self.MasterTime, self.Encoder, new_unwrapped_encoder, \
-                    self.GPIO, self.AuxGPIO  = struct.unpack('<cBLhlHHx', x)
+                    self.GPIO, self.AuxGPIO  = struct.unpack_from('<cBLhlHHx', x, offset)
             assert(StartChar == self.startChar)
+            self._update_inputs(self.MasterTime, self.GPIO)
             self.GPIO_state = (self.GPIO_state & self.OutputPinMask) + (self.GPIO & ~self.OutputPinMask)
             if (self.GPIO != self.GPIO_state):
                 self.latency = self.latency + 1
@@ -177,7 +295,8 @@ class SerialInterface():
                 diff_encoder = new_unwrapped_encoder - self.unwrapped_encoder # instantaneous velocity in angle (encoder units)
                 if not self.block_movement:
                     change_in_position = diff_encoder * self.diameter_constant # convert velocity to cm per time step
-                    self.velocity = self._smooth(change_in_position) * 500 # 500 = Hz samples per second TODO - make a parameter
+                    dt = ((self.MasterTime - previous_master_time) & 0xFFFFFFFF) / 1000 # MasterTime is in ms
+                    self.velocity = self.velocity_filter.update(change_in_position, dt if dt > 0 else NOMINAL_DT)
                     self.unwrapped_pos = self.unwrapped_pos + change_in_position # TODO - why do we need unwrapped_pos anymore???
 
                     self.pos = self.maze_topology_fun(self.pos + change_in_position) # depending on topology will either wrap or force between 0/track_length
@@ -192,12 +311,75 @@ class SerialInterface():
         else:
             self.unwrapped_encoder = new_unwrapped_encoder
             self.reinitialize = False
-                
-        if self.data_socket:
-            self.data_socket.send(struct.pack('<Ld', self.MasterTime, self.pos))
 
-        # self.AuxGPIO will be None for version 1 interfaces
-        return StartChar, StructSize, self.MasterTime, self.Encoder, self.unwrapped_encoder, self.GPIO, self.AuxGPIO
+        return StartChar, StructSize
+
+    def _update_inputs(self, master_time, gpio):
+        if self.reinitialize and (self.inputs.tick == 0): # first packet - initial levels, not edges
+            self.inputs.start(master_time, gpio)
+        else:
+            self.inputs.update(master_time, gpio)
+
+    def _process_packets(self, packets):
+        """Vectorized equivalent of calling _process_packet() on each of a batch of packets.
+
+        Args:
+            packets: Structured array of packets (see packetdecoder.PACKET_DTYPES).
+
+        Returns:
+            unwrapped_encoder, pos, unwrapped_pos, velocity: Arrays of the tracked encoder value,
+                position, unwrapped position and velocity after each packet.
+        """
+        n_packets = len(packets)
+        previous_master_time = self.MasterTime
+        self.MasterTime = int(packets['MasterTime'][-1])
+        self.Encoder = int(packets['Encoder'][-1])
+        self.GPIO = int(packets['GPIO'][-1])
+        for master_time, gpio in zip(packets['MasterTime'].tolist(), packets['GPIO'].tolist()):
+            self._update_inputs(master_time, gpio)
+        if (self.version==2):
+            self.AuxGPIO = int(packets['AuxGPIO'][-1])
+            # Output pins in GPIO_state are only changed by commands, so every packet is
+            # compared against the same expected output state.
+            self.latency += int(np.count_nonzero((packets['GPIO'] & self.OutputPinMask) != (self.GPIO_state & self.OutputPinMask)))
+            self.GPIO_state = (self.GPIO_state & self.OutputPinMask) + (self.GPIO & ~self.OutputPinMask)
+
+        new_unwrapped_encoder = packets['UnwrappedEncoder'].astype(np.int64)
+        pos = np.full(n_packets, self.pos, dtype=np.float64)
+        velocity = np.full(n_packets, self.velocity, dtype=np.float64)
+        unwrapped_pos = np.full(n_packets, self.unwrapped_pos, dtype=np.float64)
+        unwrapped_encoders = np.full(n_packets, self.unwrapped_encoder, dtype=np.int64)
+
+        first = 0
+        if self.reinitialize:
+            self.unwrapped_encoder = int(new_unwrapped_encoder[0])
+            unwrapped_encoders[:] = self.unwrapped_encoder
+            self.reinitialize = False
+            first = 1
+
+        if self.calculate_position and (n_packets > first):
+            if not self.block_movement:
+                change_in_position = encoder_changes(new_unwrapped_encoder[first:], self.unwrapped_encoder) * self.diameter_constant
+                master_times = packets['MasterTime'].astype(np.int64)
+                dt = np.diff(master_times, prepend=previous_master_time)[first:] % (1 << 32) / 1000
+                dt[dt <= 0] = NOMINAL_DT
+                velocity[first:] = self.velocity_filter.update_many(change_in_position, dt)
+                unwrapped_pos[first:] = self.unwrapped_pos + np.cumsum(change_in_position)
+                self.unwrapped_pos = float(unwrapped_pos[-1])
+                if self.maze_topology == 'Ring':
+                    pos[first:] = np.mod(self.pos + np.cumsum(change_in_position), self.virtual_track_length)
+                else: # clamping depends on the path, so integrate one step at a time
+                    p = self.pos
+                    for idx, change in enumerate(change_in_position.tolist(), first):
+                        p = self.maze_topology_fun(p + change)
+                        pos[idx] = p
+                self.pos = float(pos[-1])
+                self.velocity = float(velocity[-1])
+
+            unwrapped_encoders[first:] = new_unwrapped_encoder[first:]
+            self.unwrapped_encoder = int(new_unwrapped_encoder[-1])
+
+        return unwrapped_encoders, pos, unwrapped_pos, velocity
 
     def check_latency():
         latency = self.latency
@@ -206,7 +388,58 @@ class SerialInterface():
 
     def send_byte(self,data):
         if data is not None:
-            self.serial.write(data)
+            self._write_command(data)
+
+    def _write_command(self, command):
+        self.commands_queued += 1
+        self.total_commands += 1
+        if self.coalesce_commands:
+            self._command_queue += command
+        else:
+            self.serial.write(command)
+            self.command_writes += 1
+
+    def flush_commands(self, block=None):
+        """Send the commands queued since the last flush, in order, with a single write.
+
+        Called once per tick by the main loop (after all of the updates).
+
+        Args:
+            block: Wait until the whole queue has been written. Defaults to the
+                   blocking_commands setting. Otherwise, whatever the OS doesn't
+                   accept stays at the front of the queue for the next flush.
+
+        Returns:
+            Number of commands completely written.
+        """
+        queue = self._command_queue
+        self.commands_flushed = 0
+        if not queue:
+            self.commands_queued = 0
+            return 0
+        if block is None:
+            block = self.blocking_commands
+
+        n_written = self.serial.write(queue) or 0
+        self.command_writes += 1
+        while block and (n_written < len(queue)):
+            if n_written == 0:
+                self.serial.flush() # wait for the OS buffer to drain
+            n_written += self.serial.write(queue[n_written:]) or 0
+            self.command_writes += 1
+        if n_written < len(queue):
+            self.command_stalls += 1
+        del queue[:n_written]
+
+        # Commands are 4 bytes (1 byte GPIO states for version 1), and only count once they are completely written
+        command_len = 4 if self.version == 2 else 1
+        previous = self._command_bytes_written // command_len
+        self._command_bytes_written += n_written
+        self.commands_flushed = self._command_bytes_written // command_len - previous
+        if self.commands_flushed > self.max_commands_per_flush:
+            self.max_commands_per_flush = self.commands_flushed
+        self.commands_queued = 0
+        return self.commands_flushed
 
     # Pin Modes from teensy3/core_pins.h
     PinModes = {'INPUT': 0, 
@@ -227,7 +460,7 @@ class SerialInterface():
         configureString += pin.to_bytes(1, byteorder='big',signed=True)
         assert(direction.upper() in self.PinModes)
         configureString += self.PinModes[direction.upper()].to_bytes(1, byteorder='big',signed=True)
-        self.serial.write(configureString)
+        self._write_command(configureString)
 
     def write_pin(self, pin, value, pinType='DIO', mirror=False):
         writeString = b'\xA9' # Magic character which indicates start of command
@@ -242,7 +475,7 @@ class SerialInterface():
         writeString += pin.to_bytes(1, byteorder='big',signed=True)
         writeString += value.to_bytes(1, byteorder='big',signed=True)
         # print(value, writeString) # debuggging
-        self.serial.write(writeString)
+        self._write_command(writeString)
         
         if (value > 0) : 
             self.GPIO_state |= (0x01 <<pin)
@@ -260,6 +493,7 @@ class SerialInterface():
         if self.GPIOs[GPIO]['IsPulsed']:
             warnings.warn("GPIO pulse raised when already in a pulse.", UserWarning)
         self.GPIOs[GPIO]['IsPulsed'] = False
+        self.scheduler.cancel(self.GPIOs[GPIO]['PulseHandle'])
 
         if (self.version == 1):
             data = (self.GPIO_state[0] | (0x1 << pin)).to_bytes(1, byteorder='big',signed=True)
@@ -272,6 +506,7 @@ class SerialInterface():
     def lower_output(self, GPIO):
         pin = self.GPIOs[GPIO]['Number']
         self.GPIOs[GPIO]['IsPulsed'] = False
+        self.scheduler.cancel(self.GPIOs[GPIO]['PulseHandle'])
         if (self.version == 1):
             data = (self.GPIO_state[0] & ~(0x1 << pin)).to_bytes(1, byteorder='big',signed=True)
             self.GPIO_state = data
@@ -302,6 +537,8 @@ class SerialInterface():
                                            with the pin be turned on.
                                  `Mirror` - (Boolean) Should the AUX pin associated
                                             with the pin track it's state
+                                 `Debounce` - (Inputs) Number of ticks the input has to
+                                              hold a level for its debounced level to change
         
         """
         self.GPIOs[name] = {'Number':pin_config['Number'], 
@@ -319,15 +556,16 @@ class SerialInterface():
 
         if pin_config['Type'] == 'Output':
             self.OutputPinMask |= 0x01 << pin_config['Number']
+        elif pin_config['Type'] in INPUT_TYPES:
+            self.inputs.add_input(name, pin_config['Number'], pin_config.get('Debounce', 1))
 
         self.GPIOs[name]['IsPulsed'] = False
         self.GPIOs[name]['PulseOffTime'] = -1
+        self.GPIOs[name]['PulseHandle'] = None
 
     def update_pulses(self):
-        for gpio_name, gpio in self.GPIOs.items():
-            if gpio['IsPulsed']:
-                if (self.MasterTime > gpio['PulseOffTime']):
-                    self.lower_output(gpio_name)
+        # Lower outputs whose pulses have ended (and run anything else which is due)
+        self.scheduler.run_due(self.MasterTime)
 
     def pulse_output(self, GPIO, off_time):
         # Note: Calling pulse_output when a pulse is already active
@@ -339,10 +577,4 @@ class SerialInterface():
             warnings.warn("GPIO pulse instructed when already in a pulse.", UserWarning)
         self.GPIOs[GPIO]['IsPulsed'] = True
         self.GPIOs[GPIO]['PulseOffTime'] = off_time
-        
-
-    def _smooth(self, instantaneous_v):
-        # Simple moving average filter
-        self._smoothing_data[self._smoothing_idx] = instantaneous_v
-        self._smoothing_idx = (self._smoothing_idx + 1) % self._smoothing_data.shape[0]
-        return self._smoothing_data.mean()
+        self.GPIOs[GPIO]['PulseHandle'] = self.scheduler.schedule(off_time, self.lower_output, GPIO)
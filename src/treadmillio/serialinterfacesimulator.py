@@ -1,91 +1,271 @@
+import os
+import tty
+import time
+import select
+import collections
+import numpy as np
 
-#import serial
+from treadmillio.packetdecoder import PACKET_DTYPES, START_CHARS
 
-from itertools import cycle
-import csv
-import time
+# Emulator of the TreadmillIO firmware (Hardware/Firmware). It opens a pseudo-terminal
+# and streams version 2 packets on it at 500 Hz, so that run-treadmillio (or anything
+# else using SerialInterface) can be pointed at the emulator with -P /dev/pts/N.
+#
+# Like the firmware, DIO and AUX pins are 1-indexed, and pin N is bit N-1 of the
+# GPIO and AuxGPIO fields. The encoder and input pins are driven by a source
+# (synthetic, or a recorded DataLog). Pins configured as outputs reflect the
+# commands received, `latency` ms after they arrive.
+
+SAMPLE_PERIOD = 0.002 # s (500 Hz)
+TICKS_PER_SAMPLE = 2 # MasterTime is in ms
+
+COMMAND_START = 0xA9
+COMMAND_LENGTH = 4 # COMMAND_START, command, pin, value
+
+# Pin modes (teensy3/core_pins.h) which drive the pin
+OUTPUT_MODES = (1, 4) # OUTPUT, OUTPUT_OPENDRAIN
+
+MAX_PIN = 12
+
+
+class SyntheticSource():
+    def __init__(self, speed=20.0, run_duration=5.0, stop_duration=2.0, lick_pin=None, lick_rate=4.0,
+                 lick_duration=30, wheel_diameter=20.2, encoder_gain=4096.0, seed=None):
+        """Encoder and lick streams of a simulated animal which alternates between running and stopping.
+
+        Args:
+            speed: Running speed (cm/s).
+            run_duration: Mean duration (s) of running bouts (exponentially distributed).
+            stop_duration: Mean duration (s) of stops.
+            lick_pin: DIO pin (1-12) of the lick sensor, or None for no licks.
+            lick_rate: Rate (Hz) of licks while stopped.
+            lick_duration: Duration (ms) of each lick.
+            wheel_diameter: WheelDiameter of the maze (cm).
+            encoder_gain: EncoderGain of the maze (encoder ticks per revolution).
+            seed: Seed of the random number generator.
+        """
+        self.rng = np.random.default_rng(seed)
+        self.ticks_per_sample = speed / (np.pi * wheel_diameter / encoder_gain) * SAMPLE_PERIOD
+        self.mean_bout_samples = {True: run_duration / SAMPLE_PERIOD, False: stop_duration / SAMPLE_PERIOD}
+        self.lick_mask = (0x01 << (lick_pin - 1)) if lick_pin else 0
+        self.p_lick = lick_rate * SAMPLE_PERIOD
+        self.lick_samples = max(1, int(round(lick_duration / TICKS_PER_SAMPLE)))
+
+    def __iter__(self):
+        rng = self.rng
+        position = 0.0
+        running = True
+        bout_remaining = rng.exponential(self.mean_bout_samples[running])
+        lick_remaining = 0
+        while True:
+            bout_remaining -= 1
+            if bout_remaining <= 0:
+                running = not running
+                bout_remaining = rng.exponential(self.mean_bout_samples[running])
+            if running:
+                position += self.ticks_per_sample * (1 + 0.1 * rng.standard_normal())
+            elif lick_remaining == 0 and rng.random() < self.p_lick:
+                lick_remaining = self.lick_samples
+            gpio = 0
+            if lick_remaining > 0:
+                gpio = self.lick_mask
+                lick_remaining -= 1
+            yield 0, int(position), gpio, 0 # (the firmware doesn't fill in the wrapped encoder)
+
+
+class DataLogSource():
+    def __init__(self, datalog, loop=True):
+        """Encoder and GPIO streams of a recorded session (DataLog.csv or DataLog.bin).
+
+        Args:
+            datalog: DataLog of the session.
+            loop: Start over at the end of the session (otherwise the source ends).
+        """
+        from treadmillio.replay import load_datalog
+        data = load_datalog(datalog)[1:] # skip the synchronization row
+        if len(data) == 0:
+            raise(ValueError('DataLog {} has no samples to play.'.format(datalog)))
+        self.encoder = data['Encoder'].tolist()
+        self.unwrapped_encoder = data['UnwrappedEncoder'].tolist()
+        self.gpio = data['GPIO'].tolist()
+        self.aux_gpio = data['AuxGPIO'].tolist() if 'AuxGPIO' in data.dtype.names else [0] * len(data)
+        self.loop = loop
 
-class SerialInterface():
+    def __iter__(self):
+        offset = 0 # keeps the encoder continuous when we loop
+        while True:
+            for sample in zip(self.encoder, self.unwrapped_encoder, self.gpio, self.aux_gpio):
+                yield sample[0], sample[1] + offset, sample[2], sample[3]
+            if not self.loop:
+                return
+            offset += self.unwrapped_encoder[-1] - self.unwrapped_encoder[0]
 
-    def __init__(self, SerialPort='/dev/ttyS0'):
-        self.GPIO_state:bytes = b'\x00' # initialize GPIO state to 0
 
-        self.EncoderData = []
-        self.GPIOData = []
+class FirmwareEmulator():
+    def __init__(self, source, latency=0, link=None, start_time=0, spin=0.0):
+        """Emulated TreadmillIO module on a pseudo-terminal.
 
-        self.MasterTime = 0 # supposed to be a 4 byte int
+        Args:
+            source: Iterable of (Encoder, UnwrappedEncoder, GPIO, AuxGPIO) samples
+                    (e.g., SyntheticSource or DataLogSource).
+            latency: Time (ms) between receiving a command and the change of the outputs.
+            link: Optional path of a symlink to the pseudo-terminal (e.g., /tmp/treadmill).
+            start_time: Initial MasterTime (ms).
+            spin: Busy-wait for the last `spin` s before each deadline (reduces jitter,
+                  at the cost of CPU time).
+        """
+        self.source = iter(source)
+        self.latency = latency
+        self.spin = spin
+        self.master_time = start_time
 
-        # Load a sample data file
-        print('Loading sample data file for simulation.')
-        with open('shorterlog.txt', newline='') as csvfile: 
-            reader = csv.reader(csvfile, delimiter=',') 
-            for row in reader: 
-                self.EncoderData.append(int(row[2])) # Append the (wrapped) Encoder data
-                self.GPIOData.append(int(row[1])) # Append the (wrapped) Encoder data
+        self.dio_modes = [0] * MAX_PIN # all pins are inputs at reset
+        self.aux_modes = [0] * MAX_PIN
+        self.dio_output_mask = 0
+        self.aux_output_mask = 0
+        self.dio_outputs = 0
+        self.aux_outputs = 0
 
+        self._commands = bytearray()
+        self._pending = collections.deque() # (MasterTime at which to apply, command, pin, value)
 
-        self.UnwrappedEncoder = self.EncoderData[0] # supposed to be an unsigned 4 byte int
-        self.Encoder = self.EncoderData[0] # supposed to be a 2 byte int
-        self.EncoderGenerator = cycle(self.EncoderData) # make it circular
-        self.GPIOGenerator = cycle(self.GPIOData) # make it circular
-        self.Clock = time.monotonic()
+        self._packet = np.zeros(1, dtype=PACKET_DTYPES[2])
+        self._packet['StartChar'] = START_CHARS[2]
+        self._packet['StructSize'] = PACKET_DTYPES[2].itemsize
+        self._packet['EndChar'] = b'\n'
 
+        self.packets_sent = 0
+        self.packets_dropped = 0 # the host fell so far behind that the pseudo-terminal was full
+        self.commands_received = 0
+        self.max_lateness = 0.0
 
-        self.GPIO_pin_reset_callbacks = []
+        self._master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        tty.setraw(slave) # no echo or line editing (kept by the pseudo-terminal)
+        os.close(slave)
+        os.set_blocking(self._master, False)
+        self._poll = select.poll()
+        self._poll.register(self._master, select.POLLIN)
 
+        self.link = link
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.port, link)
 
-    def send_byte(self, data: bytes):
-        if data is not None:
-            if isinstance(data, bytes) and len(data) == 1:
-                self.GPIO_state = bytes(data)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    @property
+    def connected(self):
+        """True if a host has the pseudo-terminal open (the firmware only streams when DTR is set)."""
+        for _, event in self._poll.poll(0):
+            if event & select.POLLHUP:
+                return False
+        return True
+
+    def _read_commands(self):
+        try:
+            data = os.read(self._master, 4096)
+        except (BlockingIOError, OSError): # nothing waiting, or the host closed the port
+            return
+        commands = self._commands
+        commands += data
+        while len(commands) >= COMMAND_LENGTH:
+            if commands[0] != COMMAND_START: # resynchronize, like the firmware
+                start = commands.find(COMMAND_START)
+                del commands[:start if start >= 0 else len(commands)]
+                continue
+            self._pending.append((self.master_time + self.latency, commands[1], commands[2], commands[3]))
+            self.commands_received += 1
+            del commands[:COMMAND_LENGTH]
+
+    def _apply_commands(self):
+        pending = self._pending
+        while pending and pending[0][0] <= self.master_time:
+            _, command, pin, value = pending.popleft()
+            if not (0 < pin <= MAX_PIN):
+                continue # ignored by the firmware
+            bit = 0x01 << (pin - 1)
+            if command == ord('C'):
+                self.dio_modes[pin - 1] = value
+                self.dio_output_mask = (self.dio_output_mask | bit) if value in OUTPUT_MODES else (self.dio_output_mask & ~bit)
+            elif command == ord('X'):
+                self.aux_modes[pin - 1] = value
+                self.aux_output_mask = (self.aux_output_mask | bit) if value in OUTPUT_MODES else (self.aux_output_mask & ~bit)
+            elif command in (ord('D'), ord('M'), ord('A')):
+                if command in (ord('D'), ord('M')):
+                    self.dio_outputs = (self.dio_outputs | bit) if value else (self.dio_outputs & ~bit)
+                if command in (ord('A'), ord('M')):
+                    self.aux_outputs = (self.aux_outputs | bit) if value else (self.aux_outputs & ~bit)
+
+    def step(self):
+        """Emulate one 2 ms period: handle commands and send the next packet.
+
+        Returns:
+            False when the source has run out of samples.
+        """
+        try:
+            encoder, unwrapped_encoder, gpio, aux_gpio = next(self.source)
+        except StopIteration:
+            return False
+
+        self.master_time += TICKS_PER_SAMPLE
+        if not self.connected:
+            self._commands.clear()
+            return True
+
+        self._read_commands()
+        self._apply_commands()
+
+        packet = self._packet
+        packet['MasterTime'] = self.master_time & 0xFFFFFFFF
+        packet['Encoder'] = encoder
+        packet['UnwrappedEncoder'] = unwrapped_encoder
+        packet['GPIO'] = (gpio & ~self.dio_output_mask) | (self.dio_outputs & self.dio_output_mask)
+        packet['AuxGPIO'] = (aux_gpio & ~self.aux_output_mask) | (self.aux_outputs & self.aux_output_mask)
+        try:
+            if os.write(self._master, packet.tobytes()) == packet.itemsize:
+                self.packets_sent += 1
             else:
-                raise(ValueError('data was not a length 1 byte.'))
-
-
-    def read_data(self):
-        FlagChar = b'E'
-        StructSize = 14
-        self.MasterTime = self.MasterTime + 2 # 2 ms ticks
-        NextEncoder = next(self.EncoderGenerator)
-        DiffEncoder = NextEncoder - self.Encoder
-        if DiffEncoder > 2048:
-            DiffEncoder = DiffEncoder - 4096
-        elif DiffEncoder < -2048:
-            DiffEncoder = DiffEncoder + 4096
-        self.UnwrappedEncoder += DiffEncoder
-        self.Encoder = NextEncoder
-        
-        NextGPIOData = next(self.GPIOGenerator)
-        MaskedGPIO = (NextGPIOData | self.GPIO_state[0]).to_bytes(1, byteorder='little')
-
-        #FlagChar, StructSize, MasterTime, Encoder, UnwrappedEncoder, GPIO  = struct.unpack('<cBLhlBx', x)
-        # c = char, B = unsigned char, L = unsigned long (4 bytes), h = short (2 bytes), l = long, x = pad byte
-        assert(FlagChar == b'E')
-
-        currentClock = time.monotonic()
-        while (currentClock - self.Clock) < 0.002:
-            time.sleep((0.002 - (currentClock-self.Clock))*0.8)
-            currentClock = time.monotonic()
-        self.Clock = currentClock
-
-
-        return_value = FlagChar, StructSize, self.MasterTime, self.Encoder, self.UnwrappedEncoder, MaskedGPIO
-
-        data = b'\x00'
-        active_callbacks = [c for c in self.GPIO_pin_reset_callbacks if self.MasterTime >= c[0]]
-        if active_callbacks:
-            for c in active_callbacks:
-                data = bytes( data[0] | (1 << c[1]) )
-            self.GPIO_pin_reset_callbacks[:] = [c for c in self.GPIO_pin_reset_callbacks if self.MasterTime < c[0]]
-            self.send_byte(data)
-
-        return return_value
-
-
-    def gpio_pulse(self, pin, duration):
-        # (1) change pin value
-        # (2) register a value change for the future
-        data = bytes(self.GPIO_state[0] | (1 << pin))
-        offtime = self.MasterTime + duration
-        self.send_byte(data)
-        self.GPIO_pin_reset_callbacks.append( (offtime, pin) )
\ No newline at end of file
+                self.packets_dropped += 1
+        except BlockingIOError:
+            self.packets_dropped += 1
+        except OSError: # the host closed the port while we were sending
+            pass
+        return True
+
+    def run(self, duration=None):
+        """Stream packets at 500 Hz until the source ends (or for `duration` s).
+
+        Packets are sent at absolute deadlines (start + n * 2 ms), so timing errors
+        don't accumulate. If the emulator falls behind, late packets are sent
+        immediately (as a backlog), and MasterTime stays in step with the deadlines.
+        """
+        start = time.perf_counter()
+        n_samples = None if duration is None else int(duration / SAMPLE_PERIOD)
+        n = 0
+        while (n_samples is None) or (n < n_samples):
+            deadline = start + n * SAMPLE_PERIOD
+            remaining = deadline - time.perf_counter()
+            if remaining > self.spin:
+                time.sleep(remaining - self.spin)
+            while time.perf_counter() < deadline:
+                pass
+            lateness = time.perf_counter() - deadline
+            if lateness > self.max_lateness:
+                self.max_lateness = lateness
+            if not self.step():
+                break
+            n += 1
+        return n
@@ -0,0 +1,124 @@
+import time
+import threading
+import numpy as np
+
+from treadmillio.packetdecoder import PACKET_DTYPES
+
+
+class SerialReader():
+    def __init__(self, serial_port, version=2, capacity=5000):
+        """Reads packets from the serial port on a separate thread and stamps each one on arrival.
+
+        The thread blocks on the port and copies each packet straight into a
+        preallocated ring (a structured array of PACKET_DTYPES, so packets are
+        decoded in place), along with the host time (time.monotonic()) at which
+        it was received. The task loop takes packets from the ring, so slow task
+        processing delays neither the draining of the port nor the timestamps.
+
+        Args:
+            serial_port: Open (and synchronized) serial port. Reads must block with a timeout.
+            version: Protocol version of the packets.
+            capacity: Number of packets in the ring. If the task loop falls this far
+                      behind, the oldest packets are dropped.
+        """
+        self.serial = serial_port
+        self.capacity = capacity
+        self.message_len = PACKET_DTYPES[version].itemsize
+        self.packets = np.zeros(capacity, dtype=PACKET_DTYPES[version])
+        self.host_times = np.zeros(capacity)
+        self._raw = memoryview(self.packets).cast('B')
+
+        self._written = 0 # packets received (only changed by the reader thread)
+        self._read = 0 # packets taken (only changed by the task loop)
+        self.dropped = 0
+        self._error = None
+
+        self._event = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='SerialReader', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _run(self):
+        message_len = self.message_len
+        try:
+            while self._running:
+                slot = self._written % self.capacity
+                view = self._raw[slot*message_len:(slot+1)*message_len]
+                n_read = self.serial.readinto(view)
+                while self._running and (0 < n_read < message_len): # rest of a partial packet
+                    n_read += self.serial.readinto(view[n_read:])
+                if n_read < message_len: # timed out (or stopping)
+                    continue
+                self.host_times[slot] = time.monotonic()
+                self._written += 1
+                self._event.set()
+        except Exception as e: # passed on to the task loop
+            self._error = e
+            self._event.set()
+
+    @property
+    def pending(self):
+        """Number of packets received but not yet taken."""
+        return self._written - self._read
+
+    def _wait(self):
+        while self._written == self._read:
+            if self._error is not None:
+                raise(RuntimeError('SerialReader: reading the serial port failed.')) from self._error
+            if not self._thread.is_alive():
+                raise(RuntimeError('SerialReader: reader thread is not running.'))
+            self._event.clear()
+            if self._written == self._read: # (a packet may have arrived before the clear)
+                self._event.wait(0.1)
+        self.drop_lapped()
+
+    def drop_lapped(self):
+        """If the reader has lapped the ring, drop the oldest packets (which were overwritten).
+
+        Keeps clear of the slot being written. Returns the number of packets dropped.
+        """
+        n_dropped = self.pending - (self.capacity - 2)
+        if n_dropped > 0:
+            self.dropped += n_dropped
+            self._read += n_dropped
+            return n_dropped
+        return 0
+
+    def next_packet(self):
+        """Wait for the next packet.
+
+        Returns:
+            buffer, offset, host_time: The packet is `buffer[offset:offset+message_len]`
+                                       (valid until the reader laps the ring).
+        """
+        self._wait()
+        slot = self._read % self.capacity
+        self._read += 1
+        return self._raw, slot * self.message_len, float(self.host_times[slot])
+
+    def take(self, n_packets):
+        """Take (copies of) the next `n_packets` packets, which must already be pending.
+
+        Returns:
+            packets, host_times: Structured array of packets and array of their arrival times.
+        """
+        self.drop_lapped() # (the ring may have been lapped since `pending` was checked)
+        if n_packets > min(self.pending, self.capacity - 2):
+            raise(ValueError('SerialReader: only {} packets are pending.'.format(self.pending)))
+        slots = (self._read + np.arange(n_packets)) % self.capacity
+        self._read += n_packets
+        return self.packets[slots], self.host_times[slots]
+
+    def close(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+            if self.dropped:
+                print('SerialReader: dropped {} packets (task loop fell more than {} packets behind).'.format(
+                    self.dropped, self.capacity))
@@ -15,6 +15,7 @@ import pickle
 import traceback as tb
 
 from .alsainterface import ALSAPlaybackSystem, ALSARecordSystem
+from .scheduler import DeadlineScheduler
 from .alsainterface import normalize_output_device, normalize_input_device, look_for_and_add_stimulus_defaults
 # from .alsainterface import sort_bundled_sounds
 
@@ -68,9 +69,16 @@ def run_record_process(device_name, config, log_directory, status_queue):
 
 
 class SoundStimulusController():
-    def __init__(self, sound_config, track_length=None, track_topology='Ring', log_directory=None, verbose=0):
+    def __init__(self, sound_config, track_length=None, track_topology='Ring', log_directory=None, verbose=0,
+                 scheduler=None):
 
         self.valid = False
+
+        # Beeps are stopped by deadlines in a DeadlineScheduler. When the scheduler is shared
+        # (e.g., SerialInterface.scheduler), whoever runs it is responsible for running it every tick.
+        self._owns_scheduler = scheduler is None
+        self.scheduler = DeadlineScheduler() if scheduler is None else scheduler
+        self._beep_updates = {}
         # TODO: Handle pipes for multiple audio devices
         # TODO: Error check the YAML file before this to make sure
         #       that sound stimuli specify devices that are in the device list
@@ -154,7 +162,8 @@ class SoundStimulusController():
             new_stimulus.change_gain(new_stimulus.baseline_gain)
             #visualization.add_zone_position(0, VirtualTrackLength, fillcolor=stimulus['Color'], width=0.5, alpha=0.75)
         elif stimulus['Type'] == 'Beep':
-            new_stimulus = BeepSound(stimulus_name, stimulus, self.alsa_playback_pipe, verbose)
+            new_stimulus = BeepSound(stimulus_name, stimulus, self.alsa_playback_pipe, verbose,
+                                     scheduler=self.scheduler, on_stop=self._beep_stopped)
             self.Beeps[stimulus_name] = new_stimulus
         elif stimulus['Type'] == 'Localized':
             if not track_length:
@@ -198,14 +207,15 @@ class SoundStimulusController():
     def stop_capture(self):
         pass
 
+    def _beep_stopped(self, beep):
+        self._beep_updates[beep.name] = db2lin(beep.off_gain)
+
     def update_beeps(self, time):
-        update_dict = {}
-        for _, beep in self.Beeps.items():
-            new_beep_value = beep.update(time)
-            if new_beep_value is not None:
-                update_dict[beep.name] = db2lin(new_beep_value)
-        if update_dict:
-            self.alsa_playback_pipe.send_bytes(pickle.dumps(update_dict)) # update all at once!
+        if self._owns_scheduler:
+            self.scheduler.run_due(time)
+        if self._beep_updates:
+            self.alsa_playback_pipe.send_bytes(pickle.dumps(self._beep_updates)) # update all at once!
+            self._beep_updates = {}
 
     def update_localized(self, pos, unwrapped_pos):
         update_dict = {}
@@ -486,7 +496,14 @@ class MultilapBackgroundSound(SoundStimulus):
 
 
 class BeepSound(SoundStimulus):
-    def __init__(self, stimulus_name, stimulus_params, alsa_playback_pipe, verbose):
+    def __init__(self, stimulus_name, stimulus_params, alsa_playback_pipe, verbose, scheduler=None, on_stop=None):
+        """Sound which is played at BaselineGain for Duration ms.
+
+        Args:
+            scheduler: DeadlineScheduler on which to schedule the end of the beep. If None,
+                       update() has to be called every tick instead.
+            on_stop: Called (with the beep) when a scheduled beep ends.
+        """
         SoundStimulus.__init__(self, stimulus_name, stimulus_params, alsa_playback_pipe, verbose)
         if 'Duration' in stimulus_params:
             self.duration = stimulus_params['Duration']
@@ -495,6 +512,9 @@ class BeepSound(SoundStimulus):
 
         self.is_playing = False
         self.time_beep_off = -1
+        self.scheduler = scheduler
+        self.on_stop = on_stop
+        self._stop_handle = None
 
         SoundStimulus.change_gain(self,-90.0) # beep for a very short moment
         
@@ -504,7 +524,17 @@ class BeepSound(SoundStimulus):
         self.time_beep_off = now + self.duration
         SoundStimulus.change_gain(self,self.baseline_gain)
         self.is_playing = True
-    
+        if self.scheduler is not None:
+            self.scheduler.cancel(self._stop_handle)
+            self._stop_handle = self.scheduler.schedule(self.time_beep_off, self._stop)
+
+    def _stop(self):
+        self.is_playing = False
+        self._stop_handle = None
+        self.gain = self.off_gain # (so that the next play() sends the baseline gain again)
+        if self.on_stop:
+            self.on_stop(self)
+
     def update(self, time):
         if self.is_playing:
             if (time > self.time_beep_off):
@@ -0,0 +1,420 @@
+import os
+import json
+import hashlib
+
+from treadmillio.gpioequation import compile_equation
+from treadmillio.gpioinputs import INPUT_TYPES
+
+# Pre-flight checks of the StateMachine section of a configuration, run before any
+# hardware is connected. The section is compiled into a transition graph, which is
+# checked for:
+#   - references to states, GPIOs and sounds which aren't defined,
+#   - missing or invalid parameters of states and transitions,
+#   - duplicate transition priorities,
+#   - states which can't be reached from the first state,
+#   - sink states (and groups of states) which the task can never leave,
+#   - zero-time cycles: loops of states which never wait for time or an input.
+#
+# Results are cached (in memory and on disk) by a hash of the relevant parts of the
+# configuration, so starting a session with an unchanged configuration is fast. With
+# Regions, each region is checked on its own (transitions have to stay within a region).
+
+CHECK_VERSION = 5 # (changes invalidate cached results)
+
+STATE_TYPES = ['Base', 'Delay', 'SetGPIO', 'SetSoundState', 'Reward', 'Visualization',
+               'SetPosition', 'LockPosition', 'Patch', 'SetInternalState']
+CONDITION_TYPES = ['None', 'ElapsedTime', 'Delay', 'GPIO', 'Speed', 'Position', 'Random']
+PATCH_CONDITION_TYPES = ['Reward', 'Increment', 'Decrement']
+DIRECTIONS = ['>', '>=', '<', '<=']
+DELAY_PARAMS = {'Fixed': ['Value'], 'Exponential': ['Rate', 'Min', 'Max'], 'Uniform': ['Min', 'Max']}
+
+# Transitions which are taken without waiting for time or an input
+IMMEDIATE_CONDITIONS = ['None', 'Random']
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'treadmillio')
+
+
+class StateMachineCheck():
+    def __init__(self, first_state=None, transitions=None, errors=None, warnings=None, cached=False):
+        """Result of check_state_machine().
+
+        Args:
+            first_state: Name of the first state.
+            transitions: Dictionary of state name to a list of (next state, condition type).
+            errors: Problems which would prevent the task from running (correctly).
+            warnings: Suspicious features of the state machine.
+            cached: True if the result came from the cache.
+        """
+        self.first_state = first_state
+        self.transitions = transitions or {}
+        self.errors = errors or []
+        self.warnings = warnings or []
+        self.cached = cached
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def to_dict(self):
+        return {'FirstState': self.first_state, 'Transitions': self.transitions,
+                'Errors': self.errors, 'Warnings': self.warnings}
+
+    @classmethod
+    def from_dict(cls, d, cached=False):
+        transitions = {name: [tuple(t) for t in ts] for name, ts in d['Transitions'].items()}
+        return cls(d['FirstState'], transitions, d['Errors'], d['Warnings'], cached)
+
+    def report(self):
+        """Human-readable summary of the check."""
+        lines = ['State machine: {} states, {} transitions, first state {}.'.format(
+            len(self.transitions), sum(len(t) for t in self.transitions.values()), self.first_state)]
+        lines += ['  Error: {}'.format(e) for e in self.errors]
+        lines += ['  Warning: {}'.format(w) for w in self.warnings]
+        return '\n'.join(lines)
+
+
+def _sound_types(config):
+    # (None for stimuli without a Type, even from Defaults)
+    sound_config = config.get('AuditoryStimuli', None) or {}
+    default_type = (sound_config.get('Defaults', None) or {}).get('Type', None)
+    return {name: (stimulus or {}).get('Type', default_type)
+            for name, stimulus in (sound_config.get('StimuliList', None) or {}).items()}
+
+
+def _check_gpio_output(label, gpio_config, state_name, param, errors):
+    if label not in gpio_config:
+        errors.append('State {}: {} {} is not a defined GPIO.'.format(state_name, param, label))
+    elif gpio_config[label].get('Type', None) != 'Output':
+        errors.append('State {}: {} {} is not a GPIO output.'.format(state_name, param, label))
+
+
+def _check_delay_params(params, where, errors):
+    duration = params.get('Duration', None)
+    if duration not in DELAY_PARAMS:
+        errors.append('{}: Duration should be one of {} (got {}).'.format(where, ', '.join(DELAY_PARAMS), duration))
+        return
+    missing = [p for p in DELAY_PARAMS[duration] if p not in params]
+    if missing:
+        errors.append('{}: {} delays need {}.'.format(where, duration, ', '.join(missing)))
+
+
+def _check_condition(state_name, state_type, next_name, params, gpio_config, errors):
+    where = 'State {} (transition to {})'.format(state_name, next_name)
+    condition_type = params.get('ConditionType', 'None')
+    if condition_type == 'ElapsedTime':
+        if 'Duration' not in params:
+            errors.append('{}: ElapsedTime transitions need a Duration.'.format(where))
+    elif condition_type == 'Delay':
+        _check_delay_params(params, where, errors)
+    elif condition_type == 'GPIO':
+        if 'Equation' in params:
+            try:
+                compile_equation(params['Equation'], gpio_config)
+            except ValueError as e:
+                errors.append('{}: {}'.format(where, e))
+        else:
+            if 'Pin' not in params or 'Value' not in params:
+                errors.append('{}: GPIO transitions need a Pin and a Value (or an Equation).'.format(where))
+            elif isinstance(params['Pin'], str) and params['Pin'] not in gpio_config:
+                errors.append('{}: Pin {} is not a defined GPIO.'.format(where, params['Pin']))
+            elif params.get('Debounced', False) and isinstance(params['Pin'], str) and \
+                 gpio_config[params['Pin']].get('Type', None) not in INPUT_TYPES:
+                errors.append('{}: Debounced transitions need a GPIO input (Pin {}).'.format(where, params['Pin']))
+    elif condition_type in ['Speed', 'Position']:
+        if 'Threshold' not in params:
+            errors.append('{}: {} transitions need a Threshold.'.format(where, condition_type))
+        if params.get('Direction', None) not in DIRECTIONS:
+            errors.append('{}: Direction should be one of {}.'.format(where, ', '.join(DIRECTIONS)))
+    elif condition_type in CONDITION_TYPES:
+        pass
+    elif (state_type == 'Patch') and (condition_type in PATCH_CONDITION_TYPES):
+        if 'Value' not in params:
+            errors.append('{}: {} transitions need a Value.'.format(where, condition_type))
+    else:
+        errors.append('{}: unknown ConditionType {}.'.format(where, condition_type))
+    return condition_type
+
+
+def _check_state_params(state_name, state, config, all_states, gpio_config, errors, warnings):
+    state_type = state['Type']
+    params = state.get('Params', None) or {}
+    if state_type == 'Delay':
+        _check_delay_params(params, 'State {}'.format(state_name), errors)
+    elif state_type == 'SetGPIO':
+        _check_gpio_output(params.get('Pin', None), gpio_config, state_name, 'Pin', errors)
+    elif state_type == 'Reward':
+        _check_gpio_output(params.get('DispensePin', None), gpio_config, state_name, 'DispensePin', errors)
+        sound = params.get('RewardSound', 'None')
+        if sound != 'None':
+            sound_types = _sound_types(config)
+            if sound not in sound_types:
+                warnings.append('State {}: RewardSound {} is not a defined auditory stimulus.'.format(state_name, sound))
+            elif sound_types[sound] not in [None, 'Beep']: # (a missing Type is reported by check_state_machine())
+                errors.append('State {}: RewardSound {} is not a Beep.'.format(state_name, sound))
+    elif state_type == 'SetSoundState':
+        sound_types = _sound_types(config)
+        for sound, value in params.items():
+            if sound not in sound_types:
+                warnings.append('State {}: {} is not a defined auditory stimulus.'.format(state_name, sound))
+            elif sound_types[sound] not in [None, 'Background', 'Bundle']:
+                errors.append('State {}: {} is not a Background or Bundle sound.'.format(state_name, sound))
+            if value not in ['On', 'Off']:
+                errors.append('State {}: the value of {} should be On or Off.'.format(state_name, sound))
+    elif state_type == 'Visualization':
+        if params.get('VisType', None) not in ['Fixed', 'Random']:
+            errors.append('State {}: VisType should be Fixed or Random.'.format(state_name))
+    elif state_type == 'SetInternalState':
+        missing = [p for p in ['State', 'InternalState', 'Value'] if p not in params]
+        if missing:
+            errors.append('State {}: SetInternalState needs {}.'.format(state_name, ', '.join(missing)))
+        elif params['State'] not in all_states:
+            errors.append('State {}: State {} is not defined.'.format(state_name, params['State']))
+
+
+def _strongly_connected_components(nodes, successors):
+    """Tarjan's algorithm (iterative). Returns a list of components (lists of nodes)."""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(successors[root]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors[child])))
+                    advanced = True
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+def _region_configs(config):
+    """StateMachine regions (name to config, the name is None without Regions)."""
+    state_machine = config.get('StateMachine', None) or {}
+    if 'Regions' in state_machine:
+        return state_machine['Regions'] or {}
+    return {None: state_machine}
+
+
+def _check_region(region_name, region_config, config, all_states, gpio_config, errors, warnings):
+    """Check one region. Returns its first state and transitions (state name to list of (next state, condition type))."""
+    state_config = region_config.get('States', None) or {}
+    where = '' if region_name is None else 'Region {}: '.format(region_name)
+    first_state = None
+    transitions = {}
+    immediate = {} # states which leave without waiting for time or an input
+    for state_name, state in state_config.items():
+        transitions[state_name] = []
+        state = state or {}
+        if state.get('FirstState', False):
+            if first_state is not None:
+                errors.append('{}States {} and {} are both marked FirstState.'.format(where, first_state, state_name))
+            else:
+                first_state = state_name
+        state_type = state.get('Type', None)
+        if state_type not in STATE_TYPES:
+            errors.append('State {}: unknown Type {}.'.format(state_name, state_type))
+            continue
+        _check_state_params(state_name, state, config, all_states, gpio_config, errors, warnings)
+
+        next_state = state.get('NextState', None)
+        if isinstance(next_state, str):
+            transitions[state_name].append((next_state, 'None'))
+            immediate[state_name] = state_type != 'Delay'
+        elif isinstance(next_state, dict) and next_state:
+            priorities = {}
+            priority_counter = -1
+            condition_types = []
+            for next_name, params in next_state.items():
+                params = params or {}
+                if 'Priority' in params:
+                    priority = params['Priority']
+                else:
+                    priority = priority_counter
+                    priority_counter -= 1
+                if priority in priorities:
+                    errors.append('State {}: transitions to {} and {} have the same priority ({}).'.format(
+                        state_name, priorities[priority], next_name, priority))
+                priorities[priority] = next_name
+                condition_type = _check_condition(state_name, state_type, next_name, params, gpio_config, errors)
+                condition_types.append(condition_type)
+                transitions[state_name].append((next_name, condition_type))
+            immediate[state_name] = any(c in IMMEDIATE_CONDITIONS for c in condition_types)
+        else:
+            errors.append('State {} needs a NextState.'.format(state_name))
+
+    # References
+    for state_name, state_transitions in transitions.items():
+        for next_name, _ in state_transitions:
+            if next_name in transitions:
+                continue
+            elif next_name in all_states:
+                errors.append('State {}: NextState {} is in another region.'.format(state_name, next_name))
+            else:
+                errors.append('State {}: NextState {} is not defined.'.format(state_name, next_name))
+    if first_state is None:
+        first_state = next(iter(state_config))
+    successors = {name: sorted(set(n for n, _ in ts if n in transitions)) for name, ts in transitions.items()}
+
+    # Reachability
+    reachable = {first_state}
+    frontier = [first_state]
+    while frontier:
+        for next_name in successors[frontier.pop()]:
+            if next_name not in reachable:
+                reachable.add(next_name)
+                frontier.append(next_name)
+    unreachable = [name for name in transitions if name not in reachable]
+    if unreachable:
+        warnings.append('{}States which can never be reached from {}: {}.'.format(
+            where, first_state, ', '.join(unreachable)))
+
+    # Sinks: groups of states with no way out. Tasks usually end up cycling through one such
+    # group (after some initial states), so only single states and multiple groups are suspicious.
+    reachable_nodes = [name for name in transitions if name in reachable]
+    reachable_successors = {name: [n for n in successors[name] if n in reachable] for name in reachable_nodes}
+    sinks = []
+    for component in _strongly_connected_components(reachable_nodes, reachable_successors):
+        members = set(component)
+        if not any(n not in members for name in component for n in reachable_successors[name]):
+            sinks.append(sorted(component))
+    for component in sinks:
+        if len(component) == 1:
+            warnings.append('{}State {} is a sink state (the task can never leave it).'.format(where, component[0]))
+        elif len(sinks) > 1:
+            warnings.append('{}The task can never leave states {} once it enters them.'.format(
+                where, ', '.join(component)))
+
+    # Zero-time cycles: loops through states which never wait
+    immediate_nodes = [name for name in transitions if immediate.get(name, False)]
+    immediate_successors = {name: [n for n in successors[name] if immediate.get(n, False)]
+                            for name in immediate_nodes}
+    max_chain_length = region_config.get('MaxChainLength', config['StateMachine'].get('MaxChainLength', 1))
+    chaining = (max_chain_length or 1) > 1
+    for component in _strongly_connected_components(immediate_nodes, immediate_successors):
+        if len(component) > 1 or component[0] in immediate_successors[component[0]]:
+            message = 'Zero-time cycle: states {} can loop without ever waiting for time or an input'.format(
+                ', '.join(sorted(component)))
+            if chaining: # (the loop would use up MaxChainLength every tick)
+                errors.append(message + ' (with MaxChainLength > 1).')
+            else:
+                warnings.append(message + ' (one state per tick).')
+
+    return first_state, transitions
+
+
+def check_state_machine(config):
+    """Check the StateMachine section of a configuration (without creating any states).
+
+    Args:
+        config: Whole configuration (the GPIO and AuditoryStimuli sections are used to check names).
+
+    Returns:
+        StateMachineCheck
+    """
+    errors = []
+    warnings = []
+    state_machine = config.get('StateMachine', None) or {}
+    if 'Regions' in state_machine and 'States' in state_machine:
+        return StateMachineCheck(errors=['StateMachine should have either States or Regions, not both.'])
+    region_configs = _region_configs(config)
+    if not region_configs or not all((r or {}).get('States', None) for r in region_configs.values()):
+        return StateMachineCheck(errors=['StateMachine (or one of its Regions) has no States.'])
+    gpio_config = config.get('GPIO', None) or {}
+
+    for sound, sound_type in _sound_types(config).items():
+        if sound_type is None:
+            errors.append('Auditory stimulus {} has no Type (and there is no default Type).'.format(sound))
+
+    all_states = set()
+    for region_name, region_config in region_configs.items():
+        for state_name in region_config['States']:
+            if state_name in all_states:
+                errors.append('State {} is defined in more than one region.'.format(state_name))
+            all_states.add(state_name)
+
+    first_state = None
+    transitions = {}
+    for region_name, region_config in region_configs.items():
+        region_first_state, region_transitions = _check_region(region_name, region_config, config, all_states,
+                                                               gpio_config, errors, warnings)
+        if first_state is None: # (of the main region)
+            first_state = region_first_state
+        transitions.update(region_transitions)
+
+    return StateMachineCheck(first_state, transitions, errors, warnings)
+
+
+def config_hash(config):
+    """Hash of the parts of a configuration which check_state_machine() looks at."""
+    relevant = {'Version': CHECK_VERSION,
+                'StateMachine': config.get('StateMachine', None),
+                'GPIO': config.get('GPIO', None),
+                'AuditoryStimuli': _sound_types(config)}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+_cache = {}
+
+
+def check_config(config, cache_dir=DEFAULT_CACHE_DIR):
+    """check_state_machine(), with results cached by config_hash().
+
+    Args:
+        config: Whole configuration.
+        cache_dir: Directory of cached results (None to only cache in memory).
+    """
+    key = config_hash(config)
+    if key in _cache:
+        return StateMachineCheck.from_dict(_cache[key], cached=True)
+    cache_file = os.path.join(cache_dir, 'statemachine-{}.json'.format(key)) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                result = json.load(f)
+            _cache[key] = result
+            return StateMachineCheck.from_dict(result, cached=True)
+        except (OSError, ValueError, KeyError):
+            pass # (re-check)
+
+    check = check_state_machine(config)
+    _cache[key] = check.to_dict()
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump(_cache[key], f)
+        except OSError:
+            pass # caching is optional
+    return check
@@ -0,0 +1,65 @@
+import time
+import numpy as np
+
+from treadmillio.binarylog import load_log
+
+# State machine event log: one fixed-size record per action taken by a state (a reward,
+# a GPIO or sound change, ...), written as a binary log (see binarylog.py) through the
+# LogSink. States and targets (GPIOs, sounds, visualization commands) are stored as ids.
+# The header holds the tables of names:
+#   'Events'  : event kinds (by Event id)
+#   'States'  : state names (by State id)
+#   'Regions' : region of each state (None without StateMachine Regions)
+#   'Targets' : GPIO, sound and command names (by Target id)
+# Value is the level, duration or position set by the event (NaN if there isn't one), and
+# Latency the time (ms) from the arrival of the tick's packet to the event.
+
+EVENTS = ['Reward', 'SetGPIO', 'SetSoundState', 'Visualization', 'SetPosition', 'LockPosition']
+EVENT_IDS = {event: idx for idx, event in enumerate(EVENTS)}
+
+STATEMACHINELOG_DTYPE = np.dtype([('MasterTime', '<u4'),
+                                  ('Event', '<u1'),
+                                  ('State', '<i2'),
+                                  ('Target', '<i2'),
+                                  ('Value', '<f4'),
+                                  ('Latency', '<f4')])
+
+
+def state_event(state, event, target=-1, value=np.nan):
+    """Event record of a state, for its logger.
+
+    Args:
+        state: TaskState which took the action.
+        event: Event kind (one of EVENTS).
+        target: Target id (see TaskStateMachine.log_targets), -1 if there isn't one.
+        value: Level, duration or position.
+    """
+    io_interface = state.io_interface
+    host_time = io_interface.last_host_time
+    latency = (time.monotonic() - host_time) * 1000 if host_time else np.nan
+    return (io_interface.MasterTime, EVENT_IDS[event], state.state_id, target, value, latency)
+
+
+def load_statemachine_log(filename):
+    """Load a binary state machine log (StatemachineLog.bin).
+
+    Returns:
+        events: numpy structured array with MasterTime, Event, State, Target, Value and Latency fields
+        info: dictionary of header information, including the Events, States, Regions and Targets tables
+    """
+    return load_log(filename)
+
+
+def event_rows(events, info, latency=True):
+    """Rows of [MasterTime, Event, State, Region, Target, Value(, Latency)], with names instead of ids."""
+    states, regions, targets = info['States'], info['Regions'], info['Targets']
+    rows = []
+    for record in events.tolist():
+        master_time, event, state, target, value, event_latency = record
+        row = [master_time, info['Events'][event],
+               states[state] if state >= 0 else None, regions[state] if state >= 0 else None,
+               targets[target] if target >= 0 else None, value]
+        if latency:
+            row.append(event_latency)
+        rows.append(row)
+    return rows
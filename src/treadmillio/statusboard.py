@@ -0,0 +1,164 @@
+import os
+import time
+import struct
+import warnings
+from multiprocessing import shared_memory, resource_tracker
+
+# The main loop publishes the state of the rig into a small block of shared
+# memory every tick, and the treadmillio-status tool renders it. That way the
+# loop itself never formats text or writes to the terminal.
+#
+# The block is protected by a sequence lock: the writer makes the sequence
+# number odd while it updates the block and even when it is done, and a
+# reader retries if the number was odd or changed while it was reading.
+#
+#   bytes 0-7   : sequence number (uint64)
+#   bytes 8-11  : refresh interval (ms) suggested to readers (uint32)
+#   STATUS      : MasterTime, GPIO, Pos, Lap, Velocity, Rewards, Overruns,
+#                 SerialOverruns, UpdateTime (wall clock time of the update)
+#   LABEL       : label of the current state (pascal string)
+
+STATUS_BOARD_NAME = 'treadmillio_status'
+
+_SEQUENCE = struct.Struct('<Q')
+_INTERVAL = struct.Struct('<I')
+_STATUS = struct.Struct('<IHdddIIId')
+_LABEL = struct.Struct('<64p')
+
+_INTERVAL_OFFSET = _SEQUENCE.size
+_STATUS_OFFSET = _INTERVAL_OFFSET + _INTERVAL.size
+_LABEL_OFFSET = _STATUS_OFFSET + _STATUS.size
+STATUS_BOARD_SIZE = _LABEL_OFFSET + _LABEL.size
+
+STATUS_FIELDS = ['MasterTime', 'GPIO', 'Pos', 'Lap', 'Velocity', 'Rewards', 'Overruns', 'SerialOverruns', 'UpdateTime']
+
+
+def create_shared_memory(name, size, replace=False):
+    """Create a named shared memory block.
+
+    Args:
+        name: Name of the block.
+        size: Size of the block (bytes).
+        replace: If True, a block which already has this name (e.g., left over from a crash) is
+                 replaced. Otherwise it's an error, as another session may be using it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        if not replace:
+            raise(FileExistsError('Shared memory block {} already exists. If another session is running on this '
+                                  'host, give this one different StatusBoardName and TelemetryRing preferences. '
+                                  'If it was left over from a crash, use --replace-shared-memory.'.format(name))) from None
+        warnings.warn('Replacing shared memory block {}.'.format(name), RuntimeWarning)
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+
+def release_shared_memory(shm):
+    """Close a block made by create_shared_memory(), and unlink it unless another block has replaced it."""
+    try: # (POSIX shared memory is a file in /dev/shm on Linux)
+        owned = os.fstat(shm._fd).st_ino == os.stat(os.path.join('/dev/shm', shm._name.lstrip('/'))).st_ino
+    except FileNotFoundError:
+        owned = False
+    except (AttributeError, OSError):
+        owned = True # (can't tell)
+    shm.close()
+    if owned:
+        shm.unlink()
+    else: # keep the resource tracker from unlinking the other block at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def attach_shared_memory(name):
+    """Attach to a shared memory block created by another process (which owns it)."""
+    shm = shared_memory.SharedMemory(name=name)
+    # Python < 3.13 registers attached blocks with the resource tracker, which
+    # would unlink the block when this process exits.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class StatusBoard():
+    def __init__(self, name=STATUS_BOARD_NAME, refresh_interval=250, replace=False):
+        """Shared memory block to which the main loop publishes the state of the rig.
+
+        Args:
+            name: Name of the shared memory block.
+            refresh_interval: Interval (ms) at which readers should refresh their display.
+            replace: Replace an existing block with this name (see create_shared_memory()).
+        """
+        self.name = name
+        self._shm = create_shared_memory(name, STATUS_BOARD_SIZE, replace)
+        self._buf = self._shm.buf
+        self._sequence = 0
+        self._state_label = None
+        _SEQUENCE.pack_into(self._buf, 0, self._sequence)
+        _INTERVAL.pack_into(self._buf, _INTERVAL_OFFSET, int(refresh_interval))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def publish(self, master_time, gpio, pos, lap, velocity, state_label=None, rewards=0, overruns=0, serial_overruns=0):
+        buf = self._buf
+        self._sequence += 1 # odd - update in progress
+        _SEQUENCE.pack_into(buf, 0, self._sequence)
+        _STATUS.pack_into(buf, _STATUS_OFFSET, master_time, gpio, pos, lap, velocity,
+                          rewards, overruns, serial_overruns, time.time())
+        if state_label is not self._state_label: # labels rarely change, so only encode them when they do
+            self._state_label = state_label
+            _LABEL.pack_into(buf, _LABEL_OFFSET, (state_label or '').encode('utf-8'))
+        self._sequence += 1
+        _SEQUENCE.pack_into(buf, 0, self._sequence)
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.release()
+            self._buf = None
+            release_shared_memory(self._shm)
+
+
+class StatusBoardReader():
+    def __init__(self, name=STATUS_BOARD_NAME):
+        """Read-only view of a StatusBoard published by another process.
+
+        Raises FileNotFoundError if no board with this name exists.
+        """
+        self.name = name
+        self._shm = attach_shared_memory(name)
+        self._buf = self._shm.buf
+        self.refresh_interval, = _INTERVAL.unpack_from(self._buf, _INTERVAL_OFFSET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def read(self, max_tries=1000):
+        """Consistent copy of the board as a dictionary, or None if nothing has been published yet."""
+        buf = self._buf
+        for _ in range(max_tries):
+            sequence, = _SEQUENCE.unpack_from(buf, 0)
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            status = _STATUS.unpack_from(buf, _STATUS_OFFSET)
+            label, = _LABEL.unpack_from(buf, _LABEL_OFFSET)
+            if _SEQUENCE.unpack_from(buf, 0)[0] == sequence:
+                if sequence == 0:
+                    return None
+                status = dict(zip(STATUS_FIELDS, status))
+                status['State'] = label.decode('utf-8')
+                return status
+        raise(RuntimeError('Could not get a consistent read of status board {}.'.format(self.name)))
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.release()
+            self._buf = None
+            self._shm.close()
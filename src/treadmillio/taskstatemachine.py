@@ -3,17 +3,13 @@ import numpy as np
 from itertools import cycle
 import warnings
 import zmq
-import random
 import pickle
 import operator
+import bisect
 
-class StateTransitionCondition:
-    def __init__(self, label, state_config, io_interface):
-        self.label = label
-
-    def condition(self, io_interface):
-        # test if the condtion defined by this object is current true or false
-        pass
+from .gpioequation import compile_equation, AUX_SHIFT
+from . import randomstreams
+from .statemachinelog import state_event, EVENTS
 
 def get_operator(direction):
     if direction == '>':
@@ -28,6 +24,201 @@ def get_operator(direction):
         raise(ValueError("Trying to interpret a conditional transition, but direction {} is not supported").format(direction))
 
 
+# Conditional state transitions are compiled (when the state is created) into condition
+# objects, kept in a tuple sorted by priority. Each has an is_met() method, so that
+# get_next_state() only has to call them in order until one is satisfied.
+
+def threshold_bounds(thresholds, value):
+    """Open interval around `value` which contains none of the (sorted) `thresholds`.
+
+    Comparisons of the value with the thresholds can only change once it leaves the
+    interval. If the value is equal to a threshold, the interval is empty.
+    """
+    idx = bisect.bisect_left(thresholds, value)
+    if idx < len(thresholds) and thresholds[idx] == value:
+        return value, value
+    low = thresholds[idx - 1] if idx > 0 else -np.inf
+    high = thresholds[idx] if idx < len(thresholds) else np.inf
+    return low, high
+
+
+class StateTransitionCondition:
+    __slots__ = ('next_state', 'priority')
+
+    def __init__(self, next_state, priority):
+        self.next_state = next_state
+        self.priority = priority
+
+    def is_met(self):
+        """True if the transition should be taken (the condition is currently satisfied)."""
+        return True # ConditionType 'None'
+
+
+class ElapsedTimeCondition(StateTransitionCondition):
+    __slots__ = ('duration', 'scheduler', 'transition_time', 'expired', '_handle')
+
+    def __init__(self, next_state, priority, io_interface, duration):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.duration = duration
+        self.scheduler = io_interface.scheduler
+        self.transition_time = -1
+        self.expired = False # set by the scheduler
+        self._handle = None
+
+    def start(self, time):
+        self.scheduler.cancel(self._handle)
+        self.transition_time = time + self.duration
+        self.expired = False
+        self._handle = self.scheduler.schedule(self.transition_time, self._expire)
+
+    def _expire(self):
+        self.expired = True
+        self._handle = None
+
+    def cancel(self):
+        self.scheduler.cancel(self._handle)
+        self._handle = None
+
+    @property
+    def deadline(self):
+        return self.transition_time if self._handle is not None else None
+
+    def is_met(self):
+        return self.expired
+
+
+class DelayCondition(StateTransitionCondition):
+    __slots__ = ('state',)
+
+    def __init__(self, next_state, priority, delay_state):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.state = delay_state
+
+    def start(self, time):
+        self.state.on_entrance()
+
+    def cancel(self):
+        self.state.on_exit()
+
+    @property
+    def deadline(self):
+        return self.state.next_deadline
+
+    def is_met(self):
+        return self.state.expired
+
+
+class GPIOCondition(StateTransitionCondition):
+    __slots__ = ('io_interface', 'mask', 'value')
+
+    def __init__(self, next_state, priority, io_interface, pin, value):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.io_interface = io_interface
+        if isinstance(pin, str): # GPIO label
+            if pin not in io_interface.GPIOs:
+                raise(ValueError('GPIO state transition to {}: unknown GPIO {}.'.format(next_state, pin)))
+            pin = io_interface.GPIOs[pin]['Number']
+        self.mask = 0x01 << (pin - 1) # as in read_pin()
+        self.value = value
+
+    def is_met(self):
+        return ((self.io_interface.GPIO & self.mask) != 0) == self.value
+
+
+class DebouncedGPIOCondition(GPIOCondition):
+    __slots__ = ('inputs',)
+
+    def __init__(self, next_state, priority, io_interface, pin, value):
+        GPIOCondition.__init__(self, next_state, priority, io_interface, pin, value)
+        self.inputs = io_interface.inputs
+        if not (self.inputs.mask & self.mask):
+            raise(ValueError('Debounced GPIO state transition to {}: {} is not a GPIO input.'.format(next_state, pin)))
+
+    def is_met(self):
+        return ((self.inputs.debounced & self.mask) != 0) == self.value
+
+
+class GPIOEquationCondition(StateTransitionCondition):
+    __slots__ = ('io_interface', 'equation', 'terms', 'gpio_mask', 'aux_mask')
+
+    def __init__(self, next_state, priority, io_interface, equation, value=True):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.io_interface = io_interface
+        self.equation = equation
+        terms, self.gpio_mask, self.aux_mask = compile_equation(equation, io_interface.GPIOs)
+        if not value: # transition when the equation is false
+            terms = compile_equation('NOT ({})'.format(equation), io_interface.GPIOs)[0]
+        self.terms = tuple(terms)
+
+    def is_met(self):
+        word = self.io_interface.GPIO
+        if self.aux_mask:
+            word |= (self.io_interface.AuxGPIO or 0) << AUX_SHIFT
+        for mask, value in self.terms:
+            if (word & mask) == value:
+                return True
+        return False
+
+
+class SpeedCondition(StateTransitionCondition):
+    __slots__ = ('io_interface', 'operator', 'threshold')
+
+    def __init__(self, next_state, priority, io_interface, direction, threshold):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.io_interface = io_interface
+        self.operator = get_operator(direction)
+        self.threshold = threshold
+
+    def is_met(self):
+        return self.operator(self.io_interface.velocity, self.threshold)
+
+
+class PositionCondition(SpeedCondition):
+    __slots__ = ()
+
+    def is_met(self):
+        return self.operator(self.io_interface.pos, self.threshold)
+
+
+class CustomCondition(StateTransitionCondition):
+    __slots__ = ('check', 'params')
+
+    def __init__(self, next_state, priority, task_state, params):
+        StateTransitionCondition.__init__(self, next_state, priority)
+        self.check = task_state.check_state_transition
+        self.params = params
+
+    def is_met(self):
+        return self.check(self.next_state, self.params)
+
+
+class PatchRewardCondition(ElapsedTimeCondition):
+    # Reward, Increment and Decrement transitions of a PatchState. The available reward
+    # only grows while the state is current, so these are checked on entrance, and the
+    # Reward/Increment ones are then scheduled for when the reward crosses their threshold.
+    __slots__ = ('state', 'condition_type', 'value')
+
+    def __init__(self, next_state, priority, patch_state, condition_type, value):
+        ElapsedTimeCondition.__init__(self, next_state, priority, patch_state.io_interface, 0)
+        self.state = patch_state
+        self.condition_type = condition_type
+        self.value = value
+
+    def start(self, time):
+        self.cancel()
+        self.expired = self.state.check_state_transition(
+            self.next_state, {'ConditionType': self.condition_type, 'Value': self.value})
+        if self.expired or self.condition_type == 'Decrement':
+            return
+        if self.condition_type == 'Reward':
+            threshold = self.value
+        else: # next multiple of the increment
+            threshold = (self.state._prev_available_reward // self.value + 1) * self.value
+        self.transition_time = self.state.reward_threshold_time(threshold)
+        if self.transition_time < np.inf:
+            self._handle = self.scheduler.schedule(self.transition_time, self._expire)
+
+
 class TaskState:
 # Example yaml:
 #    ExampleState:
@@ -56,15 +247,20 @@ class TaskState:
 #          ConditionType: 'GPIO' # transition if a GPIO has some value
 #          Pin: 'SomePinLabel'
 #          Value: True # True or False (boolean == bit)
+#          Debounced: False # (optional) True to use the debounced level of the input (see the
+#                           # GPIO 'Debounce' option)
 #          Priority: 2
 #        SomeState4: 
 #          ConditionType: 'GPIO' # transition based on an equation of GPIO values
 #          Equation: 'SomePin1Label AND SomePin2Label OR SomPin3Label' # AND, OR, XOR, NOT allowed
+#                    # (and parentheses). Pins can also be given as DIO numbers ('3') or AUX pins ('AUX3').
+#          Value: True # (optional) False to transition when the equation is false
 #          Priority: 3
 
     def __init__(self, label, state_config, io_interface):
         self.Type = None
         self.label = label
+        self.state_id = -1 # (in the state machine log, set by TaskStateMachine)
         self.print_entry = state_config.get('PrintEntry', False)
 
         #print(state_config)
@@ -95,22 +291,24 @@ class TaskState:
                     self.next_state[state_name]['ConditionType'] = params['ConditionType']
                     if params['ConditionType'] == 'ElapsedTime':
                         self.next_state[state_name]['Duration'] = params['Duration'] # this will error if its not specified
-                        self.next_state[state_name]['TransitionTime'] = -1
                     elif params['ConditionType'] == 'Delay':
                         label = 'Delay ({} to {})'.format(self.label, state_name)
                         config = {'Params': params, 'NextState': 'Default'}
                         self.next_state[state_name]['State'] = DelayState(label, config, self.io_interface)
                     elif params['ConditionType'] == 'GPIO':
-                        self.next_state[state_name]['Pin'] = params['Pin'] # this will error if its not specified
-                        self.next_state[state_name]['Value'] = params['Value'] # this will error if its not specified
+                        if 'Equation' in params:
+                            self.next_state[state_name]['Equation'] = params['Equation']
+                            self.next_state[state_name]['Value'] = params.get('Value', True)
+                        else:
+                            self.next_state[state_name]['Pin'] = params['Pin'] # this will error if its not specified
+                            self.next_state[state_name]['Value'] = params['Value'] # this will error if its not specified
+                            self.next_state[state_name]['Debounced'] = params.get('Debounced', False)
                     elif params['ConditionType'] == 'Speed':
                         self.next_state[state_name]['Threshold'] = params['Threshold']
                         self.next_state[state_name]['Direction'] = params['Direction']
-                        self.next_state[state_name]['Operator'] = get_operator(params['Direction'])
                     elif params['ConditionType'] == 'Position':
                         self.next_state[state_name]['Threshold'] = params['Threshold']
                         self.next_state[state_name]['Direction'] = params['Direction']
-                        self.next_state[state_name]['Operator'] = get_operator(params['Direction'])
                     elif params['ConditionType'] == 'Random':
                         self.next_state[state_name]['RandomPriority'] = params.get('RandomPriority', 1.0)
                     elif params['ConditionType'] == 'None':
@@ -126,6 +324,8 @@ class TaskState:
             if len(priorities) > len(set(priorities)):
                 raise(ValueError('Non unique state transition priorities detected for state {}.'.format(label)))
 
+            self._compile_transitions()
+
         else:
             raise(ValueError('Parsing state machine. State {} needs a next state.'.format(label)))
 
@@ -133,6 +333,119 @@ class TaskState:
         self.render_viewer = state_config.get('Viewer', False)
         self._p_viewer = None
 
+    def _compile_transitions(self):
+        # Condition objects, highest priority first. Random transitions are always
+        # candidates, so they are kept apart (with a priority drawn every tick).
+        conditions = []
+        random_states = []
+        random_priorities = []
+        for state_name, params in self.next_state.items():
+            condition_type = params['ConditionType']
+            priority = params['Priority']
+            if condition_type == 'None':
+                conditions.append(StateTransitionCondition(state_name, priority))
+            elif condition_type == 'ElapsedTime':
+                conditions.append(ElapsedTimeCondition(state_name, priority, self.io_interface, params['Duration']))
+            elif condition_type == 'Delay':
+                conditions.append(DelayCondition(state_name, priority, params['State']))
+            elif condition_type == 'GPIO' and 'Equation' in params:
+                conditions.append(GPIOEquationCondition(state_name, priority, self.io_interface,
+                                                        params['Equation'], params['Value']))
+            elif condition_type == 'GPIO' and params['Debounced']:
+                conditions.append(DebouncedGPIOCondition(state_name, priority, self.io_interface, params['Pin'], params['Value']))
+            elif condition_type == 'GPIO':
+                conditions.append(GPIOCondition(state_name, priority, self.io_interface, params['Pin'], params['Value']))
+            elif condition_type == 'Speed':
+                conditions.append(SpeedCondition(state_name, priority, self.io_interface,
+                                                 params['Direction'], params['Threshold']))
+            elif condition_type == 'Position':
+                conditions.append(PositionCondition(state_name, priority, self.io_interface,
+                                                    params['Direction'], params['Threshold']))
+            elif condition_type == 'Random':
+                random_states.append(state_name)
+                random_priorities.append(params['RandomPriority'])
+            else:
+                conditions.append(self.compile_state_transition(state_name, priority, params))
+
+        conditions.sort(key=lambda condition: condition.priority, reverse=True)
+        self._conditions = tuple(conditions)
+        self._timed_conditions = tuple(c for c in conditions if isinstance(c, (ElapsedTimeCondition, DelayCondition)))
+        self._random_states = tuple(random_states)
+        self._random_draws = None
+        if random_states:
+            # (index, priority) of the winning random transition, drawn in batches
+            priorities = np.array(random_priorities)
+            def draw(rng, n):
+                samples = rng.random((n, len(priorities))) * priorities
+                idx = samples.argmax(axis=1)
+                return list(zip(idx.tolist(), samples[np.arange(n), idx].tolist()))
+            self._random_draws = randomstreams.batched('StateMachine/{}/Transitions'.format(self.label), draw)
+
+        # What the conditions depend on (for event-driven evaluation)
+        self._evaluate_every_tick = bool(random_states) or \
+            any(type(c) in (StateTransitionCondition, CustomCondition) for c in conditions)
+        self._gpio_mask = 0
+        self._aux_gpio_mask = 0
+        self._debounced_mask = 0
+        for c in conditions:
+            if isinstance(c, DebouncedGPIOCondition):
+                self._debounced_mask |= c.mask
+            elif isinstance(c, GPIOCondition):
+                self._gpio_mask |= c.mask
+            elif isinstance(c, GPIOEquationCondition):
+                self._gpio_mask |= c.gpio_mask
+                self._aux_gpio_mask |= c.aux_mask
+        self._speed_thresholds = sorted(set(c.threshold for c in conditions if type(c) is SpeedCondition))
+        self._position_thresholds = sorted(set(c.threshold for c in conditions if type(c) is PositionCondition))
+        self._watched_gpio = 0
+        self._watched_aux_gpio = 0
+        self._watched_debounced = 0
+        self._speed_bounds = (0.0, 0.0) # (empty until watch_inputs())
+        self._position_bounds = (0.0, 0.0)
+
+    def watch_inputs(self):
+        """Remember the inputs which the transition conditions depend on (after evaluating them).
+
+        Until needs_evaluation() is True, get_next_state() would give the same result.
+        """
+        if isinstance(self.next_state, dict):
+            io_interface = self.io_interface
+            self._watched_gpio = io_interface.GPIO
+            self._watched_aux_gpio = io_interface.AuxGPIO or 0
+            if self._debounced_mask:
+                self._watched_debounced = io_interface.inputs.debounced
+            self._speed_bounds = threshold_bounds(self._speed_thresholds, io_interface.velocity)
+            self._position_bounds = threshold_bounds(self._position_thresholds, io_interface.pos)
+
+    def needs_evaluation(self):
+        """True if a watched GPIO changed, speed or position crossed a threshold, or a deadline passed."""
+        if not isinstance(self.next_state, dict) or self._evaluate_every_tick:
+            return True
+        io_interface = self.io_interface
+        if (io_interface.GPIO ^ self._watched_gpio) & self._gpio_mask:
+            return True
+        if self._aux_gpio_mask and ((io_interface.AuxGPIO or 0) ^ self._watched_aux_gpio) & self._aux_gpio_mask:
+            return True
+        if self._debounced_mask and (io_interface.inputs.debounced ^ self._watched_debounced) & self._debounced_mask:
+            return True
+        low, high = self._speed_bounds
+        if not (low < io_interface.velocity < high):
+            return True
+        low, high = self._position_bounds
+        if not (low < io_interface.pos < high):
+            return True
+        for condition in self._timed_conditions:
+            if condition.is_met():
+                return True
+        return False
+
+    @property
+    def next_deadline(self):
+        """Earliest pending deadline (MasterTime) of the ElapsedTime and Delay transitions (None if there isn't one)."""
+        deadlines = [c.deadline for c in self._timed_conditions if c.deadline is not None] \
+            if isinstance(self.next_state, dict) else []
+        return min(deadlines) if deadlines else None
+
     def get_graph_label(self):
         return '<font point-size="18">{}: <b>{}</b></font>'.format(self.Type, self.label)
 
@@ -147,8 +460,12 @@ class TaskState:
                         next_state.append( (state_name, 'Elapsed Time ({} ms)'.format(condition['Duration'])))
                     elif condition['ConditionType'] == 'Delay':
                         next_state.append(  (state_name, 'Delay ({})'.format(condition['State'].label)) )
+                    elif condition['ConditionType'] == 'GPIO' and 'Equation' in condition:
+                        next_state.append( (state_name, 'GPIO {}{}'.format(
+                            condition['Equation'], '' if condition['Value'] else ' is False')))
                     elif condition['ConditionType'] == 'GPIO':
-                        next_state.append( (state_name, 'GPIO {} = {}'.format(condition['Pin'], condition['Value'])))
+                        next_state.append( (state_name, 'GPIO {} = {}{}'.format(condition['Pin'], condition['Value'],
+                                                   ' (debounced)' if condition.get('Debounced', False) else '')))
                     elif condition['ConditionType'] == 'Speed':
                         next_state.append( (state_name, 'Speed {} {}'.format(condition['Direction'], condition['Threshold'])))
                     elif condition['ConditionType'] == 'Position':
@@ -160,35 +477,20 @@ class TaskState:
                 return self.next_state
 
         if isinstance(self.next_state, dict):
-            time = self.io_interface.MasterTime
-            next_state = []
-            priority = []
-            for state_name, condition in self.next_state.items():
-                if  ((condition['ConditionType'] == 'ElapsedTime') and (time > condition['TransitionTime'])) or \
-                    ((condition['ConditionType'] == 'Delay') and (condition['State'].get_next_state())) or \
-                    ((condition['ConditionType'] == 'GPIO') and \
-                        (self.io_interface.read_pin(condition['Pin']) == condition['Value'])) or \
-                    ((condition['ConditionType'] == 'Speed') and \
-                        condition['Operator'](self.io_interface.velocity, condition['Threshold'])) or \
-                    ((condition['ConditionType'] == 'Position') and \
-                        condition['Operator'](self.io_interface.pos, condition['Threshold'])):
-                    # (note that we don't even check for "None")
-                    next_state.append(state_name)
-                    priority.append(condition['Priority'])
-                elif condition['ConditionType'] == 'Random': # enable random state transitions using priority
-                    next_state.append(state_name)
-                    priority.append(np.random.rand() * condition['RandomPriority'])
-                elif condition['ConditionType'] == 'None': # add state transition if unconditional
-                    next_state.append(state_name)
-                    priority.append(condition['Priority'])
-                elif condition['ConditionType'] not in ['None', 'ElapsedTime', 'Delay', 'GPIO', 'Speed', 'Position']:
-                    if self.check_state_transition(state_name, condition): # check custom state transition
-                        next_state.append(state_name)
-                        priority.append(condition['Priority'])
-            if next_state:
-                return( next_state[np.argmax(priority)] ) # return state with the highest priority
-            else:
-                return( None ) # if no condiditonal condition was matched, we stay in the same state (ignore the sel)
+            # Highest priority transition whose condition is met
+            if self._random_states:
+                idx, random_priority = next(self._random_draws)
+                for condition in self._conditions:
+                    if condition.priority <= random_priority:
+                        break # a random transition wins
+                    if condition.is_met():
+                        return condition.next_state
+                return self._random_states[idx]
+
+            for condition in self._conditions:
+                if condition.is_met():
+                    return condition.next_state
+            return None # if no condiditonal condition was matched, we stay in the same state (ignore the sel)
         else:
             return self.next_state
 
@@ -200,17 +502,15 @@ class TaskState:
             self._viewer_conn, self._p_viewer = launch_viewer(self.Type)
 
         if isinstance(self.next_state, dict):
-            for state_name, condition in self.next_state.items():
-                if (condition['ConditionType'] == 'ElapsedTime'):
-                    self.next_state[state_name]['TransitionTime'] = condition['Duration'] + self.io_interface.MasterTime
-                    #break # there's only supposed to be one TransitionTime state transition, so we can break if we find it
-                elif (condition['ConditionType'] == 'Delay'):
-                    self.next_state[state_name]['State'].on_entrance(logger=logger)
-        else:
-            pass
+            # Start the clocks of ElapsedTime and Delay transitions
+            for condition in self._timed_conditions:
+                condition.start(self.io_interface.MasterTime)
 
     def on_exit(self, logger=None):
-        pass
+        # Cancel the deadlines of our timed transitions
+        if isinstance(self.next_state, dict):
+            for condition in self._timed_conditions:
+                condition.cancel()
 
     def on_remain(self, logger=None):
         pass
@@ -225,6 +525,19 @@ class TaskState:
         raise NotImplementedError('Parsing state {}. ConditionType {} is not implemented.'
                                   .format(self.label, params['ConditionType']))
 
+    def compile_state_transition(self, state_name, priority, params):
+        """Condition object of a task-specific state transition (by default, calls check_state_transition())."""
+        return CustomCondition(state_name, priority, self, params)
+
+    def set_log_ids(self, state_id, target_id):
+        """Set the ids used in the state machine log.
+
+        Args:
+            state_id: Id of this state.
+            target_id: Function which returns the id of a target (GPIO, sound or command) name.
+        """
+        self.state_id = state_id
+
 class DelayState(TaskState):
 # Example yaml:
 #    ExampleFixedDelayState:
@@ -249,23 +562,25 @@ class DelayState(TaskState):
         self.delay_type = Params['Duration']
         self.delay_end = 0
         self.is_waiting = False
+        self.expired = False # set by the io_interface's scheduler
+        self._handle = None
 
         if (Params['Duration'] == 'Exponential'):
             self.rate = Params['Rate']
             self.delay_min = Params['Min']
             self.delay_max = Params['Max']
 
-            delays = np.random.exponential(self.rate, size=(50,))
-            delays += self.delay_min
-            delays[delays > self.delay_max] = self.delay_max
-            self.delays = np.rint(delays).astype('int').tolist()
+            def draw(rng, n):
+                delays = rng.exponential(self.rate, size=n) + self.delay_min
+                delays[delays > self.delay_max] = self.delay_max
+                return np.rint(delays).astype('int')
 
         elif (Params['Duration'] == 'Uniform'):
             self.delay_min = Params['Min']
             self.delay_max = Params['Max']
 
-            delays = np.random.uniform(self.delay_min, self.delay_max, size=(50,))
-            self.delays = np.rint(delays).astype('int').tolist()
+            def draw(rng, n):
+                return np.rint(rng.uniform(self.delay_min, self.delay_max, size=n)).astype('int')
 
         elif (Params['Duration'] == 'Fixed'):
             self.delays = [Params['Value']]
@@ -273,7 +588,10 @@ class DelayState(TaskState):
             raise(NotImplementedError(
                 "Random durations other than exponential not yet implemented"))
 
-        self.DelayList = cycle(self.delays)
+        if (Params['Duration'] == 'Fixed'):
+            self.DelayList = cycle(self.delays)
+        else: # drawn in batches from this state's random stream (so the sequence doesn't repeat)
+            self.DelayList = randomstreams.batched('StateMachine/{}/Delay'.format(label), draw)
 
     # def getDelay(self):
         # return next(self.DelayList)
@@ -282,11 +600,33 @@ class DelayState(TaskState):
         delay = next(self.DelayList)
         time = self.io_interface.MasterTime
         self.delay_end = time + delay
-    
+        scheduler = self.io_interface.scheduler
+        scheduler.cancel(self._handle)
+        self.expired = False
+        self._handle = scheduler.schedule(self.delay_end, self._expire)
+
+    def _expire(self):
+        self.expired = True
+        self._handle = None
+
+    def watch_inputs(self):
+        pass
+
+    def needs_evaluation(self):
+        return self.expired
+
+    @property
+    def next_deadline(self):
+        return self.delay_end if self._handle is not None else None
+
+    def on_exit(self, logger=None):
+        TaskState.on_exit(self, logger)
+        self.io_interface.scheduler.cancel(self._handle)
+        self._handle = None
+
     def get_next_state(self, rendering=False):
         if not rendering:
-            time = self.io_interface.MasterTime
-            if (time > self.delay_end):
+            if self.expired:
                 return self.next_state
             else:
                 return None
@@ -329,9 +669,9 @@ class VisualizationState(TaskState):
                 self.command.append(stim['Command'])
                 self.command_probs.append(stim['Probability'])
             self.command_probs = [p / prob_total for p in self.command_probs]
-            self.command_choices = np.random.choice(range(len(self.command_probs)),
-                                                    5000, True, self.command_probs)
-            self.CommandIndices = cycle(self.command_choices)
+            self.CommandIndices = randomstreams.batched(
+                'StateMachine/{}/Visualization'.format(label),
+                lambda rng, n: rng.choice(len(self.command_probs), n, True, self.command_probs))
 
         #TODO: Validate that server is online
 
@@ -351,9 +691,13 @@ class VisualizationState(TaskState):
             command = self.command[next(self.CommandIndices)]
         socket.send_string(command)
 
-        time = self.io_interface.MasterTime
         if logger:
-            logger([time,-1,-1,-1,-1,'Visualization', command])
+            logger(state_event(self, 'Visualization', self._log_targets[command]))
+
+    def set_log_ids(self, state_id, target_id):
+        TaskState.set_log_ids(self, state_id, target_id)
+        commands = [self.command] if self.visType == 'Fixed' else self.command
+        self._log_targets = {command: target_id(command) for command in commands}
 
 
     def get_graph_label(self):
@@ -396,9 +740,12 @@ class RewardState(TaskState):
         else:
             self.duration = 250  # ms
 
+        self.machine = None # TaskStateMachine which counts the rewards (set by the machine)
+
     def triggerReward(self, time):
         self.io_interface.pulse_output(self.pin, time + self.duration)
-        print('Reward!')
+        if self.machine:
+            self.machine.rewards += 1
         if self.RewardSound:
             self.RewardSound.play(time)
         return self.pin, self.duration
@@ -407,12 +754,17 @@ class RewardState(TaskState):
         TaskState.on_entrance(self, logger)
         time = self.io_interface.MasterTime
         self.io_interface.pulse_output(self.pin, time + self.duration)
-        print('Reward! ({})'.format(self.label))
+        if self.machine:
+            self.machine.rewards += 1
         if self.RewardSound:
             self.RewardSound.play(time)
 
         if logger:
-            logger([time,-1,-1,-1,-1,'Reward', self.pin, self.duration])  
+            logger(state_event(self, 'Reward', self._log_target, self.duration))
+
+    def set_log_ids(self, state_id, target_id):
+        TaskState.set_log_ids(self, state_id, target_id)
+        self._log_target = target_id(self.pin)
 
     def get_graph_label(self):
         label = '<table border="0"><tr><td>{}</td></tr>'.format(TaskState.get_graph_label(self))
@@ -451,9 +803,12 @@ class SetGPIOState(TaskState):
         else:
             self.io_interface.lower_output(self.pin)
 
-        time = self.io_interface.MasterTime
         if logger:
-            logger([time,-1,-1,-1,-1,'SetGPIO', self.pin, self.level])
+            logger(state_event(self, 'SetGPIO', self._log_target, self.level))
+
+    def set_log_ids(self, state_id, target_id):
+        TaskState.set_log_ids(self, state_id, target_id)
+        self._log_target = target_id(self.pin)
 
     def get_graph_label(self):
         label = '<table border="0"><tr><td>{}</td></tr>'.format(TaskState.get_graph_label(self))
@@ -474,9 +829,8 @@ class SetPosition(TaskState):
         TaskState.on_entrance(self, logger)
         self.io_interface.pos = self.pos
 
-        time = self.io_interface.MasterTime
         if logger:
-            logger([time,-1,-1,-1,-1,'SetPosition', self.pos])
+            logger(state_event(self, 'SetPosition', value=self.pos))
 
 
 class LockPosition(TaskState):
@@ -490,9 +844,8 @@ class LockPosition(TaskState):
         TaskState.on_entrance(self, logger)
         self.io_interface.block_movement = self.lock_state
 
-        time = self.io_interface.MasterTime
         if logger:
-            logger([time,-1,-1,-1,-1,'LockPosition', self.lock_state])
+            logger(state_event(self, 'LockPosition', value=self.lock_state))
 
 
 class SetSoundStimulusState(TaskState):
@@ -550,11 +903,12 @@ class SetSoundStimulusState(TaskState):
                         params['Sound'].choose_sound(self.Index)
                         self.IncrementIndex = 0
                     params['Sound'].change_gain(params['Gain'])
+                    if logger: # (which sound, and its level)
+                        logger(state_event(self, 'SetSoundState', self._log_targets[sound], params['Gain']))
 
-                time = self.io_interface.MasterTime
-                if logger:
-                    # TODO: log which sound and which level!
-                    logger([time,-1,-1,-1,-1,'SetSoundState'])
+    def set_log_ids(self, state_id, target_id):
+        TaskState.set_log_ids(self, state_id, target_id)
+        self._log_targets = {sound: target_id(sound) for sound in (self.Sound or {})}
 
     def get_graph_label(self):
         label = '<table border="0"><tr><td>{}</td></tr>'.format(TaskState.get_graph_label(self))
@@ -675,12 +1029,14 @@ class PatchState(TaskState):
             self.Model = ExponentialPatch(params['ModelType'], 
                                           params['ModelParams'],
                                           params.get('SwitchRate', 0.0),
-                                          self.io_interface.MasterTime)
+                                          self.io_interface.MasterTime,
+                                          rng=randomstreams.generator('StateMachine/{}/Patch'.format(label)))
         elif params['ModelType'] == 'Poisson':
             self.Model = PoissonPatch(params['ModelType'], 
                                       params['ModelParams'],
                                       params.get('SwitchRate', 0.0),
-                                      self.io_interface.MasterTime)
+                                      self.io_interface.MasterTime,
+                                      rng=randomstreams.generator('StateMachine/{}/Patch'.format(label)))
         else:
             raise NotImplementedError('Model type \'{}\' has not been implemented.'
                                       .format(params['ModelType']))
@@ -719,9 +1075,15 @@ class PatchState(TaskState):
             raise NotImplementedError('Condition type \'{}\' not implemented for PatchState.'
                                       .format(params['ConditionType']))
 
-    def on_entrance(self, logger=None):
-        TaskState.on_entrance(self, logger)
+    def compile_state_transition(self, state_name, priority, params):
+        return PatchRewardCondition(state_name, priority, self, params['ConditionType'], params['Value'])
 
+    def reward_threshold_time(self, available_reward):
+        """MasterTime at which the available reward reaches `available_reward` (np.inf if it never does)."""
+        t = self.Model.time_of_reward(available_reward + self.R_harvest)
+        return self.Model.master_time(t) if t < np.inf else np.inf
+
+    def on_entrance(self, logger=None):
         # Cache previous reward
         self._prev_available_reward = self.available_reward
 
@@ -730,22 +1092,27 @@ class PatchState(TaskState):
             self.R_harvest += self.RewardHarvest
             self.RewardHarvest = 0.0
 
-        if self.NewPatch:
+        new_patch = self.NewPatch
+        if new_patch:
             # Reset patch model if entering new patch
             self.reset()
-            if self.render_viewer:
-                update_dict = {'reset': None, 'priority': 1}
-                self._viewer_conn.send_bytes(pickle.dumps(update_dict))
         else:
             # Update patch statistics, i.e. if reward is available
             self.update()
-            if self.render_viewer:
+
+        # (after the patch is updated, as this schedules the Reward and Increment transitions)
+        TaskState.on_entrance(self, logger)
+
+        if self.render_viewer:
+            if new_patch:
+                update_dict = {'reset': None, 'priority': 1}
+            else:
                 update_dict = {'reward': [self.Model.t, self.available_reward],
                                'priority': 1} # don't skip first data point
-                self._viewer_conn.send_bytes(pickle.dumps(update_dict))
+            self._viewer_conn.send_bytes(pickle.dumps(update_dict))
 
     def on_remain(self, logger=None):
-        # Update patch statistics, i.e. if reward is available
+        # Update patch statistics (the transitions are deadlines, but ToneIndex and the viewer use them)
         self.update()
         if self.render_viewer:
             update_dict = {'reward': [self.Model.t, self.available_reward],
@@ -791,9 +1158,10 @@ class PatchModel():
     REQUIRED_PARAMS = []
     OPTIONAL_PARAMS = []
 
-    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis'):
+    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis', rng=None):
         # Settings
         self.Type = patch_type
+        self.rng = rng if rng is not None else randomstreams.generator('Patch')
 
         # Set internal state
         self.R = 0 # current total reward
@@ -831,11 +1199,11 @@ class PatchModel():
         elif 'Distribution' not in config:
             raise ValueError('Parameter configuration must specify distribution.')
         if config['Distribution'] == 'Uniform':
-            return np.random.uniform(config['Low'], config['High'])
+            return self.rng.uniform(config['Low'], config['High'])
         elif config['Distribution'] == 'LogUniform':
             if config['Low'] <= 0.0:
                 raise ValueError('Bounds must be positive numbers.')
-            return np.exp(np.random.uniform(np.log(config['Low']), np.log(config['High'])))
+            return np.exp(self.rng.uniform(np.log(config['Low']), np.log(config['High'])))
         else:
             raise NotImplementedError('Distribution \'{}\' has not been implemented.'
                                       .format(config['Distribution']))
@@ -849,19 +1217,27 @@ class PatchModel():
         # avoid potential conversion errors
         self.t = time*self._base - self.t0 # convert to seconds
 
+    def master_time(self, t):
+        """Inverse of the conversion in update(): patch time t (sec) to MasterTime."""
+        return (t + self.t0) / self._base
+
+    def time_of_reward(self, R):
+        """Patch time (sec) at which the total reward first reaches R (np.inf if it never does)."""
+        raise NotImplementedError
+
     def reset(self, time=0.0):
         self.R = 0.0
         self.t = 0.0
         self.t0 = time*self._base # convert to seconds
 
-        if random.random() < self.p_switch:
+        if self.rng.random() < self.p_switch:
             self.set_params()
 
 class ExponentialPatch(PatchModel):
 
     REQUIRED_PARAMS = ['tau', 'r0']
 
-    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis'):
+    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis', rng=None):
         """
         Creates patch that fills by exponentially-decaying reward rate.
 
@@ -869,18 +1245,12 @@ class ExponentialPatch(PatchModel):
         - tau: reward decay rate (sec)
         - r0: initial reward rate (uL/s)
         """
-        PatchModel.__init__(self, patch_type, params, p_switch, init_time, time_base)
+        PatchModel.__init__(self, patch_type, params, p_switch, init_time, time_base, rng)
 
         # Follows exponential decay:
         # r(t) = r0 * e^(-t/tau)
-
-        # We could instead determine reward times now to save computation, 
-        # but that would require knowing the Reward state transition threshold
-        # in the initialization. Not sure which way is better...
-        #n = np.arange(int(tau*r0/R0)) # total number of rewards
-        #t_reward = -tau*np.log(1.0 - (n*R0)/(tau*r0)) * 1000 # ms
-        #self.t_reward = np.append(t_reward, np.inf) # reward times (ms)
-        #self.n_reward = 0 # current reward number
+        # R(t) = r0 * tau * (1 - e^(-t/tau)), so the time at which R(t) reaches a
+        # threshold (e.g., of a Reward transition) is known in advance.
 
     @property
     def _r0(self):
@@ -896,6 +1266,13 @@ class ExponentialPatch(PatchModel):
     def R_func(self, t):
         return self._r0*self._tau*(1.0 - np.exp(-t/self._tau))
 
+    def time_of_reward(self, R):
+        if R <= 0.0:
+            return 0.0
+        elif R >= self._r0*self._tau:
+            return np.inf
+        return -self._tau*np.log1p(-R/(self._r0*self._tau))
+
     def update(self, time):
         PatchModel.update(self, time)
         self.R = self.R_func(self.t)
@@ -903,8 +1280,9 @@ class ExponentialPatch(PatchModel):
 class PoissonPatch(PatchModel):
     
     REQUIRED_PARAMS = ['tau', 'V0', 'lambda0']
+    CHUNK_SIZE = 64 # drip times drawn at once
 
-    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis'):
+    def __init__(self, patch_type, params, p_switch=0.0, init_time=0.0, time_base='millis', rng=None):
         """
         Creates patch that fills by drips following Poisson process.
 
@@ -913,10 +1291,11 @@ class PoissonPatch(PatchModel):
         - V0: drip size (uL)
         - lambda0: initial Poisson rate parameter (sec)
         """
-        PatchModel.__init__(self, patch_type, params, p_switch, init_time, time_base)
+        PatchModel.__init__(self, patch_type, params, p_switch, init_time, time_base, rng)
 
-        # Placeholder for drip times
-        self.t_drip = None
+        # Drip times (sec, sorted) are drawn in chunks as they are needed. The patch
+        # has released n_drips of them (the ones <= t).
+        self._reset_drips()
 
     @property
     def _tau(self):
@@ -936,74 +1315,178 @@ class PoissonPatch(PatchModel):
     def _Lam(self, t, s):
         return self._lambda0*self._tau*(np.exp(-t/self._tau) - np.exp(-(t+s)/self._tau))
 
-    def _inv_cdf(self, F, t_0):
-        return -(1.0/self._lam(t_0))*np.log(1.0 - F)
-
-    def _interevent_times(self, n, t, t_max=1000.0):
-        # Generate interevent times for lam(t)
-        F = np.random.uniform(size=n)
-        t = self._inv_cdf(F, t)
-        t[t > t_max] = t_max # cutoff at maximum interval
-        return t
-
-    def _events(self, t, s, t_max=1000.0):
-        """Generate number of events based on instantaneous Poisson rate."""
-        # Guess number of events as Poisson mean
-        mean = self._lam(t)*s
-        chunk = max(int(mean), 1)
-        
-        # Generate interevent times
-        t = self._interevent_times(chunk, t, t_max)
-        T = np.cumsum(t) # event times
-        idx = np.searchsorted(T, s, side='left')
-        n = idx  # number of event times < s
-
-        # Continue sampling time until time s reached
-        while (idx == T.size):
-            t = self._interevent_times(chunk, t, t_max)
-            T = np.cumsum(t) + T[-1]
-            idx = np.searchsorted(T, s, side='left')
-            n += idx
-            
-        return n
-
-    def _create_drip_times(self, t, s, t_max=None):
-        if t_max is None:
-            t_max = s
-
-        # Get event times with rate lambda_max
-        lam_max = self._lam(t) # current rate is maximum due to exponential decay
-        N_s = self._events(t, s, t_max) # number of events
-        #N_s = np.random.poisson(lam_max*s)
-        t_event = np.sort(np.random.uniform(low=t, high=t+s, size=N_s)) # time of events
-        
-        # Prune drip times to generate inhomogeneous process
-        lam_t = self._lam(t_event)
-        U = np.random.uniform(size=N_s)
-        return t_event[U <= (lam_t / lam_max)]
+    def _reset_drips(self):
+        self.t_drip = np.empty(0)
+        self.n_drips = 0
+        self._next_drip = None # (time of drip n_drips, once drawn)
+        self._cumulative_events = 0.0
+
+    def _draw_drip_times(self):
+        # Time rescaling: the drips of a unit-rate Poisson process at cumulative times E
+        # happen at Lam(0, t) = E. Only lambda0*tau drips are expected in total, so
+        # drips past that never happen (np.inf).
+        total = self._lambda0*self._tau
+        E = self._cumulative_events + np.cumsum(self.rng.exponential(size=self.CHUNK_SIZE))
+        self._cumulative_events = E[-1]
+        t = np.full(E.size, np.inf)
+        happen = E < total
+        t[happen] = -self._tau*np.log1p(-E[happen]/total)
+        self.t_drip = np.concatenate((self.t_drip, t))
+
+    def drip_time(self, n):
+        """Time (sec) of drip n (counting from 0), np.inf if the patch runs dry first."""
+        while n >= self.t_drip.size:
+            if self.t_drip.size and self.t_drip[-1] == np.inf:
+                return np.inf
+            self._draw_drip_times()
+        return self.t_drip[n]
+
+    def time_of_reward(self, R):
+        drips = max(int(np.ceil(R/self._V0 - 1e-9)), 0) # (allow for rounding of harvested reward)
+        return self.drip_time(drips - 1) if drips > 0 else 0.0
 
     def update(self, time):
         PatchModel.update(self, time)
 
-        if self.t_drip is None:
-            self.t_drip = self._create_drip_times(self.t, 1000.0)
+        if self._next_drip is None:
+            self._next_drip = self.drip_time(self.n_drips)
+        if self._next_drip <= self.t:
+            # Advance the cursor past the drips released since the last update
+            while self.t_drip[-1] <= self.t:
+                self._draw_drip_times()
+            self.n_drips = int(np.searchsorted(self.t_drip, self.t, side='right'))
+            self._next_drip = self.t_drip[self.n_drips]
 
-        self.R = np.sum(self.t_drip <= self.t)*self._V0
+        self.R = self.n_drips*self._V0
 
     def reset(self, time=0.0, **params):
         PatchModel.reset(self, time)
 
-        self.t_drip = None
+        self._reset_drips()
+
+
+class StateMachineRegion():
+    def __init__(self, name, config, machine_config, state_dict, machine):
+        """One region of a TaskStateMachine: a set of states, one of which is current.
+
+        Args:
+            name: Name of the region (None for a StateMachine without Regions).
+            config: Region configuration (States, and optionally EvaluationMode and MaxChainLength).
+            machine_config: StateMachine configuration (defaults for EvaluationMode and MaxChainLength).
+            state_dict: States of the region (name to object).
+            machine: The TaskStateMachine (for its socket and viewer).
+        """
+        self.name = name
+        self.StateMachineDict = state_dict
+        self.machine = machine
+        where = 'StateMachine' if name is None else 'StateMachine region {}'.format(name)
+
+        # 'EveryTick': check the transitions of the current state every tick.
+        # 'EventDriven': only when an input they depend on changes or a deadline passes.
+        self.evaluation_mode = config.get('EvaluationMode', machine_config.get('EvaluationMode', 'EveryTick'))
+        if self.evaluation_mode not in ['EveryTick', 'EventDriven']:
+            raise(ValueError('Unknown {} EvaluationMode {} (should be EveryTick or EventDriven).'.format(
+                where, self.evaluation_mode)))
+        self.event_driven = self.evaluation_mode == 'EventDriven'
+        self.evaluations = 0
+        self.skipped_evaluations = 0
+
+        # Maximum number of transitions taken in one tick. With the default of 1, a state we
+        # transition to is entered on the next tick. Longer chains run action states (SetGPIO,
+        # Reward, ...) back to back within one tick.
+        self.max_chain_length = config.get('MaxChainLength', machine_config.get('MaxChainLength', 1))
+        if not isinstance(self.max_chain_length, int) or self.max_chain_length < 1:
+            raise(ValueError('{} MaxChainLength should be a positive integer (got {}).'.format(
+                where, self.max_chain_length)))
+        self.chain_limit_hits = 0 # ticks in which the chain was cut short
+
+        self.FirstState = None
+        for state_name, state in config['States'].items():
+            if 'FirstState' in state and state['FirstState']:
+                self.FirstState = state_name
+        if self.FirstState is None:
+            self.FirstState = list(config['States'].keys())[0]
+            print('First state in {} not defined. '
+                  'Picking first state in list: {}'.format(where, self.FirstState))
+        else:
+            print('First state{} is {}'.format('' if name is None else ' of region {}'.format(name), self.FirstState))
+
+        self.CurrentState = self.StateMachineDict[self.FirstState]
+        self.new_state = True
+
+    @property
+    def next_wake_time(self):
+        """MasterTime after which the region next needs to be evaluated, unless an input changes.
+
+        The current MasterTime if the current state has to be evaluated every tick
+        (or was just entered), None if it only waits for inputs.
+        """
+        if self.new_state or self.CurrentState.needs_evaluation():
+            return self.CurrentState.io_interface.MasterTime
+        return self.CurrentState.next_deadline
+
+    def update(self, logger=None):
+        # Take up to max_chain_length transitions. A state we transition to is entered
+        # (and its transitions checked) in the same tick, unless the chain is at its limit.
+        for hop in range(self.max_chain_length):
+            if self.new_state:
+                # print(self.CurrentState.label) # TODO: Add Degug/Verbosity to the configuration and spit these out if it's set
+                machine = self.machine
+                if isinstance(self.CurrentState, VisualizationState):
+                    self.CurrentState.on_entrance(machine.socket, logger)
+                else:
+                    self.CurrentState.on_entrance(logger)
+
+                if machine.render_viewer:
+                    update_dict = {self.CurrentState.label: None, 'priority': 0}
+                    machine._viewer_conn.send_bytes(pickle.dumps(update_dict))
+            else:
+                self.CurrentState.on_remain(logger)
+
+            if self.event_driven:
+                if self.new_state or self.CurrentState.needs_evaluation():
+                    next_state = self.CurrentState.get_next_state()
+                    self.CurrentState.watch_inputs()
+                    self.evaluations += 1
+                else:
+                    next_state = None
+                    self.skipped_evaluations += 1
+            else:
+                next_state = self.CurrentState.get_next_state()
+            if next_state is not None:
+                self.CurrentState.on_exit(logger)
+                self.CurrentState = self.StateMachineDict[next_state]
+                self.new_state = True
+            else:
+                self.new_state = False
+                return
+
+        if self.max_chain_length > 1: # (a chain of one transition per tick is the default)
+            self.chain_limit_hits += 1
+            if self.chain_limit_hits == 1:
+                warnings.warn('StateMachine took MaxChainLength ({}) transitions in one tick, and will continue '
+                              'with {} on the next tick. Is there a loop of unconditional transitions?'.format(
+                                  self.max_chain_length, self.CurrentState.label), RuntimeWarning)
 
 
 class TaskStateMachine():
+# Example yaml (with concurrent regions, each with its own current state):
+#    StateMachine:
+#      Regions:
+#        Trials:
+#          States:
+#            ...
+#        Sounds:
+#          EvaluationMode: 'EventDriven' # (optional) overrides the StateMachine setting
+#          States:
+#            ...
+# State names are shared by all regions (so SetInternalState can reach across them), but
+# transitions have to stay within a region. Without Regions, States is a single region.
     def __init__(self, config, io_interface=None, sound_controller=None):
 
         self.zmq_context = None # keep track of whether we'll do comms
 
         self.StateMachineDict = {}
-        self.FirstState = None
-        self.new_state = True
 
         self.needs_zmq = False
         self.socket = None
@@ -1024,72 +1507,62 @@ class TaskStateMachine():
             self.sound_controller = sound_controller
 
         # ---------------- Process YAML config file / dictionary -------------------------------------------
-        set_internal = {} # SetInternalStates must be processed last
-        for state_name, state in config['States'].items():
-            if 'FirstState' in state and state['FirstState']:
-                self.FirstState = state_name
-
-            if (state['Type'] == 'Base'):
-                self.StateMachineDict[state_name] = TaskState(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'Delay'):
-                self.StateMachineDict[state_name] = DelayState(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'SetGPIO'):
-                self.StateMachineDict[state_name] = SetGPIOState(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'SetSoundState'):
-                self.StateMachineDict[state_name] = SetSoundStimulusState(
-                    state_name, state, io_interface, sound_controller)
-
-            elif (state['Type'] == 'Reward'):
-                self.StateMachineDict[state_name] = RewardState(
-                    state_name, state, io_interface, sound_controller)
-
-            elif (state['Type'] == 'Visualization'):
-                self.StateMachineDict[state_name] = VisualizationState(
-                    state_name, state, io_interface)
-                self.needs_zmq = True
-
-            elif (state['Type'] == 'SetPosition'):
-                self.StateMachineDict[state_name] = SetPosition(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'LockPosition'):
-                self.StateMachineDict[state_name] = LockPosition(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'Patch'):
-                self.StateMachineDict[state_name] = PatchState(
-                    state_name, state, io_interface)
-
-            elif (state['Type'] == 'SetInternalState'):
-                set_internal[state_name] = state
+        if 'Regions' in config:
+            if 'States' in config:
+                raise(ValueError('StateMachine should have either States or Regions, not both.'))
+            region_configs = config['Regions']
+        else:
+            region_configs = {None: config}
 
-            else:
-                raise(NotImplementedError("Unknown state machine element {}".format(state['Type'])))
+        region_states = {}
+        set_internal = {} # SetInternalStates must be processed last
+        for region_name, region_config in region_configs.items():
+            region_states[region_name] = {}
+            for state_name, state in region_config['States'].items():
+                if state_name in self.StateMachineDict or state_name in set_internal:
+                    raise(ValueError('State {} is defined in more than one StateMachine region.'.format(state_name)))
+                if (state['Type'] == 'SetInternalState'):
+                    set_internal[state_name] = (region_name, state)
+                else:
+                    self.StateMachineDict[state_name] = self._create_state(state_name, state, io_interface,
+                                                                           sound_controller)
+                    region_states[region_name][state_name] = self.StateMachineDict[state_name]
 
-        for state_name, state in set_internal.items(): # avoids KeyError if state not yet added
+        for state_name, (region_name, state) in set_internal.items(): # avoids KeyError if state not yet added
             # NOTE: Is it better to parse State parameter here, 
             #       or to pass entire dict to SetInternalState object?
             self.StateMachineDict[state_name] = SetInternalState(
                 state_name, state, io_interface, self.StateMachineDict)
-            
-        if self.FirstState is None:
-            self.FirstState = list(self.StateMachineDict.keys())[0]
-            print('First state in state machine not defined. '
-                  'Picking first state in list: {}'.format(self.FirstState))
-        else:
-            print('First state is {}'.format(self.FirstState))
+            region_states[region_name][state_name] = self.StateMachineDict[state_name]
+
+        for region_name, states in region_states.items():
+            for state in states.values():
+                next_states = state.next_state if isinstance(state.next_state, dict) else [state.next_state]
+                for next_state in next_states:
+                    if next_state not in states:
+                        raise(ValueError('State {}: NextState {} is not a state of the same StateMachine region.'.format(
+                            state.label, next_state)))
+
+        # (in config order, the first region is the main one)
+        self.regions = [StateMachineRegion(region_name, region_configs[region_name], config,
+                                           {name: states[name] for name in region_configs[region_name]['States']},
+                                           self)
+                        for region_name, states in region_states.items()]
+
+        # Ids of states and targets in the state machine log (see log_info())
+        self._state_regions = {state_name: region_name
+                               for region_name, states in region_states.items() for state_name in states}
+        self.log_targets = []
+        for state_id, state in enumerate(self.StateMachineDict.values()):
+            state.set_log_ids(state_id, self._log_target_id)
 
         self.StateMachineWaiting = False
         self.StateMachineWaitEndTime = 0
 
-        self.CurrentState = self.StateMachineDict[self.FirstState]
-
+        self.rewards = 0 # number of rewards delivered by Reward states
+        for state in self.StateMachineDict.values():
+            if isinstance(state, RewardState):
+                state.machine = self
 
         if self.needs_zmq:
             self.zmq_context = zmq.Context()
@@ -1103,6 +1576,50 @@ class TaskStateMachine():
             from .viewer import launch_viewer
             self._viewer_conn, self._p_viewer = launch_viewer('StateMachine', self.render())
 
+    def _create_state(self, state_name, state, io_interface, sound_controller):
+        if (state['Type'] == 'Base'):
+            return TaskState(state_name, state, io_interface)
+
+        elif (state['Type'] == 'Delay'):
+            return DelayState(state_name, state, io_interface)
+
+        elif (state['Type'] == 'SetGPIO'):
+            return SetGPIOState(state_name, state, io_interface)
+
+        elif (state['Type'] == 'SetSoundState'):
+            return SetSoundStimulusState(state_name, state, io_interface, sound_controller)
+
+        elif (state['Type'] == 'Reward'):
+            return RewardState(state_name, state, io_interface, sound_controller)
+
+        elif (state['Type'] == 'Visualization'):
+            self.needs_zmq = True
+            return VisualizationState(state_name, state, io_interface)
+
+        elif (state['Type'] == 'SetPosition'):
+            return SetPosition(state_name, state, io_interface)
+
+        elif (state['Type'] == 'LockPosition'):
+            return LockPosition(state_name, state, io_interface)
+
+        elif (state['Type'] == 'Patch'):
+            return PatchState(state_name, state, io_interface)
+
+        else:
+            raise(NotImplementedError("Unknown state machine element {}".format(state['Type'])))
+
+    def _log_target_id(self, name):
+        if name not in self.log_targets:
+            self.log_targets.append(name)
+        return self.log_targets.index(name)
+
+    def log_info(self):
+        """Tables of names for the header of the state machine log (see statemachinelog.py)."""
+        return {'Events': EVENTS,
+                'States': list(self.StateMachineDict),
+                'Regions': [self._state_regions[name] for name in self.StateMachineDict],
+                'Targets': [str(name) for name in self.log_targets]}
+
     def __enter__(self):
         if self.needs_zmq:
             self.socket = self.zmq_context.socket(zmq.PAIR)
@@ -1114,38 +1631,58 @@ class TaskStateMachine():
         if self.socket:
             self.socket.close()
 
+    # The main (first) region's current state, and totals over the regions
+    @property
+    def FirstState(self):
+        return self.regions[0].FirstState
+
+    @property
+    def CurrentState(self):
+        return self.regions[0].CurrentState
+
+    @property
+    def new_state(self):
+        return self.regions[0].new_state
+
+    @property
+    def current_states(self):
+        """Current state of each region (region name to state, the name is None without Regions)."""
+        return {region.name: region.CurrentState for region in self.regions}
+
+    @property
+    def evaluations(self):
+        return sum(region.evaluations for region in self.regions)
+
+    @property
+    def skipped_evaluations(self):
+        return sum(region.skipped_evaluations for region in self.regions)
+
+    @property
+    def chain_limit_hits(self):
+        return sum(region.chain_limit_hits for region in self.regions)
+
+    @property
+    def next_wake_time(self):
+        """MasterTime after which the state machine next needs to be evaluated, unless an input changes.
+
+        The current MasterTime if a current state has to be evaluated every tick
+        (or was just entered), None if they all only wait for inputs.
+        """
+        wake_times = [t for t in (region.next_wake_time for region in self.regions) if t is not None]
+        return min(wake_times) if wake_times else None
+
     def start(self, time):
         # if (self.CurrentState.Type == 'Delay'):
             # self.StateMachineWaitEndTime = time + self.CurrentState.getDelay()
             # self.StateMachineWaiting = True
-        self.new_state = True
-        pass
+        for region in self.regions:
+            region.new_state = True
 
 
     def update_statemachine(self, logger=None):
-        time = self.io_interface.MasterTime
-
-        if self.new_state:
-            # print(self.CurrentState.label) # TODO: Add Degug/Verbosity to the configuration and spit these out if it's set
-            if isinstance(self.CurrentState, VisualizationState):
-                self.CurrentState.on_entrance(self.socket, logger)
-            else:
-                self.CurrentState.on_entrance(logger)
-
-            if self.render_viewer:
-                update_dict = {self.CurrentState.label: None, 'priority': 0}
-                self._viewer_conn.send_bytes(pickle.dumps(update_dict))
-        else:
-            self.CurrentState.on_remain(logger)
-
-        next_state = self.CurrentState.get_next_state()
-        if next_state is not None:
-            self.CurrentState.on_exit(logger)
-            self.CurrentState = self.StateMachineDict[next_state]
-            self.new_state = True
-        else:
-            self.new_state = False
-
+        # All regions are updated in one pass, with the same inputs
+        for region in self.regions:
+            region.update(logger)
 
     def render(self, filename=None):
         import pygraphviz
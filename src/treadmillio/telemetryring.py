@@ -0,0 +1,171 @@
+import struct
+import numpy as np
+
+from treadmillio.statusboard import create_shared_memory, release_shared_memory, attach_shared_memory
+
+# Shared memory ring holding the last `capacity` ticks of data from the IO
+# module, for local consumers (VR renderer, viewers, online analysis). Readers
+# map the block and copy records out directly - there are no syscalls or
+# serialization on either side.
+#
+#   bytes 0-7   : number of ticks written so far (uint64)
+#   bytes 8-15  : capacity of the ring (uint64)
+#   bytes 64-   : `capacity` records of TELEMETRY_DTYPE
+#
+# Each record carries its own sequence number (seqlock). Tick n is written
+# to slot n % capacity, whose sequence number is 2n+1 while it is being
+# written and 2n+2 once it is complete. A reader which copies a slot checks
+# that the sequence number is 2n+2 both in its copy and after the copy.
+
+TELEMETRY_RING_NAME = 'treadmillio_telemetry'
+
+TELEMETRY_DTYPE = np.dtype([('Sequence', '<u8'),
+                            ('MasterTime', '<u4'),
+                            ('GPIO', '<u2'),
+                            ('AuxGPIO', '<u2'),
+                            ('Pos', '<f8'),
+                            ('UnwrappedPos', '<f8'),
+                            ('Velocity', '<f8')])
+
+_HEADER = struct.Struct('<QQ')
+_COUNT = struct.Struct('<Q')
+_SEQUENCE = struct.Struct('<Q')
+_DATA = struct.Struct('<IHHddd')
+_RECORDS_OFFSET = 64
+
+assert(_SEQUENCE.size + _DATA.size == TELEMETRY_DTYPE.itemsize)
+
+
+class TelemetryRing():
+    def __init__(self, name=TELEMETRY_RING_NAME, capacity=5000, replace=False):
+        """Writer side of the telemetry ring.
+
+        Args:
+            name: Name of the shared memory block.
+            capacity: Number of ticks kept in the ring (5000 ticks is 10 s at 500 Hz).
+            replace: Replace an existing block with this name (see statusboard.create_shared_memory()).
+        """
+        self.name = name
+        self.capacity = capacity
+        self._shm = create_shared_memory(name, _RECORDS_OFFSET + capacity * TELEMETRY_DTYPE.itemsize, replace)
+        self._buf = self._shm.buf
+        self._records = np.ndarray((capacity,), dtype=TELEMETRY_DTYPE, buffer=self._buf, offset=_RECORDS_OFFSET)
+        self._count = 0
+        _HEADER.pack_into(self._buf, 0, self._count, self.capacity)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, master_time, gpio, aux_gpio, pos, unwrapped_pos, velocity):
+        buf = self._buf
+        n = self._count
+        offset = _RECORDS_OFFSET + (n % self.capacity) * TELEMETRY_DTYPE.itemsize
+        _SEQUENCE.pack_into(buf, offset, 2*n + 1) # odd - write in progress
+        _DATA.pack_into(buf, offset + _SEQUENCE.size, master_time, gpio, aux_gpio, pos, unwrapped_pos, velocity)
+        _SEQUENCE.pack_into(buf, offset, 2*n + 2)
+        self._count = n + 1
+        _COUNT.pack_into(buf, 0, self._count)
+
+    def write_many(self, master_time, gpio, aux_gpio, pos, unwrapped_pos, velocity):
+        """Write a batch of ticks (e.g., a catch-up batch) in one pass.
+
+        Arguments are arrays with one element per tick, in order (aux_gpio may
+        be a scalar). If there are more ticks than the ring holds, only the
+        last `capacity` are written.
+        """
+        n_ticks = len(master_time)
+        first = self._count
+        end = first + n_ticks
+        skip = max(0, n_ticks - self.capacity) # would be overwritten within this batch anyway
+        ticks = np.arange(first + skip, end, dtype=np.uint64)
+        slots = ticks % np.uint64(self.capacity)
+        records = self._records
+        records['Sequence'][slots] = 2*ticks + 1 # odd - write in progress
+        records['MasterTime'][slots] = master_time[skip:]
+        records['GPIO'][slots] = gpio[skip:]
+        records['AuxGPIO'][slots] = aux_gpio if np.ndim(aux_gpio) == 0 else aux_gpio[skip:]
+        records['Pos'][slots] = pos[skip:]
+        records['UnwrappedPos'][slots] = unwrapped_pos[skip:]
+        records['Velocity'][slots] = velocity[skip:]
+        records['Sequence'][slots] = 2*ticks + 2
+        self._count = end
+        _COUNT.pack_into(self._buf, 0, self._count)
+
+    def close(self):
+        if self._buf is not None:
+            self._records = None
+            self._buf.release()
+            self._buf = None
+            release_shared_memory(self._shm)
+
+
+class TelemetryReader():
+    def __init__(self, name=TELEMETRY_RING_NAME):
+        """Read-only view of a TelemetryRing written by another process.
+
+        Raises FileNotFoundError if no ring with this name exists.
+        """
+        self.name = name
+        self._shm = attach_shared_memory(name)
+        self._buf = self._shm.buf
+        _, self.capacity = _HEADER.unpack_from(self._buf, 0)
+        self._records = np.ndarray((self.capacity,), dtype=TELEMETRY_DTYPE, buffer=self._buf, offset=_RECORDS_OFFSET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    @property
+    def count(self):
+        """Number of ticks written so far."""
+        return _COUNT.unpack_from(self._buf, 0)[0]
+
+    def read_since(self, count=0, max_records=None):
+        """Copy the ticks written after the first `count` ticks.
+
+        Ticks which have already been overwritten (or are overwritten while
+        they are copied) are dropped, so check the MasterTime of the result
+        if gaps matter.
+
+        Args:
+            count: Number of ticks already consumed (the count returned by the previous call).
+            max_records: If given, only the most recent `max_records` ticks are returned.
+
+        Returns:
+            records: Structured array of TELEMETRY_DTYPE.
+            count: Value of `count` for the next call.
+        """
+        end = self.count
+        start = max(count, end - self.capacity)
+        if max_records is not None:
+            start = max(start, end - max_records)
+        ticks = np.arange(start, end, dtype=np.uint64)
+        slots = ticks % np.uint64(self.capacity)
+        records = self._records[slots] # copy
+        expected = 2*ticks + 2
+        valid = (records['Sequence'] == expected) & (self._records['Sequence'][slots] == expected)
+        if not valid.all():
+            records = records[valid]
+        return records, end
+
+    def latest(self):
+        """Most recent tick (a record of TELEMETRY_DTYPE), or None if nothing has been written."""
+        for _ in range(1000):
+            records, _ = self.read_since(max_records=1)
+            if len(records):
+                return records[0]
+            elif self.count == 0:
+                return None
+        raise(RuntimeError('Could not get a consistent read of telemetry ring {}.'.format(self.name)))
+
+    def close(self):
+        if self._buf is not None:
+            self._records = None
+            self._buf.release()
+            self._buf = None
+            self._shm.close()
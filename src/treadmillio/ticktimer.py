@@ -0,0 +1,163 @@
+import time
+
+
+class TimingHistogram():
+    # Log-linear ("HDR"-style) histogram of integer durations in ns. Values
+    # below 2**SUB_BUCKET_BITS get their own bucket, above that each power
+    # of two is split into 2**(SUB_BUCKET_BITS-1) buckets, so the relative
+    # error of a recorded value is at most ~6%.
+    SUB_BUCKET_BITS = 5
+    MAX_VALUE_BITS = 36 # ~68 s. Longer durations are clamped to the last bucket.
+
+    _half = 1 << (SUB_BUCKET_BITS - 1)
+    NUM_BUCKETS = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 2) * _half
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def bucket_index(cls, value):
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        index = (shift * cls._half) + (value >> shift)
+        return min(index, cls.NUM_BUCKETS - 1)
+
+    @classmethod
+    def bucket_value(cls, index):
+        """Lowest value which falls into bucket `index`."""
+        if index < (2 * cls._half):
+            return index
+        shift = index // cls._half - 1
+        return (index - shift * cls._half) << shift
+
+    def record(self, value):
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p, counts=None, count=None):
+        if counts is None:
+            counts, count = self.counts, self.count
+        if count == 0:
+            return 0
+        target = p / 100 * count
+        cumulative = 0
+        for index, c in enumerate(counts):
+            cumulative += c
+            if cumulative >= target and c > 0:
+                return self.bucket_value(index)
+        return self.max
+
+
+class TickTimer():
+    def __init__(self, stages, tick_budget=2.0, snapshot_interval=None, snapshot_writer=None, sink=None, summary_file=None):
+        """Always-on timing of each stage of the main loop.
+
+        Call lap(stage) after each stage of the loop and end_tick() at the
+        end of each iteration. Every call records the time since the previous
+        one into the histogram of that stage.
+
+        Args:
+            stages: List of stage names (in loop order).
+            tick_budget: Processing time per tick (ms). Ticks whose processing,
+                         i.e., everything but waiting in read_data, takes longer
+                         are counted as overruns.
+            snapshot_interval: Interval (ms of MasterTime) at which per-stage
+                               statistics for the preceding interval are logged.
+            snapshot_writer: Object with a writerow() method used for snapshots.
+            sink: Optional LogSink. If given, snapshot statistics are computed
+                  and written on its writer thread, and the summary includes
+                  the number of log writes it dropped.
+            summary_file: Optional file name to which the summary is written
+                          at exit (it is always printed).
+        """
+        self.stages = list(stages)
+        self.histograms = {stage: TimingHistogram() for stage in self.stages}
+        self.histograms['tick'] = TimingHistogram() # processing time of whole tick (excluding read_data)
+
+        self.tick_budget = int(tick_budget * 1e6) # ns
+        self.overruns = 0
+
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_writer = snapshot_writer
+        self._sink = sink
+        self.summary_file = summary_file
+        self._next_snapshot = None
+        self._snapshot_counts = {name: (list(h.counts), h.count) for name, h in self.histograms.items()}
+
+        self._last = time.perf_counter_ns()
+        self._tick_start = self._last
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        summary = self.summary()
+        print(summary)
+        if self.summary_file:
+            with open(self.summary_file, 'w') as f:
+                print(summary, file=f)
+
+    def lap(self, stage):
+        now = time.perf_counter_ns()
+        self.histograms[stage].record(now - self._last)
+        self._last = now
+        if stage == 'read_data': # processing for this tick begins when data arrives
+            self._tick_start = now
+
+    def end_tick(self, master_time=None):
+        now = time.perf_counter_ns()
+        tick_time = now - self._tick_start
+        self.histograms['tick'].record(tick_time)
+        if tick_time > self.tick_budget:
+            self.overruns += 1
+
+        if self.snapshot_interval and (master_time is not None):
+            if self._next_snapshot is None:
+                self._next_snapshot = master_time + self.snapshot_interval
+            elif master_time >= self._next_snapshot:
+                self._next_snapshot += self.snapshot_interval
+                self.snapshot(master_time)
+
+        self._last = time.perf_counter_ns() # don't charge the snapshot to the next stage
+
+    def snapshot(self, master_time):
+        # Copy the counts here, but do the (comparatively slow) statistics elsewhere if we can
+        current_counts = {name: (list(h.counts), h.count) for name, h in self.histograms.items()}
+        previous_counts = self._snapshot_counts
+        self._snapshot_counts = current_counts
+        if self._sink:
+            self._sink.submit(self._write_snapshot, master_time, current_counts, previous_counts)
+        else:
+            self._write_snapshot(master_time, current_counts, previous_counts)
+
+    def _write_snapshot(self, master_time, current_counts, previous_counts):
+        if not self.snapshot_writer:
+            return
+        for name, (counts, count) in current_counts.items():
+            previous, previous_count = previous_counts[name]
+            interval_counts = [c - p for c, p in zip(counts, previous)]
+            interval_count = count - previous_count
+            h = self.histograms[name]
+            self.snapshot_writer.writerow([master_time, name, interval_count] +
+                [h.percentile(p, interval_counts, interval_count) / 1000 for p in [50, 90, 99, 100]])
+
+    def summary(self):
+        lines = ['Tick timing (us):',
+                 '{:>20} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'count', 'mean', 'p50', 'p99', 'p99.9', 'max')]
+        for name, h in self.histograms.items():
+            mean = h.total / h.count if h.count else 0
+            lines.append('{:>20} {:>10} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                name, h.count, mean / 1000, h.percentile(50) / 1000, h.percentile(99) / 1000,
+                h.percentile(99.9) / 1000, h.max / 1000))
+        lines.append('Ticks over the {:.1f} ms budget: {}'.format(self.tick_budget / 1e6, self.overruns))
+        if self._sink: # (so that the session directory records any log data which is missing)
+            lines.append('Log writes dropped: {} (backlog of {} writes reached {} times, max backlog {})'.format(
+                self._sink.dropped_writes, self._sink.max_backlog, self._sink.backlog_alarms, self._sink.max_backlog_seen))
+        return '\n'.join(lines)
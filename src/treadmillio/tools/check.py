@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+import argparse
+import yaml
+
+from treadmillio.statemachinecheck import check_config, DEFAULT_CACHE_DIR
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the StateMachine of a TreadmillIO configuration file '
+                                                 '(states, transitions, GPIOs and sounds) without running it.')
+    parser.add_argument('param_file', help='YAML configuration file.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Check the configuration even if an unchanged one was checked before.')
+    args = parser.parse_args()
+
+    with open(args.param_file, 'r') as f:
+        Config = yaml.safe_load(f)
+
+    if 'StateMachine' not in Config:
+        parser.exit(0, 'No StateMachine in {}.\n'.format(args.param_file))
+
+    check = check_config(Config, cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR)
+    print(check.report())
+    if not check.ok:
+        parser.exit(1, '{} error(s).\n'.format(len(check.errors)))
+
+
+if __name__ == '__main__':
+    main()
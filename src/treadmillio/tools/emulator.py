@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import time
+import argparse
+import yaml
+
+from treadmillio.serialinterfacesimulator import FirmwareEmulator, SyntheticSource, DataLogSource
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate a TreadmillIO module on a pseudo-terminal '
+                                     '(for testing run-treadmillio without hardware).')
+    parser.add_argument('--datalog', default=None,
+                        help='Play the encoder and GPIO data of a recorded session (DataLog.csv or DataLog.bin) '
+                        'instead of synthetic data.')
+    parser.add_argument('--no-loop', action='store_true',
+                        help='Stop at the end of the recorded session (rather than starting over).')
+    parser.add_argument('--config', default=None,
+                        help='Task configuration, to take WheelDiameter and EncoderGain from the Maze section.')
+    parser.add_argument('--speed', type=float, default=20.0,
+                        help='Running speed (cm/s) of the synthetic animal.')
+    parser.add_argument('--run-duration', type=float, default=5.0,
+                        help='Mean duration (s) of running bouts.')
+    parser.add_argument('--stop-duration', type=float, default=2.0,
+                        help='Mean duration (s) of stops.')
+    parser.add_argument('--lick-pin', type=int, default=None,
+                        help='DIO pin (1-12) of the synthetic lick sensor.')
+    parser.add_argument('--lick-rate', type=float, default=4.0,
+                        help='Rate (Hz) of licks while stopped.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed of the synthetic data.')
+    parser.add_argument('--latency', type=int, default=0,
+                        help='Time (ms) between receiving a command and the change of the outputs.')
+    parser.add_argument('--link', default=None,
+                        help='Create a symlink to the pseudo-terminal (e.g., /tmp/treadmill).')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Stop after this many seconds.')
+    parser.add_argument('--spin', type=float, default=0.0,
+                        help='Busy-wait for the last SPIN ms before each packet (reduces jitter).')
+    args = parser.parse_args()
+
+    if args.datalog:
+        source = DataLogSource(args.datalog, loop=not args.no_loop)
+    else:
+        maze_config = {}
+        if args.config:
+            with open(args.config, 'r') as f:
+                maze_config = (yaml.safe_load(f) or {}).get('Maze', {}) or {}
+        source = SyntheticSource(speed=args.speed, run_duration=args.run_duration, stop_duration=args.stop_duration,
+                                 lick_pin=args.lick_pin, lick_rate=args.lick_rate,
+                                 wheel_diameter=maze_config.get('WheelDiameter', 20.2),
+                                 encoder_gain=maze_config.get('EncoderGain', 4096.0), seed=args.seed)
+
+    with FirmwareEmulator(source, latency=args.latency, link=args.link, spin=args.spin / 1000) as emulator:
+        print('Emulating a TreadmillIO module on {}{} (run-treadmillio -P {}).'.format(
+            emulator.port, ' ({})'.format(args.link) if args.link else '', args.link or emulator.port))
+        start = time.perf_counter()
+        try:
+            emulator.run(args.duration)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.perf_counter() - start
+        print('Sent {} packets in {:.1f} s ({} dropped, {} commands received). Max lateness {:.2f} ms.'.format(
+            emulator.packets_sent, elapsed, emulator.packets_dropped, emulator.commands_received,
+            emulator.max_lateness * 1000))
+
+
+if __name__ == "__main__":
+    main()
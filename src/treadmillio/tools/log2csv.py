@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import os
+import csv
+import argparse
+
+from treadmillio.binarylog import load_log, read_log_header
+
+def convert_log(input_file, output_file, chunk_length=100000):
+    data, info = load_log(input_file)
+
+    with open(output_file, 'w', newline='') as f:
+        # Reproduce the header lines of the CSV logs written by run_treadmillio
+        print('{}\n   Version {}'.format(info.get('Description', 'Log File.'), info.get('Version', 'unknown version')), file=f)
+        writer = csv.writer(f)
+        if 'Events' in info: # state machine log - write names rather than ids
+            from treadmillio.statemachinelog import event_rows
+            writer.writerows(event_rows(data, info))
+            return len(data)
+        for start in range(0, len(data), chunk_length):
+            chunk = data[start:start+chunk_length]
+            columns = []
+            for name in data.dtype.names:
+                if name == 'Input' and 'Inputs' in info: # input log - write names rather than ids
+                    columns.append([info['Inputs'][idx] for idx in chunk[name].tolist()])
+                elif chunk[name].dtype == 'f4':
+                    columns.append(chunk[name].astype(str)) # shortest repr of the float32, not of its float64 conversion
+                else:
+                    columns.append(chunk[name].tolist())
+            writer.writerows(zip(*columns))
+
+    return len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert TreadmillIO binary log files (e.g., DataLog.bin, StatemachineLog.bin or InputLog.bin) to CSV.')
+    parser.add_argument('log_files', nargs='+',
+                        help='Binary log file(s) to convert.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output file name (defaults to the input file name with a .csv extension). '
+                        'Only valid when converting a single file.')
+    args = parser.parse_args()
+
+    if args.output and len(args.log_files) > 1:
+        parser.error('--output can only be used when converting a single file.')
+
+    for log_file in args.log_files:
+        output_file = args.output if args.output else os.path.splitext(log_file)[0] + '.csv'
+        n_records = convert_log(log_file, output_file)
+        print('Wrote {} records from {} to {}.'.format(n_records, log_file, output_file))
+        with open(log_file, 'rb') as f:
+            info, _ = read_log_header(f)
+        if info.get('DroppedRecords'):
+            print('   {} records were dropped while logging ({} gaps - see the Gaps entry of the header).'.format(
+                info['DroppedRecords'], len(info.get('Gaps', []))))
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,8 @@ import warnings
 
 from contextlib import ExitStack
 
+from treadmillio import randomstreams
+
 
 NamedVersion = '1.0'
 
@@ -76,14 +78,15 @@ if 'EnableSound' in Config['Preferences']:
 
 # Check for random seed on command line or in preferences
 if args.random_seed is not None:
-    np.random.seed(int(args.random_seed))
+    np.random.seed(int(args.random_seed) % 2**32) # (legacy global stream)
     print(f'Setting random seed to {args.random_seed}.')
     if 'RandomSeed' in Config['Preferences']:
         Config['Preferences']['RandomSeed'] = int(args.random_seed)
         print('Overwriting random seed in preferences file (true value will be logged).')
 elif 'RandomSeed' in Config['Preferences']:
-    np.random.seed(Config['Preferences']['RandomSeed'])
+    np.random.seed(int(Config['Preferences']['RandomSeed']) % 2**32)
     print(f"Setting random seed to {Config['Preferences']['RandomSeed']}.")
+randomstreams.seed(Config['Preferences'].get('RandomSeed', None))
 
 
 
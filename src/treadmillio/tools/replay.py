@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import io
+import os
+import csv
+import sys
+import time
+import argparse
+import yaml
+import numpy as np
+
+from importlib.metadata import version, PackageNotFoundError
+
+from treadmillio.replay import SessionReplay
+from treadmillio.binarylog import BinaryLogWriter
+from treadmillio.statemachinelog import STATEMACHINELOG_DTYPE, load_statemachine_log, event_rows
+
+LOG_FILES = {'RewardZones': ('RewardzoneLog.csv', 'Reward Zone Log File.')}
+STATE_LOG_FILE = 'StatemachineLog.bin'
+LEGACY_STATE_LOG_FILE = 'StatemachineLog.csv' # (ragged rows of earlier versions)
+
+
+def read_log_rows(f, n_header_lines=2):
+    for _ in range(n_header_lines):
+        f.readline()
+    return list(csv.reader(f))
+
+
+def legacy_state_log_rows(rows):
+    """(MasterTime, event) of the rows of a StatemachineLog.csv, as written by earlier versions."""
+    return [[row[0], row[5]] for row in rows]
+
+
+def legacy_event_rows(events, info):
+    """(MasterTime, event) of state machine events, with one row per state entrance (as in earlier versions)."""
+    rows = []
+    last = None
+    for master_time, event, state in zip(events['MasterTime'].tolist(), events['Event'].tolist(),
+                                         events['State'].tolist()):
+        if (master_time, event, state) != last:
+            rows.append([str(master_time), info['Events'][event]])
+        last = (master_time, event, state)
+    return rows
+
+
+def diff_logs(original, replayed, max_differences=10):
+    """Compare the rows of two logs. Returns a list of (row number, original row, replayed row)."""
+    differences = []
+    for idx in range(max(len(original), len(replayed))):
+        original_row = original[idx] if idx < len(original) else None
+        replayed_row = replayed[idx] if idx < len(replayed) else None
+        if original_row != replayed_row:
+            differences.append((idx, original_row, replayed_row))
+            if len(differences) >= max_differences:
+                break
+    return differences
+
+
+def main():
+    try:
+        __version__ = version("treadmillio")
+    except PackageNotFoundError:
+        __version__ = "unknown version"
+
+    parser = argparse.ArgumentParser(description='Replay a recorded TreadmillIO session through the task logic '
+                                     '(faster than real time) and compare the logs it generates with the originals.')
+    parser.add_argument('log_directory',
+                        help='Directory of the recorded session (with ParsedConfig.yaml and DataLog.csv or DataLog.bin).')
+    parser.add_argument('--config', default=None,
+                        help='Configuration file to replay with (defaults to the ParsedConfig.yaml of the session).')
+    parser.add_argument('-R', '--random-seed', default=None,
+                        help='Random seed (defaults to the RandomSeed preference of the session).')
+    parser.add_argument('--max-ticks', type=int, default=None,
+                        help='Only replay this many ticks.')
+    parser.add_argument('--output-dir', default=None,
+                        help='Directory to write the replayed StatemachineLog.bin and RewardzoneLog.csv.')
+    parser.add_argument('--timing', action='store_true',
+                        help='Measure the time taken by each stage of the loop.')
+    args = parser.parse_args()
+
+    config_file = args.config if args.config else os.path.join(args.log_directory, 'ParsedConfig.yaml')
+    with open(config_file, 'r') as f:
+        Config = yaml.safe_load(f)
+
+    datalog = os.path.join(args.log_directory, 'DataLog.bin')
+    if not os.path.exists(datalog):
+        datalog = os.path.join(args.log_directory, 'DataLog.csv')
+
+    replay = SessionReplay(Config, datalog, args.random_seed)
+
+    logs = {}
+    for section, (log_file, description) in LOG_FILES.items():
+        if section in Config:
+            buffer = io.StringIO(newline='')
+            logs[log_file] = (buffer, csv.writer(buffer), description)
+    state_events = [] if 'StateMachine' in Config else None
+    state_logger = state_events.append if state_events is not None else None
+    reward_zone_logger = logs['RewardzoneLog.csv'][1].writerow if 'RewardzoneLog.csv' in logs else None
+
+    timer = None
+    if args.timing:
+        from treadmillio.ticktimer import TickTimer
+        timer = TickTimer(['read_data', 'update_pulses', 'update_beeps', 'update_statemachine',
+                           'update_localized', 'update_reward_zones', 'flush_commands'])
+
+    start = time.perf_counter()
+    n_ticks = replay.run(state_logger, reward_zone_logger, timer, args.max_ticks)
+    elapsed = time.perf_counter() - start
+    print('Replayed {} ticks ({:.1f} s of session time) in {:.2f} s: {:.0f} ticks/s ({:.1f}x real time).'.format(
+        n_ticks, n_ticks * 0.002, elapsed, n_ticks / elapsed, n_ticks * 0.002 / elapsed))
+    if timer:
+        print(timer.summary())
+
+    if state_events is not None:
+        state_events = np.array(state_events, dtype=STATEMACHINELOG_DTYPE)
+        state_log_info = replay.StateMachine.log_info()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        if state_events is not None:
+            with BinaryLogWriter(os.path.join(args.output_dir, STATE_LOG_FILE), STATEMACHINELOG_DTYPE,
+                                 Description='State Machine Log File. (Replay of {})'.format(args.log_directory),
+                                 Version=__version__, **state_log_info) as writer:
+                for event in state_events.tolist():
+                    writer.writerow(event)
+        for log_file, (buffer, _, description) in logs.items():
+            with open(os.path.join(args.output_dir, log_file), 'w', newline='') as f:
+                print('{} (Replay of {})\n   Version {}'.format(description, args.log_directory, __version__), file=f)
+                f.write(buffer.getvalue())
+
+    compared = []
+    if state_events is not None:
+        # Compare everything but the latencies (or, for logs of earlier versions, the times and kinds of events)
+        if os.path.exists(os.path.join(args.log_directory, STATE_LOG_FILE)):
+            original_events, original_info = load_statemachine_log(os.path.join(args.log_directory, STATE_LOG_FILE))
+            compared.append((STATE_LOG_FILE, event_rows(original_events, original_info, latency=False),
+                             event_rows(state_events, state_log_info, latency=False)))
+        elif os.path.exists(os.path.join(args.log_directory, LEGACY_STATE_LOG_FILE)):
+            with open(os.path.join(args.log_directory, LEGACY_STATE_LOG_FILE), newline='') as f:
+                original = legacy_state_log_rows(read_log_rows(f))
+            compared.append((LEGACY_STATE_LOG_FILE, original, legacy_event_rows(state_events, state_log_info)))
+        else:
+            print('{}: no original to compare with.'.format(STATE_LOG_FILE))
+
+    for log_file, (buffer, _, _) in logs.items():
+        original_file = os.path.join(args.log_directory, log_file)
+        if not os.path.exists(original_file):
+            print('{}: no original to compare with.'.format(log_file))
+            continue
+        with open(original_file, newline='') as f:
+            original = read_log_rows(f)
+        buffer.seek(0)
+        compared.append((log_file, original, list(csv.reader(buffer))))
+
+    all_match = True
+    for log_file, original, replayed in compared:
+        if args.max_ticks is not None: # only compare the part of the session which was replayed
+            original = original[:len(replayed)]
+        differences = diff_logs(original, replayed)
+        if not differences:
+            print('{}: {} rows match.'.format(log_file, len(original)))
+        else:
+            all_match = False
+            print('{}: replay differs ({} original rows, {} replayed rows). First differences:'.format(
+                log_file, len(original), len(replayed)))
+            for idx, original_row, replayed_row in differences:
+                print('  row {}:\n    original: {}\n    replayed: {}'.format(idx, original_row, replayed_row))
+
+    sys.exit(0 if all_match else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,14 @@ import os
 import shutil
 import argparse
 import yaml
-import csv
 import zmq
 import numpy as np
 import warnings
 
 from contextlib import ExitStack
 
+from treadmillio import randomstreams
+
 from importlib.metadata import version, PackageNotFoundError
 
 def main():
@@ -23,9 +24,6 @@ def main():
     if (__version__.split('.')[-1] == 'dirty'):
         raise(ValueError('Refusing to run because git state is dirty.'))
 
-
-    Profiling = False
-
     ### Maybe should add argcomplete for this program?
 
     # Command-line arguments: computer settings
@@ -41,6 +39,9 @@ def main():
                         help='Directory to write output file (defaults to cwd)')
     parser.add_argument('--no-check-space', default=None,
                         help='Exits if less than 10 GB of space is available.')
+    parser.add_argument('--replace-shared-memory', action='store_true',
+                        help='Replace the status board and telemetry ring blocks if they already exist '
+                        '(left over from a crashed session). Otherwise, existing blocks are an error.')
 
 
     args = parser.parse_args()
@@ -55,6 +56,14 @@ def main():
         from treadmillio.soundstimulus import validate_sound_config
         validate_sound_config(Config['AuditoryStimuli'])
 
+    if 'StateMachine' in Config and Config['Preferences'].get('CheckStateMachine', True):
+        from treadmillio.statemachinecheck import check_config
+        check = check_config(Config) # (cached by a hash of the config)
+        for warning in check.warnings:
+            warnings.warn('StateMachine: ' + warning, RuntimeWarning)
+        if not check.ok:
+            raise(ValueError('StateMachine configuration has errors:\n  ' + '\n  '.join(check.errors)))
+
     # ------------------- Setup logging. ------------------------------------------------------------------
     DoLogCommands = Config['Preferences'].get('LogCommands', True)
 
@@ -110,19 +119,23 @@ def main():
 
     # Check for random seed on command line or in preferences
     if args.random_seed is not None:
-        np.random.seed(int(args.random_seed))
+        np.random.seed(int(args.random_seed) % 2**32) # (legacy global stream)
         print(f'Setting random seed to {args.random_seed}.')
         if 'RandomSeed' in Config['Preferences']:
-            Config['Preferences']['RandomSeed'] = int(args.random_seed)
             print('Overwriting random seed in preferences file (true value will be logged).')
+        Config['Preferences']['RandomSeed'] = int(args.random_seed)
     elif 'RandomSeed' in Config['Preferences']:
-        np.random.seed(Config['Preferences']['RandomSeed'])
+        np.random.seed(int(Config['Preferences']['RandomSeed']) % 2**32)
         print(f"Setting random seed to {Config['Preferences']['RandomSeed']}.")
+    # Each component (delays, random transitions, ...) draws from its own stream derived from the seed.
+    # Without a seed, fresh entropy is used and logged (in ParsedConfig.yaml) so that the session can be replayed.
+    Config['Preferences']['RandomSeed'] = randomstreams.seed(Config['Preferences'].get('RandomSeed', None))
 
 
     with ExitStack() as stack:
         # --------------  Initialize Serial IO - Won't actually do anything until we call connect()! --------------------------
         from treadmillio.serialinterface import SerialInterface
+        from treadmillio.telemetryring import TELEMETRY_RING_NAME
 
         gpio_config = Config.get('GPIO', None)
         if not gpio_config:
@@ -134,20 +147,27 @@ def main():
             zmq_streaming = Config['Preferences'].get('DataStreamingPort', None)
         
         Interface = stack.enter_context(SerialInterface(SerialPort=args.serial_port, gpio_config=gpio_config, 
-                                                        maze_config=maze_config, zmq_streaming=zmq_streaming))
+                                                        maze_config=maze_config, zmq_streaming=zmq_streaming,
+                                                        catch_up=Config['Preferences'].get('SerialCatchUp', False),
+                                                        telemetry_ring=Config['Preferences'].get('TelemetryRing', TELEMETRY_RING_NAME),
+                                                        telemetry_ring_length=Config['Preferences'].get('TelemetryRingLength', 5000),
+                                                        replace_telemetry_ring=args.replace_shared_memory,
+                                                        coalesce_commands=Config['Preferences'].get('CoalesceCommands', True),
+                                                        blocking_commands=Config['Preferences'].get('BlockingCommandWrites', False),
+                                                        reader_thread=Config['Preferences'].get('SerialReaderThread', False),
+                                                        reader_ring_length=Config['Preferences'].get('SerialReaderRingLength', 5000)))
 
         #----------------------- Sound stimuli --------------
         if 'AuditoryStimuli' in Config and EnableSound:
             from treadmillio.soundstimulus import SoundStimulusController
             SoundController = stack.enter_context(SoundStimulusController(Config['AuditoryStimuli'], Interface.virtual_track_length, 
-                                                Interface.maze_topology, log_directory))
+                                                Interface.maze_topology, log_directory, scheduler=Interface.scheduler))
         else:
             SoundController = None
             if 'AuditoryStimuli' in Config:
                 warnings.warn("Config file specified AuditoryStimuli, but EnableSound is False.", RuntimeWarning)
 
 
-            # BUG: Should check to make sure states are all connected properly?
         # ------------------- Read in State Machine States. ------------------------------------------------------------------
         if 'StateMachine' in Config:
             from treadmillio.taskstatemachine import TaskStateMachine
@@ -172,29 +192,55 @@ def main():
             # Log config file used
             with open(os.path.join(log_directory, 'ParsedConfig.yaml'), 'w') as yaml_file:
                 yaml.dump(Config, yaml_file, indent=4)
+
+            # All log files are written from a separate thread so that disk IO can't stall the main loop
+            from treadmillio.logsink import LogSink
+            Sink = stack.enter_context(LogSink(flush_interval=Config['Preferences'].get('LogFlushInterval', 1000),
+                                               fsync=Config['Preferences'].get('LogFsync', False),
+                                               max_backlog=Config['Preferences'].get('LogMaxBacklog', 10000)))
                 
             # Create data log file and write header
-            log_file = stack.enter_context(open(os.path.join(log_directory, 'DataLog.csv'), 'w', newline=''))
-            print(f'Experiment Data File.\n   Version {__version__}',file=log_file)
-            log_writer = csv.writer(log_file) # logging is actually CSV format
+            DataLogFormat = Config['Preferences'].get('DataLogFormat', 'Binary')
+            if DataLogFormat == 'Binary':
+                from treadmillio.binarylog import BinaryLogWriter, DATALOG_DTYPE
+                # Use the treadmillio-log2csv tool to convert to the CSV format
+                log_writer = stack.enter_context(BinaryLogWriter(os.path.join(log_directory, 'DataLog.bin'), DATALOG_DTYPE,
+                                                    sink=Sink, Description='Experiment Data File.', Version=__version__))
+            elif DataLogFormat == 'CSV':
+                log_writer = Sink.open_csv(os.path.join(log_directory, 'DataLog.csv'),
+                                           f'Experiment Data File.\n   Version {__version__}') # logging is actually CSV format
+            else:
+                raise(ValueError("Unknown DataLogFormat {}. Currently implemented: 'Binary' or 'CSV'.".format(DataLogFormat)))
 
 
             if StateMachine and DoLogCommands:
-                # Create state machine log file and write header
-                state_machine_log = stack.enter_context(open(os.path.join(log_directory, 'StatemachineLog.csv'), 'w', newline=''))
-                print(f'State Machine Log File.\n   Version {__version__}',file=state_machine_log)
-                state_log_writer = csv.writer(state_machine_log)
+                # Create state machine event log (binary, typed records - see statemachinelog.py)
+                from treadmillio.binarylog import BinaryLogWriter
+                from treadmillio.statemachinelog import STATEMACHINELOG_DTYPE
+                # (events are rare, so each one is handed to the sink as soon as it's logged)
+                state_log_writer = stack.enter_context(BinaryLogWriter(os.path.join(log_directory, 'StatemachineLog.bin'),
+                                                    STATEMACHINELOG_DTYPE, block_length=1, sink=Sink,
+                                                    Description='State Machine Log File.', Version=__version__,
+                                                    **StateMachine.log_info()))
+
+            if Interface.inputs.names:
+                # Create input log (debounced onsets and offsets of the GPIO inputs, e.g., licks)
+                from treadmillio.binarylog import BinaryLogWriter
+                from treadmillio.gpioinputs import INPUTLOG_DTYPE
+                input_log_writer = stack.enter_context(BinaryLogWriter(os.path.join(log_directory, 'InputLog.bin'),
+                                                    INPUTLOG_DTYPE, block_length=100, sink=Sink,
+                                                    Description='GPIO Input Log File.', Version=__version__,
+                                                    **Interface.inputs.log_info()))
+                Interface.inputs.subscribe(input_log_writer.writerow)
 
             if RewardZones and DoLogCommands:
-                # Create state machine log file and write header
-                reward_zone_log = stack.enter_context(open(os.path.join(log_directory, 'RewardzoneLog.csv'), 'w', newline='', buffering=1))
-                print(f'Reward Zone Log File.\n   Version {__version__}',file=reward_zone_log)
-                reward_zone_writer = csv.writer(reward_zone_log)
-
+                # Create reward zone log file and write header
+                reward_zone_writer = Sink.open_csv(os.path.join(log_directory, 'RewardzoneLog.csv'),
+                                                   f'Reward Zone Log File.\n   Version {__version__}')
 
-            if Profiling:
-                execution_log = stack.enter_context(open(os.path.join(log_directory, 'execution.csv'), 'w', newline=''))
-                execution_writer = csv.writer(execution_log)
+            # Periodic snapshots of how long each stage of the main loop takes
+            timing_writer = Sink.open_csv(os.path.join(log_directory, 'TickTimingLog.csv'),
+                                          f'Tick Timing Log File.\n   Version {__version__}')
 
         # ------------------- Webcam Video Recording. ------------------------------------------------------------------
         if 'Cameras' in Config:
@@ -229,6 +275,22 @@ def main():
 
         # TODO: Figure out how to handle errors below. The shared termination flag should work, but it doesn't
         
+        # ------------------- Status board (displayed by the treadmillio-status tool). -----------------------------------
+        from treadmillio.statusboard import StatusBoard, STATUS_BOARD_NAME
+        Status = stack.enter_context(StatusBoard(Config['Preferences'].get('StatusBoardName', STATUS_BOARD_NAME),
+                                                 refresh_interval=Config['Preferences'].get('HeartBeat', 250),
+                                                 replace=args.replace_shared_memory))
+
+        # ------------------- Main loop timing. ------------------------------------------------------------------
+        from treadmillio.ticktimer import TickTimer
+        Timer = stack.enter_context(TickTimer(['read_data', 'log_data', 'update_pulses', 'update_beeps', 
+                                               'update_statemachine', 'update_localized', 'update_reward_zones', 'flush_commands',
+                                               'publish_status'],
+                                              snapshot_interval=Config['Preferences'].get('TimingSnapshotInterval', 60000),
+                                              snapshot_writer=timing_writer if DoLogCommands else None,
+                                              sink=Sink if DoLogCommands else None,
+                                              summary_file=os.path.join(log_directory, 'TickTimingSummary.txt') if DoLogCommands else None))
+
         # ----------------- Initialization
         ##### Actually connect to IO device. We wait until here so that data doesn't get lost/confused in serial buffer
 
@@ -247,56 +309,59 @@ def main():
         while(True):
             ## every 2 ms happens:
             FlagChar, StructSize, MasterTime, Encoder, UnwrappedEncoder, GPIO, AuxGPIO = Interface.read_data()
-            last_ts = time.monotonic()   # to match with miniscope timestamps (which is written in msec, here is sec)
-                                        # since read_data() is blocking, this is a farther bound (i.e., ts AFTER) data
+            Timer.lap('read_data')
+            last_ts = Interface.last_host_time  # to match with miniscope timestamps (which is written in msec, here is sec)
+                                        # time.monotonic() when the packet was received (with SerialReaderThread,
+                                        # stamped on arrival; otherwise, when read_data() read it)
 
             if DoLogCommands:
-                if not first_sample:
-                    log_writer.writerow([MasterTime, GPIO, Encoder, UnwrappedEncoder, last_ts, Interface.pos, Interface.velocity]) # Log data from serial interface
-                else: # for ths first sample, to synchronize to a meaningful clock, we the CLOCK_REALTIME time, in the first row 
+                if first_sample: # for ths first sample, to synchronize to a meaningful clock, we the CLOCK_REALTIME time, in the first row 
                     sys_ts = time.time()
-                    log_writer.writerow([0, InitialGPIO, InitialEncoder, UnwrappedEncoder, sys_ts, 0, 0]) 
-                    log_writer.writerow([MasterTime, GPIO, Encoder, UnwrappedEncoder, last_ts, Interface.pos, Interface.velocity])
+                    log_writer.writerow((0, InitialGPIO, InitialEncoder, UnwrappedEncoder, sys_ts, 0, 0)) 
                     first_sample = False
+                # In catch-up mode, packets which were drained without being returned still get logged
+                for SkippedTime, SkippedGPIO, SkippedEncoder, SkippedUnwrappedEncoder, SkippedPos, SkippedVelocity, SkippedTs in Interface.skipped_samples:
+                    log_writer.writerow((SkippedTime, SkippedGPIO, SkippedEncoder, SkippedUnwrappedEncoder, SkippedTs, SkippedPos, SkippedVelocity))
+                log_writer.writerow((MasterTime, GPIO, Encoder, UnwrappedEncoder, last_ts, Interface.pos, Interface.velocity)) # Log data from serial interface
+            Timer.lap('log_data')
 
             # -------------------- Updates -------------------- 
-            Interface.update_pulses() # lower any outstanding GPIO pulses
+            Interface.update_pulses() # lower any outstanding GPIO pulses (and run any other deadlines which have passed)
+            Timer.lap('update_pulses')
 
             if SoundController:
-                SoundController.update_beeps(MasterTime) # stop any outstanding beeps
+                SoundController.update_beeps(MasterTime) # send the gains of beeps which have ended
+            Timer.lap('update_beeps')
 
             if StateMachine:
                 if DoLogCommands:
                     StateMachine.update_statemachine(state_log_writer.writerow) # update the state machine
                 else:
                     StateMachine.update_statemachine(None) # update the state machine
-
-            # unwrapped_pos = (UnwrappedEncoder - initialUnwrappedencoder) / encoder_gain *d *np.pi 
-            # pos = unwrapped_pos % virtual_track_length
-
-            if "Maze" in Config:
-                if (MasterTime % Config['Preferences']['HeartBeat']) == 0:
-                    print(f'Heartbeat {MasterTime} - 0x{GPIO:012b}. Pos - {Interface.pos}. Lap: {Interface.unwrapped_pos // Interface.virtual_track_length}. Speed: {Interface.velocity}')
-                    if StateMachine:
-                        print(StateMachine.CurrentState.label)
-            else:
-                if (MasterTime % Config['Preferences']['HeartBeat']) == 0:
-                    print(f'Heartbeat {MasterTime} - 0x{GPIO:012b}.')
-                    if StateMachine:
-                        print(StateMachine.CurrentState.label)
+            Timer.lap('update_statemachine')
 
             if SoundController:
                 SoundController.update_localized(Interface.pos, Interface.unwrapped_pos) # update VR-position-dependent sounds
+            Timer.lap('update_localized')
 
             if RewardZones:
                 if DoLogCommands:
                     RewardZones.update_reward_zones(MasterTime, Interface.pos, GPIO, reward_zone_writer.writerow) # update any VR-position rewards
                 else:
                     RewardZones.update_reward_zones(MasterTime, Interface.pos, GPIO) # update any VR-position rewards
+            Timer.lap('update_reward_zones')
+
+            Interface.flush_commands() # send all of the GPIO commands of this tick in one write
+            Timer.lap('flush_commands')
+
+            # The treadmillio-status tool displays this (printing here could stall the loop)
+            Status.publish(MasterTime, GPIO, Interface.pos, Interface.unwrapped_pos // Interface.virtual_track_length,
+                           Interface.velocity, StateMachine.CurrentState.label if StateMachine else None,
+                           (StateMachine.rewards if StateMachine else 0) + (RewardZones.rewards if RewardZones else 0),
+                           Timer.overruns, Interface.overruns)
+            Timer.lap('publish_status')
 
-            if Profiling and DoLogCommands:
-                exec_time = time.monotonic() - last_ts
-                execution_writer.writerow([exec_time])
+            Timer.end_tick(MasterTime)
 
 
 if __name__ == "__main__":
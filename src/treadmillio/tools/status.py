@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import time
+import argparse
+
+from treadmillio.statusboard import StatusBoardReader, STATUS_BOARD_NAME
+
+STALE_TIMEOUT = 2.0 # s without an update before we decide the session has ended
+
+
+def format_status(status):
+    return 'Heartbeat {} - 0x{:012b}. Pos - {:.2f}. Lap: {:.0f}. Speed: {:.2f}. State: {}. Rewards: {}. ' \
+           'Overruns: {} (serial {}).'.format(status['MasterTime'], status['GPIO'], status['Pos'], status['Lap'],
+                                              status['Velocity'], status['State'] or '-', status['Rewards'],
+                                              status['Overruns'], status['SerialOverruns'])
+
+
+def attach(name, wait):
+    while True:
+        try:
+            return StatusBoardReader(name)
+        except FileNotFoundError:
+            if not wait:
+                raise
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Display the status of a running TreadmillIO session.')
+    parser.add_argument('--name', default=STATUS_BOARD_NAME,
+                        help='Name of the status board (the StatusBoardName preference of the session).')
+    parser.add_argument('-i', '--interval', type=float, default=None,
+                        help='Refresh interval in ms (defaults to the HeartBeat preference of the session).')
+    parser.add_argument('--once', action='store_true',
+                        help='Print the current status once and exit.')
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait for a session to start (and for the next one after it ends).')
+    args = parser.parse_args()
+
+    try:
+        board = attach(args.name, args.wait)
+    except FileNotFoundError:
+        parser.exit(1, 'No TreadmillIO session is publishing to status board {}.\n'.format(args.name))
+
+    last_master_time = None
+    try:
+        while True:
+            interval = (args.interval if args.interval else board.refresh_interval) / 1000
+            status = board.read()
+            if status is None:
+                pass # session is starting
+            elif (time.time() - status['UpdateTime']) > STALE_TIMEOUT:
+                board.close()
+                if not args.wait:
+                    print('Session ended (last update at MasterTime {}).'.format(status['MasterTime']))
+                    break
+                time.sleep(interval)
+                board = attach(args.name, args.wait) # a new session replaces the board
+                continue
+            elif status['MasterTime'] != last_master_time:
+                print(format_status(status))
+                last_master_time = status['MasterTime']
+                if args.once:
+                    break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        board.close()
+
+
+if __name__ == "__main__":
+    main()
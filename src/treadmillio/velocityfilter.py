@@ -0,0 +1,248 @@
+import math
+import numpy as np
+
+# Velocity estimators for SerialInterface. Each filter is updated with the change in
+# position (cm) and the time step (s, from MasterTime) of every packet, and returns
+# the estimated velocity (cm/s). Updates are O(1) per sample.
+#
+# Selected with the VelocityFilter option of the Maze section, either as a name or
+# as a dictionary with a Type and parameters, e.g.:
+#
+#   Maze:
+#     VelocityFilter:
+#       Type: 'Kalman'
+#       ProcessNoise: 500.0 # cm/s^2
+
+NOMINAL_DT = 0.002 # s (500 Hz)
+
+
+class VelocityFilter():
+    def update(self, change_in_position, dt):
+        raise NotImplementedError
+
+    def update_many(self, changes_in_position, dts):
+        """Velocity after each of a batch of samples (same result as calling update() on each)."""
+        return np.array([self.update(dx, dt) for dx, dt in zip(changes_in_position.tolist(), dts.tolist())])
+
+
+class MovingAverageFilter(VelocityFilter):
+    def __init__(self, window=50):
+        """Distance travelled over the last `window` samples divided by their duration.
+
+        With a constant time step, this is the moving average of the original
+        SerialInterface (which assumed 500 Hz). The window starts out filled with
+        stationary samples.
+
+        Args:
+            window: Number of samples (50 samples is 0.1 s at 500 Hz).
+        """
+        self.window = int(window)
+        self._dx = np.zeros(self.window)
+        self._dt = np.full(self.window, NOMINAL_DT)
+        self._idx = 0
+        self._sum_dx = 0.0
+        self._sum_dt = self.window * NOMINAL_DT
+        self._updates = 0
+
+    def update(self, change_in_position, dt):
+        idx = self._idx
+        self._sum_dx += change_in_position - self._dx[idx]
+        self._sum_dt += dt - self._dt[idx]
+        self._dx[idx] = change_in_position
+        self._dt[idx] = dt
+        self._idx = (idx + 1) % self.window
+        self._updates += 1
+        if self._updates % (100 * self.window) == 0: # keep rounding errors of the running sums from accumulating
+            self._sum_dx = float(self._dx.sum())
+            self._sum_dt = float(self._dt.sum())
+        return self._sum_dx / self._sum_dt
+
+    def update_many(self, changes_in_position, dts):
+        window = self.window
+        n = len(changes_in_position)
+        history_dx = np.concatenate([np.roll(self._dx, -self._idx), changes_in_position])
+        history_dt = np.concatenate([np.roll(self._dt, -self._idx), dts])
+        cumulative_dx = np.concatenate([[0.0], np.cumsum(history_dx)])
+        cumulative_dt = np.concatenate([[0.0], np.cumsum(history_dt)])
+        velocity = (cumulative_dx[window+1:] - cumulative_dx[1:n+1]) / (cumulative_dt[window+1:] - cumulative_dt[1:n+1])
+        if n >= window:
+            self._dx[:] = history_dx[-window:]
+            self._dt[:] = history_dt[-window:]
+            self._idx = 0
+        else:
+            slots = (self._idx + np.arange(n)) % window
+            self._dx[slots] = changes_in_position
+            self._dt[slots] = dts
+            self._idx = (self._idx + n) % window
+        self._sum_dx = float(self._dx.sum())
+        self._sum_dt = float(self._dt.sum())
+        return velocity
+
+
+class ExponentialFilter(VelocityFilter):
+    def __init__(self, time_constant=50):
+        """Exponentially weighted average of the instantaneous velocity.
+
+        Args:
+            time_constant: Time constant (ms).
+        """
+        self.time_constant = time_constant / 1000
+        self.velocity = 0.0
+
+    def update(self, change_in_position, dt):
+        alpha = 1.0 - math.exp(-dt / self.time_constant)
+        self.velocity += alpha * (change_in_position / dt - self.velocity)
+        return self.velocity
+
+
+class SavitzkyGolayFilter(VelocityFilter):
+    def __init__(self, window=51, order=2):
+        """Slope at the latest sample of a polynomial fit to the positions of the last `window` samples.
+
+        The fit only needs the moments sum(i^k * position_i) (k <= order) of the
+        window, which are updated incrementally as samples enter and leave it.
+        Positions are treated as evenly spaced, at the mean time step of the window.
+
+        Args:
+            window: Number of samples.
+            order: Order of the polynomial (1 or 2).
+        """
+        if order not in (1, 2):
+            raise(ValueError('SavitzkyGolay VelocityFilter: Order must be 1 or 2 (got {}).'.format(order)))
+        if window <= order:
+            raise(ValueError('SavitzkyGolay VelocityFilter: Window must be longer than the order of the fit.'))
+        self.window = int(window)
+        self.order = order
+
+        # Least squares fit of p(i) = sum_k c_k i^k (i = 0 is the oldest sample) from the moments,
+        # and the weights which give dp/di at the latest sample.
+        i = np.arange(self.window, dtype=float)
+        X = np.vander(i, order + 1, increasing=True)
+        derivative = np.array([0.0, 1.0, 2.0 * (self.window - 1)])[:order + 1]
+        self._weights = (derivative @ np.linalg.inv(X.T @ X)).tolist()
+
+        self._positions = np.zeros(self.window) # relative to self._origin
+        self._dt = np.full(self.window, NOMINAL_DT)
+        self._idx = 0
+        self._position = 0.0
+        self._origin = 0.0
+        self._sum_dt = self.window * NOMINAL_DT
+        self._updates = 0
+        self._recompute()
+
+    def _recompute(self):
+        # Exact moments (and a new origin, so that the positions stay small)
+        positions = np.roll(self._positions, -self._idx) + self._origin - self._position
+        self._origin = self._position
+        self._positions = positions
+        self._idx = 0
+        i = np.arange(self.window, dtype=float)
+        self._moments = [float(positions.sum()), float(i @ positions), float((i * i) @ positions)]
+        self._sum_dt = float(self._dt.sum())
+
+    def update(self, change_in_position, dt):
+        window = self.window
+        idx = self._idx
+        self._position += change_in_position
+        new = self._position - self._origin
+        old = self._positions[idx]
+        self._positions[idx] = new
+        self._sum_dt += dt - self._dt[idx]
+        self._dt[idx] = dt
+        self._idx = (idx + 1) % window
+
+        # Add the new sample at i = window and drop the oldest (i = 0), then shift i down by one
+        s0, s1, s2 = self._moments
+        t0 = s0 - old + new
+        t1 = s1 + window * new
+        t2 = s2 + window * window * new
+        self._moments = [t0, t1 - t0, t2 - 2 * t1 + t0]
+
+        self._updates += 1
+        if self._updates % (100 * window) == 0:
+            self._recompute()
+
+        w = self._weights
+        slope = w[0] * self._moments[0] + w[1] * self._moments[1]
+        if self.order == 2:
+            slope += w[2] * self._moments[2]
+        return slope / (self._sum_dt / window)
+
+
+class KalmanFilter(VelocityFilter):
+    def __init__(self, process_noise=500.0, measurement_noise=None, position_resolution=math.pi * 20.2 / 4096):
+        """Kalman filter with a constant velocity model of the position.
+
+        Args:
+            process_noise: Standard deviation of the (white noise) acceleration (cm/s^2).
+            measurement_noise: Standard deviation of the position measurements (cm).
+                               Defaults to the quantization noise of one encoder step.
+            position_resolution: Position change (cm) of one encoder step.
+        """
+        self.q = process_noise ** 2
+        if measurement_noise is None:
+            self.r = position_resolution ** 2 / 12 # uniform quantization noise
+        else:
+            self.r = measurement_noise ** 2
+        self.position = 0.0 # integrated measurement
+        self.x = [0.0, 0.0] # position, velocity
+        self.P = [[1.0, 0.0], [0.0, 1.0]]
+
+    def update(self, change_in_position, dt):
+        self.position += change_in_position
+        (p00, p01), (p10, p11) = self.P
+        x0, x1 = self.x
+        q = self.q
+
+        # Predict
+        x0 = x0 + dt * x1
+        dt2 = dt * dt
+        p00 = p00 + dt * (p01 + p10) + dt2 * p11 + q * dt2 * dt2 / 4
+        p01 = p01 + dt * p11 + q * dt2 * dt / 2
+        p10 = p10 + dt * p11 + q * dt2 * dt / 2
+        p11 = p11 + q * dt2
+
+        # Correct with the measured position
+        s = p00 + self.r
+        k0 = p00 / s
+        k1 = p10 / s
+        innovation = self.position - x0
+        x0 = x0 + k0 * innovation
+        x1 = x1 + k1 * innovation
+        self.P = [[(1 - k0) * p00, (1 - k0) * p01], [p10 - k1 * p00, p11 - k1 * p01]]
+        self.x = [x0, x1]
+        return x1
+
+
+VELOCITY_FILTERS = {'MovingAverage': (MovingAverageFilter, {'Window': 'window'}),
+                    'Exponential': (ExponentialFilter, {'TimeConstant': 'time_constant'}),
+                    'SavitzkyGolay': (SavitzkyGolayFilter, {'Window': 'window', 'Order': 'order'}),
+                    'Kalman': (KalmanFilter, {'ProcessNoise': 'process_noise', 'MeasurementNoise': 'measurement_noise'})}
+
+
+def make_velocity_filter(config=None, position_resolution=None):
+    """Create the velocity filter described by the VelocityFilter option of the Maze section.
+
+    Args:
+        config: Name of the filter, or a dictionary with its Type and parameters.
+                Defaults to a 50 sample MovingAverage.
+        position_resolution: Position change (cm) of one encoder step (sets the
+                             default measurement noise of the Kalman filter).
+    """
+    if config is None:
+        config = 'MovingAverage'
+    if isinstance(config, str):
+        config = {'Type': config}
+    filter_type = config.get('Type', 'MovingAverage')
+    if filter_type not in VELOCITY_FILTERS:
+        raise(ValueError('Unknown VelocityFilter {}. Currently implemented: {}.'.format(
+            filter_type, ', '.join(VELOCITY_FILTERS))))
+    filter_class, parameter_names = VELOCITY_FILTERS[filter_type]
+    for key in config:
+        if key != 'Type' and key not in parameter_names:
+            raise(ValueError('Unknown parameter {} for VelocityFilter {}.'.format(key, filter_type)))
+    kwargs = {argument: config[key] for key, argument in parameter_names.items() if key in config}
+
+    if (filter_class is KalmanFilter) and position_resolution:
+        kwargs['position_resolution'] = position_resolution
+    return filter_class(**kwargs)